@@ -3,23 +3,50 @@
 
 Options apply to multiple verbs:
 
--t abc  - Set output type (see 'check' below).
--o path - Set output file path.
--l lib  - Use lib instead of default library file.
+-t abc  - Set output type (see 'check' below).  convert takes a list, such
+          as -t opus,mp3, to write several types at once.
+-o path - Set output file path.  With several output types, either give a
+          path for each (-o /music/opus,/music/mp3), or one path, which
+          gets a directory for each type.
+-l lib  - Use lib instead of default library file.  If lib ends in .db
+          or .sqlite, it is a SQLite database instead of a pickle.
 -0      - Write output to stdout with null delimiters.
+-j n    - Run n jobs at once when scanning, converting, or updating tags.
+          With -j auto, convert times each encoder and then finds its own
+          way to the number of jobs that gets the most done (see the
+          AUTO_ settings in flaccfg); other verbs run a job per CPU.
+--dry-run - Make update_tags print what it would change, and stop there.
+--fix   - Make audit repair the files it complains about.
+--album - Make convert decode each flac file once, cutting the audio into
+          tracks on the way to the encoders, instead of once per track.
+--keep-albums - Make convert finish albums one after another, instead of
+          running the longest tracks first wherever they are.
+--resume - Make convert finish the last run into the -o path, instead of
+          starting a new one.
 
 There must be exactly one verb, which may have arguments:
 
 init path1 path2 ...
-  Create new library file with one or more root paths.
+  Create new library file with one or more root paths, and scan them.
+  The scan is journaled as for scan below, so if it is interrupted,
+  running the same init again picks up where it left off.
+
+migrate newlib
+  Copy the library (and remembered options) to newlib, which can be a
+  SQLite database.  Use -l newlib from then on.
 
 check
   Print configuration and self-tests.  Transcoder modules that report
-  "ready" can be used as an argument to -t.
+  "ready" can be used as an argument to -t, and what they can do is
+  listed beside them.
 
 scan
-  Search filesystem and update library index with any new, changed, or
-  deleted flac files.
+  Search filesystem and update library index with any new, changed,
+  moved, or deleted flac files.  With -j, metadata is read from n files at once.
+  Directories that haven't changed since the last scan are trusted
+  without checking each file in them, unless --paranoid is given.
+  Progress is journaled, so an interrupted scan resumes where it
+  stopped the next time.
 
 search flacarg1 flacarg2 ...
   Print absolute paths of selected flac files.  With -0, you can pipe
@@ -28,7 +55,23 @@ search flacarg1 flacarg2 ...
 info flacarg1 flacarg2 ...
   Print metadata tags for selected flac files.
 
+tracks regex1 regex2 ...
+  Print the address and title of every track with a title that matches
+  any of the regexes.  With -0, print only the addresses.
+
+audit [flacarg1 flacarg2 ...]
+  Report selected flac files (or the whole library) that have too little
+  padding for tags to be edited in place, or too few seekpoints to start
+  decoding from the middle quickly.  With --fix, add padding and
+  seekpoints to them, one file at a time per disk and up to -j disks at
+  once.  With -0, print just their paths.
+
+update_tags flacarg1 flacarg2 ...
+  Rewrite the tags of selected flac files in canonical form.  Files
+  whose tags are already canonical are skipped.
+
 extract flacarg1 tracknum
+extract md5#tracknum
   Extract given track from flac file to a wav file in current
   directory.
 
@@ -39,30 +82,58 @@ latest n
 convert flacarg1 flacarg2 ...
   Transcode selected flac files.  Output type and path are controlled
   by -t and -o.  The last-used values are remembered if not specified.
-  Any file that already exists at a desired output path will not be
-  overwritten.
+  With several output types, each track is decoded once and fed to all
+  of their encoders together, at the pace of the slowest one, and each
+  output path is kept up to date on its own.
+  A manifest in the output path records what each output was made from,
+  and only outputs that are missing or whose flac file, track, tags, or
+  encoder settings have changed since are made again.  Outputs the
+  manifest vouches for aren't checked for, unless --paranoid is given.
+  When only the tags have changed, the existing output is retagged
+  instead of encoded again, if the output type knows how.
+  Jobs start while the rest of the flacs are still being planned, and
+  each finished output is printed with how many have been planned,
+  started, and done so far.
+  Up to -j jobs run at once, longest first, but no more at once on
+  each filesystem than DEVICE_CONCURRENCY in flaccfg allows.  A job
+  that hangs is killed (see JOB_TIMEOUT in flaccfg), and failed tracks
+  are tried again a few times before being listed at the end.  Outputs
+  appear only when they are complete, and every run is recorded in the
+  output path, so that an interrupted one can be finished with
+  convert --resume (which takes no flacargs) without redoing anything.
 
 Any flacarg may be either a resolvable file name, or a regex that will
 be matched against filenames, artists, and album tags in the entire
-library.
+library.  The library keeps a search index (built by scan) so that this
+doesn't have to try every regex on every file.  For extract and convert,
+a flacarg may also be a track address, md5#tracknum, as printed by
+tracks.
 
 Copyright 2009-2017 Mikey Dickerson.  Modification and redistribution
 are permitted under the terms of the GNU General Public License,
 version 2.
 """
 
-import Queue
+import collections
+import copy
 import getopt
 import os
-import random
 import re
 import sys
-import tempfile
-import threading
+import time
 
+import flacenstein.engine as engine
 import flacenstein.flaclib as flaclib
 import flacenstein.flaccfg as flaccfg
+import flacenstein.ledger as ledger
+import flacenstein.manifest as manifest
+import flacenstein.outtags as outtags
+import flacenstein.pipeline as pipeline
+import flacenstein.schedule as schedule
+
 
+# a single track, as printed by the tracks verb
+TRACK_ADDRESS = re.compile(r'^([0-9a-f]{32})#(\d+)$')
 
 class Error(Exception): pass
 
@@ -90,104 +161,422 @@ def parse_flac_args(lib, args):
       flacs.append(flaclib.FlacFile(arg))
     else:
       regex = re.compile(arg, re.IGNORECASE)
-      for flac in lib.flacs.values():
-        if (regex.search(flac.filename) or
-            regex.search(flac.artist or "") or
-            regex.search(flac.album or "")):
-            flacs.append(flac)
+      flacs.extend(lib.match(regex))
   return flacs
 
 
-def print_stdout(what, null_delimiter=False):
-  if null_delimiter:
-    sys.stdout.write(what)
-    sys.stdout.write('\0')
-  else:
-    print what
-
+def parse_track_args(lib, args):
+  """
+  Like parse_flac_args(), but returns (flac, tracknums) pairs, where
+  tracknums is a list of 0-based track numbers, or None for all of them.
+  Track addresses are looked up directly instead of searched for.
+  """
+  selected = []
+  for arg in args:
+    m = TRACK_ADDRESS.match(arg)
+    if m:
+      flac = lib.get(m.group(1))
+      if flac is None: raise Error('%s is not in the library' % m.group(1))
+      selected.append((flac, [int(m.group(2)) - 1]))
+    else:
+      selected.extend([ (flac, None) for flac in parse_flac_args(lib, [arg]) ])
+  return selected
 
-class TranscodeWorker(threading.Thread):
 
-  def __init__(self, queue, xfmmod, myname):
-    threading.Thread.__init__(self)
-    self.queue = queue
-    self.xfmmod = xfmmod
-    self.myname = myname
+def save_tags(flac):
+  """parallel_imap() worker for update_tags: (flac, how, error)."""
+  try:
+    return flac, flac.saveTags(preserve_mtime=True), None
+  except (flaclib.Error, EnvironmentError), e:
+    return flac, None, e
 
-  def run(self):
-    while not self.queue.empty():
-      job = self.queue.get()
-      child = os.fork()
-      if child == 0:
-        # encodeFile() is expected to exec an encoder process and
-        # exit with a status code.
-        self.xfmmod.encodeFile(job)
-        assert False, 'Unpossible! encodeFile() returned!'
 
-      try:
-        os.waitpid(child, 0)
-      except KeyboardInterrupt:
-        print 'Killing child process %s' % child
-        os.kill(child, 15)
-        print 'See You Space Cowboy'
-        return
+def fix_layout(item):
+  """device_imap() worker for audit --fix: (flac, error)."""
+  flac, problems = item
+  try:
+    flac.fixLayout(problems)
+    return flac, None
+  except (flaclib.Error, EnvironmentError), e:
+    return flac, e
 
-      self.queue.task_done()
-      print 'worker %s finished %s' % (self.myname, job.outfile)
 
+def print_stdout(what, null_delimiter=False):
+  if null_delimiter:
+    sys.stdout.write(what)
+    sys.stdout.write('\0')
+  else:
+    print what
 
-def transcode_flacs(flaclist, prefs):
 
-  if not prefs['output_path'] and prefs['output_type']:
+class Target:
+  """One output type that convert writes, and where."""
+
+  def __init__(self, name, path, trees):
+    self.name = name
+    self.path = path
+    self.xfmmod = import_xfm(name)
+    if self.xfmmod is None or not self.xfmmod.ready():
+      raise Error('%s module failed self-tests' % name)
+    self.xfmmod.outpath = path
+    # targets that share an output path share its manifest
+    if path not in trees: trees[path] = manifest.Manifest(path)
+    self.tree = trees[path]
+
+
+def parse_targets(output_type, output_path):
+  """
+  Pairs up the output types in -t with the paths in -o, as [(type,
+  path)].  Each type can have its own path, or they can share one, in
+  which case each gets a directory of its own under it.
+  """
+  if not output_type or not output_path:
     raise Error('must specify output path and type')
-
-  xfmmod = import_xfm(prefs['output_type'])
-  xfmmod.outpath = prefs['output_path']
-  if not xfmmod.ready():
-    raise Error('%s module failed self-tests' % prefs['output_type'])
-
-  print 'output type is %s' % xfmmod.description
-  artdir = tempfile.mkdtemp('', 'flacart.')
-  joblist = []
-  class EncodeJob: pass
-
-  for f in flaclist:
-    for c, t in enumerate(f.tracks):
-      j = EncodeJob()
-      j.tracknum = c + 1
-      j.artist = f.artist
-      j.title = t or 'Track %d' % j.tracknum
-      j.album = f.album
-      j.flacfile = f.filename
-      j.coverart = f.extractThumbnail(artdir)
-      fname = '%02d %s.%s' % (j.tracknum, t, xfmmod.extension)
-      j.outfile = os.path.join(prefs['output_path'],
+  types = output_type.split(',')
+  paths = output_path.split(',')
+  if len(set(types)) != len(types):
+    raise Error('output type given twice in %s' % output_type)
+  if len(types) > 1 and len(paths) == 1:
+    paths = [ os.path.join(paths[0], t) for t in types ]
+  if len(paths) != len(types):
+    raise Error('%d output types but %d output paths' % (len(types),
+                                                         len(paths)))
+  return zip(types, paths)
+
+
+def retag(xfmmod, job):
+  """
+  Retags job's existing output instead of encoding it again, and returns
+  [(job, None)], or None if that can't be done.
+  """
+  try:
+    outdir = os.path.dirname(job.outfile)
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+    xfmmod.retagFile(job)
+    return [(job, None)]
+  except (outtags.Error, EnvironmentError), e:
+    print "can't retag %s (%s), so encoding it again" % (job.final, e)
+    return None
+
+
+def group_jobs(joblist, targets, albums=False):
+  """
+  Gathers the jobs in joblist that can share a decoder into
+  pipeline.AlbumJobs: the jobs for each track, one per output type, or
+  with albums, all the jobs for each flac file.  The jobs that can't be
+  gathered, or that have no one to share with, are returned as is.
+  """
+  groups = {}
+  out = []
+  for j in joblist:
+    # retagging is quick enough on its own, and a track whose range we
+    # don't know, or whose encoder can't read a pipe, has to be alone
+    if (getattr(j, 'retag', False) or j.start is None or
+        not pipeline.capabilities(targets[j.target].xfmmod).streams):
+      out.append(j)
+      continue
+    if albums: key = j.flacfile
+    else: key = (j.flacfile, j.start)
+    groups.setdefault(key, []).append(j)
+  start = lambda src, job: pipeline.start_encoder(targets[job.target].xfmmod,
+                                                  src, job)
+  for jobs in groups.values():
+    if len(jobs) == 1 and not albums:
+      out.extend(jobs)
+      continue
+    album = pipeline.AlbumJob(jobs, start)
+    album.device = jobs[0].device
+    # each track is read once, however many encoders it goes to
+    album.source_bytes = sum([ t[0].source_bytes for t in album.tracks ])
+    out.append(album)
+  return out
+
+
+def plan_jobs(selected, targets, paranoid=False):
+  """
+  Yields a list for each flac file in selected of the EncodeJobs for its
+  tracks whose outputs are missing or out of date according to each
+  target's manifest.  This is a generator so that the first of them can
+  be encoded while the rest are planned.
+  """
+  reasons = dict([ (name, {}) for name in targets ])
+  for f, tracknums in selected:
+    if tracknums is None: tracknums = range(len(f.tracks))
+    joblist = []
+    # every track gets the same art, so it only has to be found once
+    coverart = f.extractThumbnail()
+    for c in tracknums:
+      if c < 0 or c >= len(f.tracks):
+        raise Error('%s has no track %d' % (f.filename, c + 1))
+      t = f.tracks[c]
+      track = pipeline.EncodeJob()
+      track.tracknum = c + 1
+      track.artist = f.artist
+      track.title = t or 'Track %d' % track.tracknum
+      track.album = f.album
+      track.flacfile = f.filename
+      # exact sample ranges, and track lengths to estimate costs with
+      track.start, track.end, track.samples = f.trackRange(c)
+      track.channels = f.channels
+      track.bits_per_sample = f.bits_per_sample
+      track.sample_rate = f.sample_rate
+      track.device = schedule.source_device(f)
+      track.coverart = coverart
+      for target in targets.values():
+        j = copy.copy(track)
+        j.target = target.name
+        j.source_bytes = schedule.source_bytes(f, j.samples)
+        fname = '%02d %s.%s' % (j.tracknum, t, target.xfmmod.extension)
+        j.final = os.path.join(target.path,
                                flaclib.filequote(f.artist),
                                flaclib.filequote(f.album),
                                flaclib.filequote(fname))
-      j.failures = 0
-      if not os.path.isfile(j.outfile): joblist.append(j)
+        # the encoder writes beside it, and it is renamed when it's done
+        j.outfile = pipeline.partial_name(j.final)
+        j.failures = 0
+        # what the output will have been made from, when it's done
+        j.entry = manifest.make_entry(f, j, target.xfmmod)
+        j.reason = target.tree.status(j.final, j.entry, paranoid)
+        if j.reason is None: continue
+        # the output we have now, which might be under an old name
+        j.existing = j.final
+        j.replaces = target.tree.renamed(j.final, j.entry)
+        if j.replaces:
+          j.existing = j.replaces
+          j.reason = (target.tree.status(j.replaces, j.entry, paranoid) or
+                      'renamed')
+        # if only the tags are different, the audio we have will do
+        j.retag = (j.reason in ('tags', 'renamed') and
+                   hasattr(target.xfmmod, 'retagFile'))
+        if j.retag: j.source_bytes = 0
+        counts = reasons[target.name]
+        counts[j.reason] = counts.get(j.reason, 0) + 1
+        joblist.append(j)
+    if joblist: yield joblist
+  for name, counts in reasons.items():
+    if not counts: continue
+    print 'Planned for %s: %s' % (name, ', '.join([
+      '%d %s' % (n, why) for why, n in sorted(counts.items()) ]))
+
+
+def record_plan(batches, jobledger):
+  """Passes on the lists of jobs in batches, adding them to the ledger."""
+  for joblist in batches:
+    jobledger.planned(joblist)
+    yield joblist
+  jobledger.planned_all()
+
+
+def transcode_flacs(selected, prefs, albums=False, keep_albums=False,
+                    resume=False, paranoid=False):
+
+  pairs = parse_targets(prefs.get('output_type'), prefs.get('output_path'))
+  # the run is recorded with the first output type
+  jobledger = ledger.JobLedger(ledger.ledger_path(pairs[0][1]))
+  trees = {}
+  try:
+    if resume:
+      jobledger.load()
+      options = jobledger.options
+      pairs = options['targets']
+      counts = jobledger.counts()
+      print 'Resuming: %(done)d done, %(failed)d failed, ' \
+            '%(started)d interrupted, %(waiting)d not started' % counts
+      if not jobledger.complete:
+        print 'That run was stopped before it was all planned; convert ' \
+              'the same flacs again afterward for the rest'
+    else:
+      options = { 'targets': pairs, 'albums': albums,
+                  'keep_albums': keep_albums, 'planned': time.time() }
+
+    targets = collections.OrderedDict()
+    for name, path in pairs:
+      targets[name] = Target(name, path, trees)
+      print 'output type is %s, in %s' % (targets[name].xfmmod.description,
+                                          path)
+
+    if resume:
+      joblist = []
+      for j in jobledger.unfinished():
+        # a job that finished just before we were stopped might not have
+        # been recorded, but its output is where it should be
+        if newer_than(j.final, options['planned']):
+          output_done(j, targets[j.target].tree)
+        else: joblist.append(j)
+      batches = [ joblist ]
+    else:
+      jobledger.plan(options)
+      batches = record_plan(plan_jobs(selected, targets, paranoid), jobledger)
+    run_jobs(batches, targets, options, prefs.get('threads', 1), jobledger)
+  finally:
+    for tree in trees.values(): tree.save()
+    jobledger.close()
 
-  num_threads = prefs.get('threads', 1)
-  print 'Prepared %d jobs' % len(joblist)
-  if num_threads > 3:
-    print 'Randomizing jobs to reduce I/O bottlenecks'
-    random.shuffle(joblist)
 
-  jobq = Queue.Queue()
-  while joblist: jobq.put(joblist.pop())
+def newer_than(fname, t):
+  try:
+    return os.path.getmtime(fname) >= t
+  except OSError:
+    return False
 
-  bag_o_threads = set()
-  while len(bag_o_threads) < prefs.get('threads', 1):
-    t = TranscodeWorker(jobq, xfmmod, len(bag_o_threads))
-    t.start()
-    bag_o_threads.add(t)
 
-  # we wait for all the threads to exit, rather than wait for the
-  # queue to be empty, because the worker threads might crash.
-  while bag_o_threads:
-    t = bag_o_threads.pop()
-    t.join()
+def output_done(job, tree):
+  """Notes job's output in the manifest, and removes what it replaces."""
+  tree.record(job.final, job.entry)
+  if job.replaces:
+    try:
+      os.unlink(job.replaces)
+      # and the album and artist directories, if that emptied them
+      os.removedirs(os.path.dirname(job.replaces))
+    except OSError:
+      pass
+    tree.forget(job.replaces)
+
+
+def journaled_scan(lib, library_file, prefs, paranoid=False):
+  """
+  Scans lib, journaling each change beside library_file as it goes, so
+  that an interrupted scan picks up where it left off next time, and
+  saves it.  Exits if another scan has the journal.
+  """
+  def compact():
+    flaclib.writeSavefile(library_file, lib, prefs)
+  try:
+    journal = flaclib.ScanJournal(os.path.expanduser(library_file) +
+                                  '.journal', compact)
+  except flaclib.JournalBusy, e:
+    sys.stderr.write('%s\n' % e)
+    sys.exit(1)
+  recovered = journal.replay(lib)
+  if recovered:
+    print 'Recovered %d changes from an interrupted scan' % recovered
+  changed = lib.scan(threads=thread_count(prefs), paranoid=paranoid,
+                     journal=journal)
+  if changed or recovered: compact()
+  journal.discard()
+
+
+def thread_count(prefs):
+  """How many jobs to run at once, for the verbs that don't do -j auto."""
+  threads = prefs.get('threads', 1)
+  if threads == 'auto': return schedule.cpu_count()
+  return threads
+
+
+def auto_concurrency(targets):
+  """
+  Times each target's encoder, and returns ({type: speed}, Concurrency)
+  for -j auto.  Each job runs an encoder for every type at once, if they
+  can share a decoder, so it starts with enough jobs for one per CPU.
+  """
+  speeds = {}
+  for name, target in targets.items():
+    speeds[name] = schedule.calibrate(target.xfmmod)
+    if speeds[name]: print '%s encodes at %.1fx realtime' % (name, speeds[name])
+    else: print "can't time the %s encoder, so guessing its speed" % name
+  cpus = schedule.cpu_count()
+  per_job = sum([ pipeline.capabilities(t.xfmmod).threads
+                  for t in targets.values() ])
+  most = min([ flaccfg.AUTO_MAX_JOBS.get(name,
+                                         cpus * flaccfg.AUTO_JOBS_PER_CPU)
+               for name in targets ])
+  return speeds, schedule.Concurrency(max(1, cpus / per_job), most)
+
+
+def run_jobs(batches, targets, options, num_threads, jobledger):
+  """
+  Runs the jobs in batches, an iterable of lists of EncodeJobs, which is
+  read from only as the jobs are needed.
+  """
+
+  for target in targets.values():
+    if options['albums'] and not pipeline.capabilities(target.xfmmod).streams:
+      print '%s module can only encode a track at a time' % \
+        target.xfmmod.description
+
+  speeds, auto = {}, None
+  if num_threads == 'auto':
+    speeds, auto = auto_concurrency(targets)
+    num_threads = auto.most
+    print 'Starting with %d jobs at once, and up to %d' % (auto(), auto.most)
+
+  # longest jobs first, so the run doesn't end waiting on one of them,
+  # as far as we've planned; or with keep_albums, the albums in order
+  speed = lambda j: speeds.get(j.target) or schedule.encoder_speed(j.target)
+  if options['keep_albums']: priority = lambda job: (job.batch, -job.cost)
+  else: priority = lambda job: -job.cost
+  counts = { 'planned': 0, 'started': 0, 'done': 0 }
+  costs = []
+
+  def prepared():
+    for n, joblist in enumerate(batches):
+      counts['planned'] += len(joblist)
+      joblist = group_jobs(joblist, targets, options['albums'])
+      for cost, job in schedule.estimate(joblist, speed):
+        job.cost, job.batch = cost, n
+        costs.append((cost, job))
+        yield job
+
+  def started(job):
+    counts['started'] += 1
+    jobledger.started(job)
+
+  # ...but no more at once from each disk than it can keep up with
+  xfm = lambda job: targets[job.target].xfmmod
+  jobs = engine.Engine(lambda src, job: pipeline.start_encoder(xfm(job), src,
+                                                               job),
+                       num_threads, per_device=schedule.device_limit,
+                       running=auto, retag=lambda job: retag(xfm(job), job),
+                       started=started)
+  started_at = time.time()
+  finished = []
+  stats = schedule.DeviceStats()
+  running = jobs.run(prepared(), priority)
+  try:
+    for job, results, t0, t1 in running:
+      encoded = 0.0
+      for j, err in results:
+        if err:
+          jobledger.failed(j, err)
+          continue
+        output_done(j, targets[j.target].tree)
+        jobledger.done(j)
+        counts['done'] += 1
+        print 'finished %s (%d planned, %d started, %d done)' % (
+          j.final, counts['planned'], counts['started'], counts['done'])
+        if not getattr(j, 'retag', False):
+          encoded += schedule.audio_length(j) or 0.0
+      stats.add(job.device, job.source_bytes, t0, t1)
+      finished.append(t1)
+      if auto:
+        change = auto.finished(encoded, t1)
+        if change: print change
+  finally:
+    # on ^C, this stops the encoders before we go
+    running.close()
+  if not finished:
+    print 'Nothing to do'
+    return
+  # what the whole run would have taken if we'd known it all at the start;
+  # the engine only ever chose among the LOOKAHEAD jobs planned next
+  predicted = schedule.makespan(schedule.lpt(costs, options['keep_albums']),
+                                auto and auto() or num_threads)
+
+  # the last few jobs to finish are when the workers ran out of work
+  if auto: num_threads = auto()
+  tail = finished[-min(num_threads, len(finished))]
+  print 'Predicted %s (had it all been planned up front), took %s; ' \
+        'workers went idle over the last %s' % (
+          schedule.format_seconds(predicted),
+          schedule.format_seconds(finished[-1] - started_at),
+          schedule.format_seconds(finished[-1] - tail))
+  if auto: print 'Ran %d to %d jobs at once' % (auto.low, auto.high)
+  for line in stats.report(): print line
+  if jobs.failures:
+    print '%d failed, after %d tries each:' % (len(jobs.failures),
+                                               jobs.retries + 1)
+    for j, err in jobs.failures: print '  %s: %s' % (j.final, err)
+    print 'convert --resume will try them again'
 
 
 if __name__ == '__main__':
@@ -199,7 +588,9 @@ if __name__ == '__main__':
   state_dirty = False
 
   try:
-    opts, args = getopt.getopt(sys.argv[1:], 't:o:l:0j:')
+    opts, args = getopt.getopt(sys.argv[1:], 't:o:l:0j:',
+                               ['paranoid', 'dry-run', 'fix', 'album',
+                                'keep-albums', 'resume'])
     opts = dict(opts)
   except getopt.GetoptError, e:
     sys.stderr.write(str(e) + '\n')
@@ -224,7 +615,8 @@ if __name__ == '__main__':
 
   if '-j' in opts:
     try:
-      prefs['threads'] = int(opts['-j'])
+      if opts['-j'] == 'auto': prefs['threads'] = 'auto'
+      else: prefs['threads'] = int(opts['-j'])
     except ValueError:
       usage('non-integer argument for threads: %s' % opts['-j'])
     state_dirty = True
@@ -237,7 +629,7 @@ if __name__ == '__main__':
 
   if verb == 'check':
 
-    print 'Library %s contains %s files' % (library_file, len(lib.flacs))
+    print 'Library %s contains %s files' % (library_file, lib.count())
     print 'Library root paths are: %s' % lib.rootpaths
     print 'Last used output path is: %s' % prefs.get('output_path', '')
     print 'Last used output type is: %s' % prefs.get('output_type', '')
@@ -246,7 +638,11 @@ if __name__ == '__main__':
     for xfm in flaccfg.XFM_MODS:
       xfmmod = import_xfm(xfm)
       if xfmmod and xfmmod.ready():
-        print '%s module is ready' % xfm
+        caps = pipeline.capabilities(xfmmod)
+        print '%s module is ready: .%s, %s-bit input, %s, %s' % (
+          xfm, caps.extension, '/'.join(map(str, caps.sample_bits)),
+          caps.art and 'tags and art' or caps.tags and 'tags' or 'no tags',
+          caps.streams and 'shares decoders' or 'decodes for itself')
       else:
         print '%s failed self-tests and is disabled.' % xfm
       del xfmmod
@@ -255,39 +651,125 @@ if __name__ == '__main__':
 
     # throw away the lib object we might already have
     lib = flaclib.FlacLibrary(args[1:])
-    lib.scan()
+    # the first scan is the longest, so it's journaled like any other
+    journaled_scan(lib, library_file, prefs)
     state_dirty = True
 
+  elif verb == 'migrate':
+
+    if len(args) != 2: usage()
+    flaclib.writeSavefile(args[1], lib, prefs)
+    print 'Wrote %d files to %s' % (lib.count(), args[1])
+
   elif verb == 'scan':
 
-    state_dirty = lib.scan()
+    journaled_scan(lib, library_file, prefs, paranoid='--paranoid' in opts)
+    state_dirty = False
 
   elif verb == 'update_tags':
 
     # There is no "standard" for vorbis tags, so the useful form has varied
     # over time.  flaclib understands more than one variant, but always
     # generates the current "canonical" form when you call saveTags().  So
-    # this is a cheap way to bring old-form tags up to date.
+    # this is a cheap way to bring old-form tags up to date.  Files that
+    # already have canonical tags are left alone, and mostly we can tell
+    # that without even opening them.
     to_update = parse_flac_args(lib, args[1:])
-    for flac in to_update:
-      print 'Rewriting tags for %s' % flac.filename
-      flac.saveTags(preserve_mtime=True)
+    stale = [ flac for flac in to_update if flac.commentsChanged() ]
+    if '--dry-run' in opts:
+      for flac in stale: print_stdout(flac.filename, print_nulls)
+      sys.exit(0)
+    # Most files have enough padding for the tags to be rewritten in place;
+    # the rest have to be copied in full, which is worth knowing about.
+    counts = { 'unchanged': len(to_update) - len(stale) }
+    for flac, how, err in flaclib.parallel_imap(save_tags, stale,
+                                                thread_count(prefs)):
+      if err:
+        print 'Failed to rewrite tags for %s: %s' % (flac.filename, err)
+        how = 'failed'
+      else:
+        print 'Rewrote tags (%s) for %s' % (how, flac.filename)
+        flac.setStat(os.stat(flac.filename))
+        if lib.get(flac.md5) is not None:
+          lib.put(flac)
+          state_dirty = True
+      counts[how] = counts.get(how, 0) + 1
+    print ', '.join([ '%d %s' % (n, kind)
+                      for kind, n in sorted(counts.items()) ])
+
+  elif verb == 'audit':
+
+    if len(args) > 1: to_audit = parse_flac_args(lib, args[1:])
+    else: to_audit = lib.flacs.values()
+    offenders = []
+    counts = { 'padding': 0, 'seektable': 0 }
+    for flac in to_audit:
+      known = flac.padding is not None and flac.seekpoints is not None
+      try:
+        problems = flac.layoutProblems()
+      except flaclib.Error, e:
+        print 'Failed to read %s' % e
+        continue
+      # libraries scanned before we kept track of these learn them now
+      if not known and lib.get(flac.md5) is not None:
+        lib.put(flac)
+        state_dirty = True
+      if not problems: continue
+      offenders.append((flac, problems))
+      for p in problems: counts[p] += 1
+      if print_nulls:
+        print_stdout(flac.filename, True)
+        continue
+      seconds = float(flac.samples or 0) / (flac.sample_rate or 1)
+      if flac.seekpoints: spacing = '%.1fs' % (seconds / flac.seekpoints)
+      else: spacing = 'none'
+      print '%-18s %8d %6s  %s' % (','.join(problems), flac.padding, spacing,
+                                   flac.filename)
+    if not print_nulls:
+      print '%d files, %d with too little padding, %d with too few ' \
+            'seekpoints' % (len(to_audit), counts['padding'],
+                            counts['seektable'])
+
+    if '--fix' in opts:
+      for flac, err in flaclib.device_imap(fix_layout, offenders,
+                                           thread_count(prefs),
+                                           device=lambda (f, p): f.device):
+        if err:
+          print 'Failed to fix %s: %s' % (flac.filename, err)
+          continue
+        print 'Fixed %s' % flac.filename
+        if lib.get(flac.md5) is not None:
+          lib.put(flac)
+          state_dirty = True
 
   elif verb == 'search':
 
     flacs = parse_flac_args(lib, args[1:])
     for f in flacs: print_stdout(f.filename, print_nulls)
 
+  elif verb == 'tracks':
+
+    for arg in args[1:]:
+      regex = re.compile(arg, re.IGNORECASE)
+      for t in sorted(lib.matchTracks(regex)):
+        address = '%s#%d' % (t.md5, t.tracknum)
+        if print_nulls: print_stdout(address, True)
+        else: print '%s %s' % (address, t.title)
+
   elif verb == 'extract':
 
-    flacs = parse_flac_args(lib, [args[1]])
-    # people typically expect track numbers to be 1-based
-    tracknum = int(args[2]) - 1
+    if len(args) < 2: usage()
+    flacs = parse_track_args(lib, [args[1]])
     if len(flacs) != 1:
       print 'Argument %s must match 1 file in library, not %d' % \
         (args[1], len(flacs))
       sys.exit(1)
-    flacs[0].extractTrack(tracknum)
+    flac, tracknums = flacs[0]
+    if tracknums is None:
+      if len(args) < 3: usage()
+      # people typically expect track numbers to be 1-based
+      tracknums = [int(args[2]) - 1]
+    flac.extractTrack(tracknums[0])
 
   elif verb == 'latest':
 
@@ -298,9 +780,7 @@ if __name__ == '__main__':
       except ValueError:
         usage()
 
-    flacs = lib.flacs.values()
-    flacs.sort(key=lambda f: f.mtime, reverse=True)
-    for f in flacs[:n]: print_stdout(f.filename, print_nulls)
+    for f in lib.latest(n): print_stdout(f.filename, print_nulls)
 
   elif verb == 'info':
 
@@ -310,12 +790,31 @@ if __name__ == '__main__':
       print 'Artist: %s' % f.artist
       print 'Album: %s' % f.album
       print 'Date: %s' % f.date
-      for n, t in enumerate(f.tracks): print 'Track %d: %s' % (n+1, t)
+      for t in f.getTracks():
+        if t.start is None or not f.sample_rate:
+          print 'Track %d: %s' % (t.tracknum, t.title)
+        else:
+          seconds = int(round(float(t.end - t.start) / f.sample_rate))
+          print 'Track %d: %s (%d:%02d)' % (t.tracknum, t.title,
+                                            seconds / 60, seconds % 60)
 
   elif verb == 'convert':
 
-    to_convert = parse_flac_args(lib, args[1:])
-    transcode_flacs(to_convert, prefs)
+    try:
+      if '--resume' in opts:
+        if len(args) > 1: usage('convert --resume takes no arguments')
+        transcode_flacs(None, prefs, resume=True)
+      else:
+        to_convert = parse_track_args(lib, args[1:])
+        transcode_flacs(to_convert, prefs, albums='--album' in opts,
+                        keep_albums='--keep-albums' in opts,
+                        paranoid='--paranoid' in opts)
+    except (Error, ledger.Error), e:
+      sys.stderr.write('%s\n' % e)
+      sys.exit(1)
+    except KeyboardInterrupt:
+      sys.stderr.write('Interrupted; convert --resume will finish the job\n')
+      sys.exit(1)
 
   else:
     usage()
@@ -23,7 +23,6 @@ if os.path.isfile(cfgfile):
 
 # give file parameters the benefit of ~ expansion
 flaccfg.DEFAULT_LIBRARY = os.path.expanduser(flaccfg.DEFAULT_LIBRARY)
-flaccfg.IMAGE_TEMP_PATH = os.path.expanduser(flaccfg.IMAGE_TEMP_PATH)
 flaccfg.MISSING_ART_IMAGE = os.path.expanduser(flaccfg.MISSING_ART_IMAGE)
 
 app = wx.PySimpleApp()
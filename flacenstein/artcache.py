@@ -0,0 +1,265 @@
+"""
+A cache of the cover art in FLAC files, kept between runs and shared by
+flac-cli.py and the GUI.
+
+Each image is stored once, under the sha1 of its data, so the same
+artwork on fifty albums takes up space once.  An index maps each album
+(by md5) to the picture block its art came from, and the mtime and size
+the file had at the time; as long as those are the same, the file isn't
+opened at all.  When the images add up to more than ART_CACHE_SIZE, the
+least recently used ones are thrown out.
+
+The index on disk is only written by flush(), which merges in whatever
+other processes have flushed in the meantime.  The shared cache returned
+by defaultCache() is flushed at exit.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import atexit
+import errno
+import fcntl
+import hashlib
+import os
+import cPickle as pickle
+import subprocess
+import tempfile
+import threading
+import time
+
+import flaccfg
+import flacmeta
+
+FRONT_COVER = 3 # PICTURE type
+URL_MIME = '-->' # PICTURE data that is a URL, not an image
+
+EXTENSIONS = { 'image/jpeg': '.jpg', 'image/jpg': '.jpg',
+               'image/png': '.png', 'image/gif': '.gif' }
+
+
+def _choose_picture(md):
+    """Returns the front cover if there is one, or else the first picture."""
+    pictures = [ p for p in md.pictures if p.mime != URL_MIME ]
+    for p in pictures:
+        if p.type == FRONT_COVER: return p
+    if pictures: return pictures[0]
+    return None
+
+
+def _guess_mime(data):
+    if data.startswith('\x89PNG'): return 'image/png'
+    if data.startswith('GIF8'): return 'image/gif'
+    return 'image/jpeg'
+
+
+class ArtCache:
+
+    def __init__(self, path=flaccfg.ART_CACHE_PATH,
+                 maxsize=flaccfg.ART_CACHE_SIZE):
+        self.path = os.path.expanduser(path)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+        # md5 -> (mtime, filesize, picture block offset, sha1 or None)
+        # sha1 -> [file name relative to self.path, size, last used]
+        self.albums, self.images = self._load()
+        self.changed = set() # md5s we have looked at since the last flush
+        self.added = set()   # sha1s we have stored since the last flush
+        self.dirty = False
+
+    def _load(self):
+        try:
+            fd = open(os.path.join(self.path, 'index'), 'rb')
+        except IOError:
+            return {}, {}
+        try:
+            try:
+                return pickle.load(fd)
+            except Exception:
+                # a damaged index only costs us some re-extraction
+                return {}, {}
+        finally:
+            fd.close()
+
+    def _write(self, albums, images):
+        fd, tmp = tempfile.mkstemp('', '.index.', self.path)
+        try:
+            fd = os.fdopen(fd, 'wb')
+            pickle.dump((albums, images), fd, pickle.HIGHEST_PROTOCOL)
+            fd.close()
+            os.rename(tmp, os.path.join(self.path, 'index'))
+        except:
+            os.unlink(tmp)
+            raise
+
+    def lookup(self, flac):
+        """
+        Returns the name of the file holding flac's cover art, or None if
+        it doesn't have any.
+        """
+        self.lock.acquire()
+        try:
+            album = self.albums.get(flac.md5)
+            if album and album[:2] == (flac.mtime, flac.filesize):
+                sha1 = album[3]
+                if sha1 is None: return None
+                image = self.images.get(sha1)
+                # somebody else might have evicted it since
+                if image and os.path.isfile(os.path.join(self.path, image[0])):
+                    image[2] = time.time()
+                    self.dirty = True
+                    return os.path.join(self.path, image[0])
+        finally:
+            self.lock.release()
+        # Reading the picture happens outside the lock, since it's I/O.
+        offset, data, certain = self._extract(flac)
+        if data is None:
+            if certain: self._remember(flac, offset, None)
+            return None
+        sha1 = hashlib.sha1(data).hexdigest()
+        fname = self._store(sha1, data)
+        self._remember(flac, offset, sha1)
+        return fname
+
+    def _remember(self, flac, offset, sha1):
+        self.lock.acquire()
+        try:
+            self.albums[flac.md5] = (flac.mtime, flac.filesize, offset, sha1)
+            self.changed.add(flac.md5)
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+    def _extract(self, flac):
+        """
+        Returns (picture block offset, image data, certain), where data is
+        None if there is no picture, and certain says whether that is
+        worth remembering or might just be a failure to read the file.
+        """
+        try:
+            md = flacmeta.readMetadata(flac.filename)
+        except flacmeta.Error:
+            return self._exportWithMetaflac(flac)
+        except IOError:
+            return None, None, False
+        picture = _choose_picture(md)
+        if picture is None: return None, None, True
+        fd = open(flac.filename, 'rb')
+        try:
+            fd.seek(picture.data_offset)
+            data = fd.read(picture.data_length)
+        finally:
+            fd.close()
+        if len(data) != picture.data_length: return None, None, False
+        return picture.block.offset, data, True
+
+    def _exportWithMetaflac(self, flac):
+        fd, tmp = tempfile.mkstemp('', '.export.', self.path)
+        os.close(fd)
+        try:
+            cmd = [flaccfg.BIN_METAFLAC, '--export-picture-to=%s' % tmp,
+                   '--', flac.filename]
+            try:
+                if subprocess.call(cmd): return None, None, False
+            except OSError:
+                return None, None, False
+            fd = open(tmp, 'rb')
+            try:
+                return None, fd.read(), True
+            finally:
+                fd.close()
+        finally:
+            os.unlink(tmp)
+
+    def _store(self, sha1, data):
+        """Writes data to the cache, unless it is there already."""
+        ext = EXTENSIONS.get(_guess_mime(data), '.jpg')
+        relname = os.path.join(sha1[:2], sha1 + ext)
+        fname = os.path.join(self.path, relname)
+        if not os.path.isfile(fname):
+            dirname = os.path.dirname(fname)
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+            fd, tmp = tempfile.mkstemp('', '.image.', dirname)
+            try:
+                os.write(fd, data)
+                os.close(fd)
+                os.rename(tmp, fname)
+            except:
+                os.unlink(tmp)
+                raise
+        self.lock.acquire()
+        try:
+            self.images[sha1] = [relname, len(data), time.time()]
+            self.added.add(sha1)
+            self.dirty = True
+        finally:
+            self.lock.release()
+        return fname
+
+    def _evict(self, images):
+        total = sum([ image[1] for image in images.values() ])
+        if total <= self.maxsize: return
+        lru = images.items()
+        lru.sort(key=lambda (sha1, image): image[2])
+        for sha1, image in lru:
+            if total <= self.maxsize: break
+            try:
+                os.unlink(os.path.join(self.path, image[0]))
+            except OSError:
+                pass
+            total -= image[1]
+            del images[sha1]
+
+    def flush(self):
+        """
+        Merges what we've learned into the index on disk, and throws out
+        images until we're under the size limit.
+        """
+        if not self.dirty: return
+        lockfd = open(os.path.join(self.path, 'lock'), 'w')
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+            self.lock.acquire()
+            try:
+                albums, images = self._load()
+                for md5 in self.changed: albums[md5] = self.albums[md5]
+                for sha1, image in self.images.items():
+                    if sha1 in images:
+                        images[sha1][2] = max(images[sha1][2], image[2])
+                    elif sha1 in self.added:
+                        images[sha1] = image
+                    # otherwise, somebody else evicted it
+                self._evict(images)
+                self._write(albums, images)
+                self.albums, self.images = albums, images
+                self.changed = set()
+                self.added = set()
+                self.dirty = False
+            finally:
+                self.lock.release()
+        finally:
+            lockfd.close()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+def defaultCache():
+    """Returns the ArtCache everybody shares, which is flushed at exit."""
+    global _default
+    _default_lock.acquire()
+    try:
+        if _default is None:
+            _default = ArtCache()
+            atexit.register(_default.flush)
+        return _default
+    finally:
+        _default_lock.release()
@@ -0,0 +1,250 @@
+"""
+Running convert's jobs: one loop, in one thread, that starts each job's
+decoder and encoders itself, moves the audio along for the ones that
+share a decoder (see pipeline.AlbumJob), and notices when processes
+exit, instead of a thread and a forked interpreter per job.
+
+Jobs are taken from an iterable as they're needed, so the first ones can
+be running while the rest are still being planned.  Of the jobs waiting,
+the most important go first, spread over the devices their flac files
+are on, as device_imap() does.  A job that runs too long for its length
+(JOB_TIMEOUT and JOB_MIN_SPEED in flaccfg), or that stops making
+progress for JOB_STALL_TIMEOUT seconds, has its processes killed and
+fails.  A failed track is tried again, on its own, up to JOB_RETRIES
+times, and only then reported.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import collections
+import errno
+import heapq
+import os
+import select
+import time
+
+import flaccfg
+import pipeline
+import schedule
+
+# how many jobs Engine.run() likes to have waiting, to choose among
+LOOKAHEAD = 64
+
+
+class _Done:
+    """A job that was over as soon as it started (a retag, say)."""
+
+    def __init__(self, results):
+        self.results = results
+        self.progress = time.time()
+
+    def fds(self):
+        return [], []
+
+    def poll(self):
+        return True
+
+    def kill(self, error):
+        pass
+
+
+class _Track:
+    """
+    One track's decoder and encoder, which we only have to wait for.
+    Progress is its output file growing.
+    """
+
+    def __init__(self, job, handle):
+        self.job = job
+        self.handle = handle
+        self.results = []
+        self.progress = self.checked = time.time()
+        self.size = 0
+
+    def fds(self):
+        return [], []
+
+    def poll(self):
+        if self.handle.poll() is None:
+            now = time.time()
+            if now - self.checked < 1: return False
+            self.checked = now
+            try:
+                size = os.path.getsize(self.job.outfile)
+            except OSError:
+                size = 0
+            if size != self.size:
+                self.size = size
+                self.progress = now
+            return False
+        self.results = [(self.job, self.handle.error())]
+        return True
+
+    def kill(self, error):
+        self.handle.kill()
+        self.handle.wait()
+        if os.path.exists(self.job.outfile): os.unlink(self.job.outfile)
+        self.results = [(self.job, error)]
+
+
+class Engine:
+    """
+    Runs jobs (EncodeJobs and AlbumJobs) with start(src, job) to start an
+    encoder, as for AlbumJob.  If retag is given, it's called instead for
+    a job with retag set, and returns [(job, error)], or None to have the
+    job encoded after all.  started(job) is called for each track job as
+    it starts.  No more than per_device jobs run at once for each device
+    (a number, or a function of the device), or than threads in all, or
+    if running is given, than running() says.
+    """
+
+    def __init__(self, start, threads=1, per_device=1, running=None,
+                 retag=None, started=None):
+        self.start = start
+        self.threads = threads
+        if callable(per_device): self.per_device = per_device
+        else: self.per_device = lambda dev: per_device
+        self.running = running
+        self.retag = retag
+        self.started = started or (lambda job: None)
+        self.retries = flaccfg.JOB_RETRIES
+        self.failures = [] # (track job, error), for the ones we gave up on
+
+    def _limit(self):
+        if self.running: return max(1, self.running())
+        return max(1, self.threads)
+
+    def _begin(self, job):
+        if isinstance(job, pipeline.AlbumJob):
+            for j in job.jobs: self.started(j)
+            job.begin()
+            return job
+        self.started(job)
+        if getattr(job, 'retag', False) and self.retag:
+            results = self.retag(job)
+            if results is not None: return _Done(results)
+        try:
+            return _Track(job, self.start(None, job))
+        except pipeline.Error, e:
+            return _Done([(job, str(e))])
+
+    def _deadline(self, job, started):
+        length = schedule.audio_length(job) or schedule.DEFAULT_LENGTH
+        return started + flaccfg.JOB_TIMEOUT + length / flaccfg.JOB_MIN_SPEED
+
+    def run(self, jobs, priority=None):
+        """
+        Yields (job, [(track job, error)], started, finished) for each of
+        jobs as it finishes, once its outputs have been moved into place.
+        A track that failed but will be tried again isn't in the list;
+        it comes back later as a job of its own.  The tracks that failed
+        for good are in failures.  Close the generator if you stop early,
+        so that the jobs still running are stopped.
+
+        jobs can be any iterable, which is only read as far as it takes
+        to keep LOOKAHEAD jobs waiting, so that a slow one (a planner,
+        say) overlaps with the jobs it has already come up with.  Of the
+        jobs waiting for a device, the one with the least priority(job)
+        goes first, or else the first one to arrive.
+        """
+        if priority is None: priority = lambda job: 0
+        source = iter(jobs)
+        queues = collections.OrderedDict() # device -> heap of jobs waiting
+        busy = {}
+        state = { 'order': 0, 'waiting': 0, 'more': True }
+
+        def wait(job, retry=False):
+            # retries go after everything that's waiting now
+            if retry: key = (1, 0, state['order'])
+            else: key = (0, priority(job), state['order'])
+            heapq.heappush(queues.setdefault(job.device, []), key + (job,))
+            busy.setdefault(job.device, 0)
+            state['order'] += 1
+            state['waiting'] += 1
+
+        def pull():
+            try:
+                wait(source.next())
+            except StopIteration:
+                state['more'] = False
+
+        tasks = {} # task -> (job, started, deadline)
+        try:
+            while tasks or state['waiting'] or state['more']:
+                # start what we can, on the device with the least going on
+                while len(tasks) < self._limit():
+                    ready = [ (busy[dev], q[0][:3], dev)
+                              for dev, q in queues.items()
+                              if q and busy[dev] < self.per_device(dev) ]
+                    if not ready:
+                        if not state['more']: break
+                        if state['waiting'] >= LOOKAHEAD: break
+                        pull()
+                        continue
+                    dev = min(ready)[2]
+                    job = heapq.heappop(queues[dev])[-1]
+                    state['waiting'] -= 1
+                    busy[dev] += 1
+                    now = time.time()
+                    tasks[self._begin(job)] = (job, now,
+                                               self._deadline(job, now))
+                # and find out about a few more jobs while those run
+                if state['more'] and state['waiting'] < LOOKAHEAD: pull()
+
+                # wait until some audio can move, or it's time to look in
+                # on the processes
+                owners = {}
+                readers, writers = [], []
+                for task in tasks:
+                    r, w = task.fds()
+                    for fd in r + w: owners[fd] = task
+                    readers.extend(r)
+                    writers.extend(w)
+                try:
+                    readers, writers, x = select.select(readers, writers, [],
+                                                        pipeline.POLL)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR: raise
+                    readers, writers = [], []
+                for fd in readers + writers: owners[fd].ready(fd)
+
+                now = time.time()
+                for task, (job, started, deadline) in tasks.items():
+                    if not task.poll():
+                        if now > deadline:
+                            task.kill('timed out after %s' %
+                                      schedule.format_seconds(now - started))
+                        elif now - task.progress > flaccfg.JOB_STALL_TIMEOUT:
+                            task.kill('no progress for %s' %
+                                      schedule.format_seconds(
+                                        now - task.progress))
+                        else:
+                            continue
+                    del tasks[task]
+                    busy[job.device] -= 1
+                    results = []
+                    for j, err in task.results:
+                        if err and j.failures < self.retries:
+                            # again on its own
+                            j.failures += 1
+                            wait(j, retry=True)
+                            continue
+                        try:
+                            pipeline.finish(j, err)
+                        except OSError, e:
+                            err = e
+                        if err: self.failures.append((j, err))
+                        results.append((j, err))
+                    yield job, results, started, now
+        finally:
+            # ^C, or the caller giving up on us; what was finished can
+            # still be kept, and --resume will find it
+            for task in tasks:
+                task.kill('interrupted')
+                for j, err in task.results:
+                    try:
+                        pipeline.finish(j, err)
+                    except OSError:
+                        pass
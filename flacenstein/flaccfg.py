@@ -17,15 +17,68 @@ DEFAULT_LIBRARY = "~/.flacenstein-library"
 LIST_SELECTED_COLOR = "grey"
 LIST_UNSELECTED_COLOR = "white"
 
-# when thumbnails are extracted from FLAC files for display, they will be
-# stored in this path
-IMAGE_TEMP_PATH = "/tmp/flac"
+# Cover art extracted from FLAC files, for display or for encoders, is
+# kept in this directory between runs, up to this many bytes of it.
+ART_CACHE_PATH = "~/.flacenstein-art"
+ART_CACHE_SIZE = 256 * 1024 * 1024
 MISSING_ART_IMAGE = "~/build/flacenstein/flacenstein/colorfulcd.jpg"
 
+# The audit verb complains about files with less padding than
+# AUDIT_MIN_PADDING bytes, since every tag edit will rewrite the whole
+# file, and about files with seekpoints more than AUDIT_MAX_SEEK_SPACING
+# seconds apart (or none), since decoding a track from the middle of them
+# has to scan from the start.  audit --fix adds AUDIT_PADDING bytes of
+# padding and a seekpoint every AUDIT_SEEK_SPACING seconds.
+AUDIT_MIN_PADDING = 4096
+AUDIT_MAX_SEEK_SPACING = 30
+AUDIT_PADDING = 128 * 1024
+AUDIT_SEEK_SPACING = 10
+
+# A scan writes every change it makes to a journal next to the library
+# file, and folds the journal into the library this often (in changes).
+JOURNAL_CHECKPOINT = 1000
+
 # when transforming (encoding from FLAC to something else), this many
 # processes will be run simultaneously
 DEFAULT_PARALLELISM = 1
 
+# Roughly how many times realtime one encoder (flac decoder included) runs
+# on one CPU, by output type.  Only the ratios matter for the order jobs
+# are run in; the absolute numbers make convert's predicted run time.
+ENCODER_SPEED = { 'mp3': 40.0, 'vorbis': 30.0, 'opus': 60.0, 'aac': 35.0 }
+DEFAULT_ENCODER_SPEED = 30.0
+
+# convert runs no more than this many jobs at once reading from the same
+# filesystem, by mount point; one is usually right for a spinning disk,
+# and a network mount may want more to cover its latency.  convert prints
+# how fast each one was read, to tune these by.
+DEVICE_CONCURRENCY = {}
+DEFAULT_DEVICE_CONCURRENCY = 2
+
+# With -j auto, convert first times each output type's encoder on
+# CALIBRATION_SECONDS of audio, and starts with a job per CPU.  Every
+# AUTO_INTERVAL seconds after that it runs one job more or one fewer at
+# once, keeping on in whichever direction encodes more audio per second,
+# and cuts back whenever more than AUTO_MAX_IOWAIT of the CPUs' time is
+# spent waiting on disks.  It never runs more than AUTO_MAX_JOBS at once
+# for an output type, or AUTO_JOBS_PER_CPU per CPU for one that isn't
+# listed; an encoder that needs a lot of memory, say, might want a limit.
+CALIBRATION_SECONDS = 10
+AUTO_INTERVAL = 15.0
+AUTO_MAX_IOWAIT = 0.25
+AUTO_MAX_JOBS = {}
+AUTO_JOBS_PER_CPU = 2
+
+# convert kills a job that has run JOB_TIMEOUT seconds longer than its
+# audio would take at JOB_MIN_SPEED times realtime, or that hasn't moved
+# any audio (or grown its output) for JOB_STALL_TIMEOUT seconds, since
+# its encoder is probably hung.  A track that fails is tried again, on
+# its own, up to JOB_RETRIES times before it's reported at the end.
+JOB_TIMEOUT = 300
+JOB_MIN_SPEED = 1.0
+JOB_STALL_TIMEOUT = 120
+JOB_RETRIES = 2
+
 # how to execute various needed binaries
 BIN_FLAC = 'flac'
 BIN_METAFLAC = 'metaflac'
@@ -33,6 +86,7 @@ BIN_LAME = 'lame'
 BIN_CDPARANOIA = 'cdparanoia'
 BIN_OGG = 'oggenc'
 BIN_OPUS = 'opusenc'
+BIN_MP4TAGS = 'mp4tags'
 
 # there should be a python module 'xfm%s.py' for each entry here
 XFM_MODS = ('aac', 'vorbis', 'mp3', 'opus')
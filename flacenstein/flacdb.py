@@ -0,0 +1,456 @@
+"""
+SQLite storage for a FLAC library, as an alternative to the pickle save
+file.
+
+The pickle has to be read in full by every flac-cli.py invocation, and
+rewritten in full by every one that changes anything, and two processes
+that do so at the same time silently lose one set of changes.  A store
+is chosen instead of a pickle by giving the library file a name ending
+in .db or .sqlite (or by it already being a SQLite database):
+
+  flac-cli.py -l ~/.flacenstein-library migrate ~/.flacenstein.db
+
+The database runs in WAL mode so that searches can go on while a scan is
+writing.  Only entries that were added, changed, or deleted since they
+were loaded are written back.
+
+The search index is kept in the state table, along with the generation
+of the files table it describes.  The generation goes up with every save
+that changes a file, so an index that somebody else's save has made out
+of date is simply ignored until the next scan rebuilds it.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import hashlib
+import os
+import cPickle as pickle
+import sqlite3
+
+import flaclib
+
+SQLITE_MAGIC = 'SQLite format 3\0'
+STORE_EXTENSIONS = ('.db', '.sqlite')
+
+# seconds to wait for another process to finish writing
+BUSY_TIMEOUT = 600
+MAX_PARAMS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  md5 TEXT PRIMARY KEY,
+  filename TEXT NOT NULL,
+  mtime INTEGER,
+  filesize INTEGER,
+  device INTEGER,
+  inode INTEGER,
+  channels INTEGER,
+  bits_per_sample INTEGER,
+  samples INTEGER,
+  sample_rate INTEGER,
+  artist TEXT,
+  album TEXT,
+  date TEXT,
+  extra BLOB,
+  digest TEXT
+);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+CREATE TABLE IF NOT EXISTS tags (
+  md5 TEXT,
+  name TEXT,
+  value BLOB,
+  PRIMARY KEY (md5, name)
+);
+CREATE TABLE IF NOT EXISTS tracks (
+  md5 TEXT,
+  tracknum INTEGER,
+  title TEXT,
+  PRIMARY KEY (md5, tracknum)
+);
+CREATE TABLE IF NOT EXISTS cuesheet (
+  md5 TEXT,
+  tracknum INTEGER,
+  offset INTEGER,
+  PRIMARY KEY (md5, tracknum)
+);
+CREATE TABLE IF NOT EXISTS state (
+  name TEXT PRIMARY KEY,
+  value BLOB
+);
+"""
+
+# FlacRecord attributes with columns of their own in the files table.  The
+# rest of FlacRecord.STATE, other than the tags and things with tables of
+# their own, is pickled into 'extra'.
+FILE_COLUMNS = ('filename', 'mtime', 'filesize', 'device', 'inode',
+                'channels', 'bits_per_sample', 'samples', 'sample_rate')
+EXTRA = tuple([ name for name in flaclib.FlacRecord.STATE
+                if name not in FILE_COLUMNS and
+                   name not in flaclib.TAG_SLOTS and
+                   name not in ('md5', 'tracks', 'cuesheet', 'rare') ])
+
+class Error(Exception): pass
+
+
+def isStore(f):
+    """True if the library file f is (or is going to be) a SQLite store."""
+    if os.path.exists(f):
+        fd = open(f, 'rb')
+        try:
+            return fd.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+        finally:
+            fd.close()
+    return os.path.splitext(f)[1] in STORE_EXTENSIONS
+
+
+def _blob(x):
+    return sqlite3.Binary(pickle.dumps(x, pickle.HIGHEST_PROTOCOL))
+
+
+def _unblob(x):
+    return pickle.loads(str(x))
+
+
+def _utf8(s):
+    if isinstance(s, unicode): return s.encode('utf8')
+    if s is None: return None
+    return str(s)
+
+
+def _rows(flac):
+    """
+    Turns a FlacRecord (or FlacFile) into the rows that represent it: one
+    for the files table (minus the digest), and lists for tags, tracks, and
+    cuesheet.
+    """
+    extra = [ (name, getattr(flac, name, None)) for name in EXTRA ]
+    files = ((flac.md5,) +
+             tuple([ getattr(flac, c) for c in FILE_COLUMNS ]) +
+             (_utf8(flac.artist), _utf8(flac.album), _utf8(flac.date),
+              extra))
+    tags = sorted(flac.tags.items())
+    tracks = list(enumerate(flac.tracks))
+    cuesheet = list(flac.cuesheet or [])
+    return files, tags, tracks, cuesheet
+
+
+def _digest(rows):
+    return hashlib.md5(repr(rows)).hexdigest()
+
+
+class FlacStore:
+    """A connection to a library database."""
+
+    def __init__(self, path):
+        self.path = path
+        # isolation_level=None lets us issue our own BEGIN/COMMIT
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                  isolation_level=None)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        # md5 -> digest of each entry as it was when we loaded it, so that
+        # save() can tell what changed
+        self.digests = {}
+        self.generation = self.getState('generation', 0)
+
+    def getIndex(self):
+        """Returns the stored SearchIndex, or None if it is out of date."""
+        index, generation = self.getState('searchindex', (None, None))
+        if generation != self.generation: return None
+        return index
+
+    def getState(self, name, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?',
+                              (name,)).fetchone()
+        if row is None: return default
+        return _unblob(row[0])
+
+    def _setState(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state (name, value) '
+                        'VALUES (?, ?)', (name, _blob(value)))
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def loadFlacs(self, md5s=None):
+        """
+        Returns a dictionary of FlacRecords keyed by md5, either for the
+        whole library or for just the listed md5s.
+        """
+        flacs = {}
+        if md5s is None:
+            where, args = '', ()
+        else:
+            md5s = list(md5s)
+            if not md5s: return flacs
+            # SQLite won't take more than 999 parameters in one statement
+            if len(md5s) > MAX_PARAMS:
+                for i in xrange(0, len(md5s), MAX_PARAMS):
+                    flacs.update(self.loadFlacs(md5s[i:i+MAX_PARAMS]))
+                return flacs
+            where = 'WHERE md5 IN (%s)' % ','.join('?' * len(md5s))
+            args = tuple(md5s)
+        cols = ', '.join(FILE_COLUMNS)
+        for row in self.db.execute('SELECT md5, %s, extra FROM files %s' %
+                                   (cols, where), args):
+            flac = flaclib.FlacRecord()
+            for name, value in _unblob(row[-1]).items():
+                if name in EXTRA: setattr(flac, name, value)
+            flac.md5 = row[0]
+            for c, v in zip(FILE_COLUMNS, row[1:-1]):
+                setattr(flac, c, v)
+            flacs[flac.md5] = flac
+        # tags, tracks, and cuesheets come back in one query each
+        for table, cols in (('tags', 'name, value'),
+                            ('tracks', 'tracknum, title'),
+                            ('cuesheet', 'tracknum, offset')):
+            for row in self.db.execute('SELECT md5, %s FROM %s %s '
+                                       'ORDER BY md5, %s' %
+                                       (cols, table, where,
+                                        cols.split(',')[0]), args):
+                flac = flacs.get(row[0])
+                if flac is None: continue
+                if table == 'tags':
+                    flac.tags[row[1]] = _unblob(row[2])
+                elif table == 'tracks':
+                    flac.tracks.append(unicode(row[2], 'utf8'))
+                else:
+                    if flac.cuesheet is None: flac.cuesheet = []
+                    flac.cuesheet.append((row[1], row[2]))
+        for md5, flac in flacs.items():
+            self.digests[md5] = _digest(_rows(flac))
+        return flacs
+
+    def _names(self, md5s):
+        """Yields (md5, filename, artist, album) for the listed md5s."""
+        md5s = list(md5s)
+        for i in xrange(0, len(md5s), MAX_PARAMS):
+            chunk = md5s[i:i+MAX_PARAMS]
+            for row in self.db.execute('SELECT md5, filename, artist, album '
+                                       'FROM files WHERE md5 IN (%s)' %
+                                       ','.join('?' * len(chunk)), chunk):
+                yield row
+
+    def match(self, regex, md5s=None):
+        """
+        Same as FlacLibrary.match(), but only the filename, artist, and
+        album columns are read until we know which entries matched.  If
+        md5s is given, only those entries are considered.
+        """
+        hits = []
+        if md5s is None:
+            rows = self.db.execute('SELECT md5, filename, artist, album '
+                                   'FROM files')
+        else:
+            rows = self._names(md5s)
+        for md5, filename, artist, album in rows:
+            if (regex.search(filename) or
+                regex.search(unicode(artist or '', 'utf8')) or
+                regex.search(unicode(album or '', 'utf8'))):
+                hits.append(md5)
+        return self.loadFlacs(hits).values()
+
+    def matchTracks(self, regex):
+        """Same as FlacLibrary.matchTracks(), reading only the titles."""
+        hits = set()
+        for md5, title in self.db.execute('SELECT md5, title FROM tracks'):
+            if regex.search(unicode(title or '', 'utf8')): hits.add(md5)
+        tracks = []
+        for flac in self.loadFlacs(hits).values():
+            tracks.extend([ t for t in flac.getTracks()
+                            if regex.search(t.title or '') ])
+        return tracks
+
+    def latest(self, n):
+        md5s = [ row[0] for row in
+                 self.db.execute('SELECT md5 FROM files ORDER BY mtime DESC '
+                                 'LIMIT ?', (n,)) ]
+        flacs = self.loadFlacs(md5s)
+        return [ flacs[md5] for md5 in md5s ]
+
+    def _put(self, flac, rows, digest):
+        files, tags, tracks, cuesheet = rows
+        md5 = flac.md5
+        for table in ('tags', 'tracks', 'cuesheet'):
+            self.db.execute('DELETE FROM %s WHERE md5 = ?' % table, (md5,))
+        self.db.execute('INSERT OR REPLACE INTO files (md5, %s, artist, '
+                        'album, date, extra, digest) VALUES (%s)' %
+                        (', '.join(FILE_COLUMNS),
+                         ','.join('?' * (len(FILE_COLUMNS) + 6))),
+                        files[:-1] + (_blob(dict(files[-1])), digest))
+        self.db.executemany('INSERT INTO tags (md5, name, value) '
+                            'VALUES (?, ?, ?)',
+                            [ (md5, k, _blob(v)) for k, v in tags ])
+        self.db.executemany('INSERT INTO tracks (md5, tracknum, title) '
+                            'VALUES (?, ?, ?)',
+                            [ (md5, n, _utf8(t)) for n, t in tracks ])
+        self.db.executemany('INSERT INTO cuesheet (md5, tracknum, offset) '
+                            'VALUES (?, ?, ?)',
+                            [ (md5, n, o) for n, o in cuesheet ])
+
+    def _delete(self, md5):
+        for table in ('files', 'tags', 'tracks', 'cuesheet'):
+            self.db.execute('DELETE FROM %s WHERE md5 = ?' % table, (md5,))
+
+    def save(self, flacs, complete, state, index=None):
+        """
+        Writes back the FlacFiles in the dictionary flacs that differ from
+        what we loaded.  If complete is true, flacs is the whole library,
+        and loaded entries missing from it are deleted.  state is a
+        dictionary of other things to keep, like prefs.
+
+        index is the library's SearchIndex, if it has one.  When complete
+        is true it should already describe flacs; otherwise the entries
+        written are added to it here.
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # if somebody else saved since we opened the store, neither our
+            # index nor theirs knows about everything any more
+            generation = self.getState('generation', 0)
+            if generation != self.generation: index = None
+            digests = {}
+            written = False
+            for md5, flac in flacs.items():
+                rows = _rows(flac)
+                digest = _digest(rows)
+                if self.digests.get(md5) != digest:
+                    self._put(flac, rows, digest)
+                    if index is not None and not complete: index.add(flac)
+                    written = True
+                digests[md5] = digest
+            if complete:
+                for md5 in self.digests:
+                    if md5 not in flacs:
+                        self._delete(md5)
+                        written = True
+            if written:
+                generation += 1
+                self._setState('generation', generation)
+            for name, value in state.items():
+                self._setState(name, value)
+            if index is not None and (written or index.dirty):
+                index.dirty = False
+                self._setState('searchindex', (index, generation))
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        self.generation = generation
+        if complete: self.digests = digests
+        else: self.digests.update(digests)
+
+    def close(self):
+        self.db.close()
+
+
+class StoredLibrary(flaclib.FlacLibrary):
+    """
+    A FlacLibrary that lives in a FlacStore.  self.flacs isn't read from
+    the database until something asks for it, and match(), matchTracks(),
+    get(), latest() and count() get by without it.
+    """
+
+    def __init__(self, store):
+        flaclib.FlacLibrary.__init__(self, store.getState('rootpaths', []))
+        del self.flacs
+        del self.index
+        self.store = store
+        self.dirsnaps = store.getState('dirsnaps', {})
+        # entries that were loaded one by one, before self.flacs was
+        self.partial = {}
+
+    def __getattr__(self, name):
+        if name == 'flacs':
+            self.flacs = self.store.loadFlacs()
+            self.flacs.update([ (md5, flac) for md5, flac
+                                in self.partial.items() if md5 in self.flacs ])
+            self.partial = {}
+            return self.flacs
+        if name == 'index':
+            self.index = self.store.getIndex()
+            return self.index
+        raise AttributeError("'StoredLibrary' object has no attribute '%s'" %
+                             name)
+
+    def _loaded(self):
+        return 'flacs' in self.__dict__
+
+    def _keep(self, flacs):
+        for flac in flacs: self.partial[flac.md5] = flac
+        return flacs
+
+    def count(self):
+        if self._loaded(): return flaclib.FlacLibrary.count(self)
+        return self.store.count()
+
+    def match(self, regex):
+        if self._loaded(): return flaclib.FlacLibrary.match(self, regex)
+        md5s = None
+        if self.index is not None: md5s = self.index.candidates(regex.pattern)
+        return self._keep(self.store.match(regex, md5s))
+
+    def get(self, md5):
+        if self._loaded(): return flaclib.FlacLibrary.get(self, md5)
+        if md5 not in self.partial:
+            self._keep(self.store.loadFlacs([md5]).values())
+        return self.partial.get(md5)
+
+    def put(self, flac):
+        if self._loaded(): return flaclib.FlacLibrary.put(self, flac)
+        # the index catches up with partial entries when they're saved
+        if not isinstance(flac, flaclib.FlacRecord):
+            flac = flaclib.FlacRecord(flac)
+        self.partial[flac.md5] = flac
+
+    def matchTracks(self, regex):
+        if self._loaded() or self.index is not None:
+            return flaclib.FlacLibrary.matchTracks(self, regex)
+        return self.store.matchTracks(regex)
+
+    def latest(self, n):
+        if self._loaded(): return flaclib.FlacLibrary.latest(self, n)
+        return self._keep(self.store.latest(n))
+
+    def save(self, prefs):
+        state = { 'rootpaths': self.rootpaths,
+                  'dirsnaps': getattr(self, 'dirsnaps', {}),
+                  'prefs': prefs }
+        if self._loaded():
+            self.store.save(self.flacs, True, state, self.index)
+        else:
+            self.store.save(self.partial, False, state, self.index)
+
+
+def loadStore(f):
+    """Returns (library, prefs) from the store at f, like loadSavefile()."""
+    store = FlacStore(f)
+    return StoredLibrary(store), store.getState('prefs', {})
+
+
+def writeStore(f, lib, prefs):
+    """
+    Saves lib and prefs to the store at f, like writeSavefile().  lib does
+    not have to have come from f; saving a pickled library to a new store
+    is how a library is migrated.
+    """
+    if isinstance(lib, StoredLibrary) and lib.store.path == f:
+        lib.save(prefs)
+        return
+    store = FlacStore(f)
+    try:
+        # everything in the store that isn't in lib has to go
+        store.digests = dict([ (row[0], row[1]) for row in
+                               store.db.execute('SELECT md5, digest '
+                                                'FROM files') ])
+        index = getattr(lib, 'index', None)
+        if index is not None: index.dirty = True
+        store.save(lib.flacs, True,
+                   { 'rootpaths': lib.rootpaths,
+                     'dirsnaps': getattr(lib, 'dirsnaps', {}),
+                     'prefs': prefs }, index)
+    finally:
+        store.close()
@@ -6,60 +6,58 @@ Copyright (C) 2005 Michael A. Dickerson.  Modification and
 redistribution are permitted under the terms of the GNU General Public
 License, version 2.
 """
+import collections
+import fcntl
+import hashlib
+import itertools
 import os
-import pickle
+import cPickle as pickle
+import Queue
 import re
 import stat
 import subprocess
 import sys
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
+import artcache
 import flaccfg
+import flacmeta
+import searchindex
 
 CD_SAMPLES_PER_FRAME = 588 # 44100 samples/sec / 75 frames/sec
 
+# Waiting on a threading.Condition without a timeout can't be interrupted
+# by ^C in Python 2, so we wait "forever" this many seconds instead.
+FOREVER = 86400 * 365
+
 SIMPLE_TAGS = ['ARTIST', 'ALBUM', 'DATE', 'GENRE', 'ARCHIVE',
                'TRACKNUM', 'RIPSTATUS']
+# FlacRecord keeps each of SIMPLE_TAGS in a slot named for it in lower case
+TAG_SLOTS = tuple([ tag.lower() for tag in SIMPLE_TAGS ])
+_TAG_SLOT = dict(zip(SIMPLE_TAGS, TAG_SLOTS))
+# tags whose values are shared by many files, and worth interning
+INTERNED_TAGS = ('ARTIST', 'ALBUM', 'DATE', 'GENRE')
+
+# One track of a FLAC file: the file's md5, the 1-based track number, the
+# title, and the sample the track starts at and the one after it ends, if
+# the file has a cuesheet to say.  md5#tracknum is its address.
+Track = collections.namedtuple('Track', 'md5 tracknum title start end')
 
 class Error(Exception): pass
 class MetaflacFailed(Error): pass
 class BadMetadata(Error): pass
 class TrackNumOutOfRange(Error): pass
+class JournalBusy(Error): pass
 
-class FlacFile:
+class _FlacBase(object):
     """
-    A class representing a single FLAC file, which may represent zero or
-    more tracks.  Tracks are the atoms that will be encoded in destination
-    formats that assume one song per file (e.g. mp3, m4a, basically everything
-    except FLAC.)
+    What FlacFile and FlacRecord have in common: everything that works
+    on a file by way of its filename, tags, and tracks attributes.
     """
-    
-    def __init__(self, fname):
-      # We fake the appearance of attributes like self.artist by keeping
-      # them in self.tags and implementing __getattr__() and __setattr__().
-      # Beware that if you assign to anything else before self.tags, you will
-      # create infinite recursion in __getattr__ and crash.
-      self.tags = {}
-      for tag in SIMPLE_TAGS: self.tags[tag] = None
-
-      # initialize everything so that we don't die with attribute not
-      # found errors
-      self.filename = fname
 
-      self.tracks = []
-      self.md5 = None
-      self.selected = False
-      self.length = 0
-      self.coverart = ''
-      self.archive = ''
-      self.channels = None
-      self.bits_per_sample = None
-      self.samples = None
-      self.sample_rate = None
-      self.mtime = None
-      self.filesize = None
-
-      if fname is not None and os.path.exists(fname): self.getMetadata()
+    __slots__ = ()
 
     def _flac_cmd(self, flag, stdin=None):
       cmd = [flaccfg.BIN_METAFLAC, '--%s' % flag, '--', self.filename]
@@ -78,42 +76,35 @@ class FlacFile:
       if stdout: return stdout.split('\n')
       return None
 
-    def getMetadata(self):
-      for l in self._flac_cmd('list'):
-        tokens = l.split(':', 1)
-        if len(tokens) == 1:
-          field, arg = tokens[0].strip(), None
-        else:
-          field, arg = [ x.strip() for x in tokens ]
-        if field == 'channels': self.channels = int(arg)
-        elif field == 'bits-per-sample': self.bits_per_sample = int(arg)
-        elif field == 'total samples': self.samples = int(arg)
-        elif field == 'MD5 signature': self.md5 = arg
-        elif field == 'sample_rate': self.sample_rate = int(arg.split()[0])
-        elif field.startswith('comment['):
-          c, arg = [ x.strip() for x in arg.split('=', 1) ]
-          # A few tags have been discovered to need special handling over
-          # time.  Everything else gets dumped in self.tags untouched.
-          if c in ('ARTIST', 'ALBUM', 'ARCHIVE'):
-            self.tags[c] = unicode(arg, 'utf8')
-          elif c.startswith('TITLE'): self.tracks.append(unicode(arg, 'utf8'))
-          elif c == 'TRACKNUM': self.tags[c] = int(arg)
-          # save random crap we don't parse in self.tags
-          else: self.tags[c] = arg
-      st = os.stat(self.filename)
+    def setStat(self, st):
+      """Records the parts of os.stat() that scan() uses to spot changes."""
       self.mtime = st[stat.ST_MTIME]
       self.filesize = st[stat.ST_SIZE]
+      self.device = st[stat.ST_DEV]
+      self.inode = st[stat.ST_INO]
 
     def getFrames(self):
       return self.samples / CD_SAMPLES_PER_FRAME
 
-    def saveTags(self, preserve_mtime=False):
-      # Record mtime before we mess with the file, because sometimes we
-      # are going to want to set it back to what it was.
-      if preserve_mtime:
-        st = os.stat(self.filename)
-        utime = (st[stat.ST_ATIME], st[stat.ST_MTIME])
+    def getTracks(self):
+      """Returns a Track for each entry in self.tracks."""
+      # cuesheet is (tracknum, offset) pairs, ending with the lead-out, so
+      # every track ends where the next one in the list starts
+      bounds = {}
+      cuesheet = self.cuesheet or []
+      for i in xrange(len(cuesheet) - 1):
+        bounds[cuesheet[i][0]] = (cuesheet[i][1], cuesheet[i+1][1])
+      # one track and no cuesheet: the track is the whole file
+      if not cuesheet and len(self.tracks) == 1 and self.samples:
+        bounds[1] = (0, self.samples)
+      return [ Track(self.md5, n, title, *bounds.get(n, (None, None)))
+               for n, title in enumerate(self.tracks, 1) ]
 
+    def canonicalComments(self):
+      """
+      Returns our tags and titles as the list of 'NAME=value' comments
+      (in UTF-8) that saveTags() would write.
+      """
       tag_names = self.tags.keys()
       # TITLE is the only place where we preserve order, so its behavior is
       # different.  self.tags['TITLE'] should not be set, and only self.tracks
@@ -139,26 +130,84 @@ class FlacFile:
             if self.tags[name] ] # Drop tags with '' or None values
       for i in xrange(len(self.tracks)):
         t.append('TITLE[%d]=%s' % (i + 1, self.tracks[i]))
-      self._flac_cmd('remove-all-tags')
-      self._flac_cmd('import-tags-from=-', 
-                     stdin='\n'.join(t).encode('utf8'))
+      return [ isinstance(c, unicode) and c.encode('utf8') or c for c in t ]
+
+    def commentsChanged(self):
+      """
+      True if saveTags() would change the comments in the file.  This only
+      reads the file if we don't know what was in it at the last scan.
+      """
+      digest = self.comment_digest
+      if digest is None:
+        try:
+          digest = flacmeta.commentDigest(
+            flacmeta.readMetadata(self.filename).comments or [])
+        except (flacmeta.Error, IOError):
+          return True
+      return digest != flacmeta.commentDigest(self.canonicalComments())
+
+    def saveTags(self, preserve_mtime=False):
+      """
+      Writes our tags to the file, replacing whatever was there.  Returns
+      how it was done: 'inplace' if the new tags fit in the old ones' space
+      plus the padding, 'rewrite' if the whole file had to be copied, or
+      'metaflac' if the native writer couldn't cope and metaflac did it.
+      """
+      # Record mtime before we mess with the file, because sometimes we
+      # are going to want to set it back to what it was.
+      if preserve_mtime:
+        st = os.stat(self.filename)
+        utime = (st[stat.ST_ATIME], st[stat.ST_MTIME])
+
+      comments = self.canonicalComments()
+      try:
+        how = flacmeta.writeComments(self.filename, comments)
+      except flacmeta.Error:
+        self._flac_cmd('remove-all-tags')
+        self._flac_cmd('import-tags-from=-', stdin='\n'.join(comments))
+        how = 'metaflac'
 
       if preserve_mtime: os.utime(self.filename, utime)
+      self.comment_digest = flacmeta.commentDigest(comments)
+      return how
 
-    def __getattr__(self, name):
-      # If you ask for anything like self.artist that isn't a real attribute,
-      # look in the self.tags dict for something called 'ARTIST'.
-      if 'tags' in self.__dict__ and name.upper() in self.tags:
-        return self.tags[name.upper()]
-      else:
-        raise AttributeError, "'FlacFile' object has no attribute '%s'" % name
+    def layoutProblems(self):
+      """
+      Returns a list of what is wrong with the layout of the file, going by
+      the padding and seekpoints the last scan found: 'padding' if there is
+      too little padding to edit tags in place, and 'seektable' if the
+      seekpoints are too far apart.  If the last scan didn't record them,
+      the file is read to find out.
+      """
+      if self.padding is None or self.seekpoints is None:
+        try:
+          md = flacmeta.readMetadata(self.filename)
+        except (flacmeta.Error, IOError), e:
+          raise BadMetadata('%s: %s' % (self.filename, e))
+        self.padding, self.seekpoints = md.padding, md.seekpoints
+      problems = []
+      if self.padding < flaccfg.AUDIT_MIN_PADDING: problems.append('padding')
+      seconds = float(self.samples or 0) / (self.sample_rate or 1)
+      if seconds > self.seekpoints * flaccfg.AUDIT_MAX_SEEK_SPACING:
+        problems.append('seektable')
+      return problems
 
-    def __setattr__(self, name, val):
-      # Intercept attempts to set e.g. self.artist which are really tags.
-      if 'tags' in self.__dict__ and name.upper() in self.tags:
-        self.tags[name.upper()] = val
-      else:
-        self.__dict__[name] = val  
+    def fixLayout(self, problems):
+      """
+      Fixes the problems layoutProblems() found, with a single metaflac
+      run that leaves the mtime alone.
+      """
+      cmd = [flaccfg.BIN_METAFLAC, '--preserve-modtime']
+      if 'seektable' in problems:
+        cmd.append('--add-seekpoint=%ds' % flaccfg.AUDIT_SEEK_SPACING)
+      if 'padding' in problems:
+        cmd.append('--add-padding=%d' % flaccfg.AUDIT_PADDING)
+      cmd.extend(['--', self.filename])
+      ret = subprocess.call(cmd)
+      if ret: raise MetaflacFailed('%s returned %s' % (cmd, ret))
+      md = flacmeta.readMetadata(self.filename)
+      self.padding, self.seekpoints = md.padding, md.seekpoints
+      self.setStat(os.stat(self.filename))
 
     def saveCuesheet(self, cuesheet):
       self._flac_cmd('import-cuesheet-from=-', stdin=cuesheet)
@@ -173,44 +222,280 @@ class FlacFile:
         s += self.tracks.__str__()
         return s
 
-    def extractThumbnail(self, path):
-        # if we've already extracted a thumbnail, return its filename
-        if self.coverart and os.path.isfile(self.coverart):
-            return self.coverart
-        
-        # create the output path if it doesn't exist.  Don't bother checking
-        # first because it's a race with other worker threads.
-        try:
-          os.makedirs(path)
-        except OSError, e:
-          pass
-
-        fd, self.coverart = tempfile.mkstemp('.jpg', "thumb", path)
-        os.close(fd) # Race condition, I know, big deal.
-        
-        try:
-            self._flac_cmd('export-picture-to=%s' % self.coverart)
-        except MetaflacFailed:
-            os.unlink(self.coverart)
-            self.coverart = None
-            
+    def extractThumbnail(self, cache=None):
+        """
+        Returns the filename of our cover art in the art cache (by default
+        the one shared by everybody), or None if we don't have any.
+        """
+        if cache is None: cache = artcache.defaultCache()
+        self.coverart = cache.lookup(self)
         return self.coverart
 
+    def trackRange(self, tracknum):
+      """
+      Returns (start, end, samples) for the 0-based track tracknum: the
+      samples to decode, where end is None if the track runs to the end of
+      the file, and its length.  All three are None if we don't know.
+      """
+      if tracknum >= len(self.tracks) or tracknum < 0:
+        raise TrackNumOutOfRange
+      t = self.getTracks()[tracknum]
+      if t.start is None: return None, None, None
+      end = t.end
+      if self.samples and end >= self.samples: end = None
+      return t.start, end, t.end - t.start
+
     def extractTrack(self, tracknum, outfile=None):
       if tracknum >= len(self.tracks) or tracknum < 0:
         print self.tracks
         raise TrackNumOutOfRange
       if not outfile:
         outfile = filequote('%s - %s.wav' % (self.artist, self.tracks[tracknum]))
-      cmd = ['flac',
-             '-d',
-             '--cue=%d.1-%d.1' % (tracknum+1, tracknum+2),
-             '-o',
-             outfile,
-             self.filename]
+      start, end, samples = self.trackRange(tracknum)
+      cmd = ['flac', '-d'] + decode_range(tracknum + 1, start, end) + \
+            ['-o', outfile, self.filename]
       subprocess.check_call(cmd)
 
     
+
+
+class FlacFile(_FlacBase):
+    """
+    A class representing a single FLAC file, which may represent zero or
+    more tracks.  Tracks are the atoms that will be encoded in destination
+    formats that assume one song per file (e.g. mp3, m4a, basically everything
+    except FLAC.)
+    """
+
+    # Libraries pickled before these attributes existed find them here.
+    device = None
+    inode = None
+    cuesheet = None
+    comment_digest = None
+    padding = None
+    seekpoints = None
+    
+    def __init__(self, fname=None):
+      # We fake the appearance of attributes like self.artist by keeping
+      # them in self.tags and implementing __getattr__() and __setattr__().
+      # Beware that if you assign to anything else before self.tags, you will
+      # create infinite recursion in __getattr__ and crash.
+      self.tags = {}
+      for tag in SIMPLE_TAGS: self.tags[tag] = None
+
+      # initialize everything so that we don't die with attribute not
+      # found errors
+      self.filename = fname
+
+      self.tracks = []
+      self.md5 = None
+      self.selected = False
+      self.length = 0
+      self.coverart = ''
+      self.archive = ''
+      self.channels = None
+      self.bits_per_sample = None
+      self.samples = None
+      self.sample_rate = None
+      self.mtime = None
+      self.filesize = None
+      self.device = None
+      self.inode = None
+      # list of (track number, sample offset of INDEX 01), including the
+      # lead-out, or None if we don't know
+      self.cuesheet = None
+      # flacmeta.commentDigest() of the comments in the file, or None
+      self.comment_digest = None
+      # bytes of PADDING, and real (not placeholder) seekpoints
+      self.padding = None
+      self.seekpoints = None
+
+      if fname is not None and os.path.exists(fname): self.getMetadata()
+
+    def getMetadata(self):
+      # Reading the metadata blocks ourselves is much cheaper than forking
+      # metaflac, but metaflac is still the authority on anything odd.
+      try:
+        self._readNative()
+      except (flacmeta.Error, IOError):
+        self._readMetaflac()
+      self.setStat(os.stat(self.filename))
+
+    def _readNative(self):
+      md = flacmeta.readMetadata(self.filename)
+      # Nothing is assigned until the whole file has parsed, so that a
+      # fallback to metaflac starts from a clean slate.
+      self.channels = md.channels
+      self.bits_per_sample = md.bits_per_sample
+      self.samples = md.samples
+      self.md5 = md.md5
+      self.sample_rate = md.sample_rate
+      self.padding = md.padding
+      self.seekpoints = md.seekpoints
+      if md.cuetracks is not None:
+        self.cuesheet = [ (t.number, t.offset + dict(t.indices).get(1, 0))
+                          for t in md.cuetracks ]
+      self.comment_digest = flacmeta.commentDigest(md.comments or [])
+      for comment in md.comments or []:
+        if '=' not in comment: continue
+        c, arg = [ x.strip() for x in comment.split('=', 1) ]
+        self._addComment(c, arg)
+
+    def _readMetaflac(self):
+      for l in self._flac_cmd('list'):
+        tokens = l.split(':', 1)
+        if len(tokens) == 1:
+          field, arg = tokens[0].strip(), None
+        else:
+          field, arg = [ x.strip() for x in tokens ]
+        if field == 'channels': self.channels = int(arg)
+        elif field == 'bits-per-sample': self.bits_per_sample = int(arg)
+        elif field == 'total samples': self.samples = int(arg)
+        elif field == 'MD5 signature': self.md5 = arg
+        elif field == 'sample_rate': self.sample_rate = int(arg.split()[0])
+        elif field.startswith('comment['):
+          c, arg = [ x.strip() for x in arg.split('=', 1) ]
+          self._addComment(c, arg)
+
+    def _addComment(self, c, arg):
+      # A few tags have been discovered to need special handling over
+      # time.  Everything else gets dumped in self.tags untouched.
+      if c in ('ARTIST', 'ALBUM', 'ARCHIVE'):
+        self.tags[c] = unicode(arg, 'utf8')
+      elif c.startswith('TITLE'): self.tracks.append(unicode(arg, 'utf8'))
+      elif c == 'TRACKNUM': self.tags[c] = int(arg)
+      # save random crap we don't parse in self.tags
+      else: self.tags[c] = arg
+
+    def __getattr__(self, name):
+      # If you ask for anything like self.artist that isn't a real attribute,
+      # look in the self.tags dict for something called 'ARTIST'.
+      if 'tags' in self.__dict__ and name.upper() in self.tags:
+        return self.tags[name.upper()]
+      else:
+        raise AttributeError, "'FlacFile' object has no attribute '%s'" % name
+
+    def __setattr__(self, name, val):
+      # Intercept attempts to set e.g. self.artist which are really tags.
+      if 'tags' in self.__dict__ and name.upper() in self.tags:
+        self.tags[name.upper()] = val
+      else:
+        self.__dict__[name] = val  
+
+
+class FlacRecord(_FlacBase):
+    """
+    The compact form of a FlacFile that a FlacLibrary keeps for each entry.
+    The tags every file has get a slot each instead of a dictionary entry,
+    and the rest go in self.rare, which is None for most files.  Artist,
+    album, and tag name strings are interned, so that an artist with 50
+    albums is only stored once, in memory and in a pickle.
+
+    It looks like a FlacFile from the outside: flac.artist, flac.tags[...],
+    and flac.tracks all work, except that deleting one of the SIMPLE_TAGS
+    from self.tags just sets it to None.
+    """
+
+    # Pickles store these in this order, so only ever add to the end.
+    STATE = ('filename', 'md5', 'mtime', 'filesize', 'device', 'inode',
+             'channels', 'bits_per_sample', 'samples', 'sample_rate',
+             'tracks', 'cuesheet', 'selected', 'length', 'coverart',
+             'rare') + TAG_SLOTS + ('comment_digest', 'padding', 'seekpoints')
+    __slots__ = STATE + ('verified', 'listindex')
+
+    def __init__(self, flac=None):
+      for name in self.STATE: setattr(self, name, None)
+      self.tracks = []
+      self.selected = False
+      self.length = 0
+      self.coverart = ''
+      if flac is None: return
+      for name in self.STATE:
+        if name != 'rare' and name not in TAG_SLOTS:
+          setattr(self, name, getattr(flac, name, None))
+      tags = self.tags
+      for name, value in flac.tags.items(): tags[name] = value
+
+    def _getTags(self):
+      return _TagView(self)
+
+    def _setTags(self, tags):
+      for name in SIMPLE_TAGS: setattr(self, name.lower(), None)
+      self.rare = None
+      view = self.tags
+      for name, value in tags.items(): view[name] = value
+
+    tags = property(_getTags, _setTags)
+
+    def __getattr__(self, name):
+      # Only called when there's no slot by this name (or it is unset), so
+      # the only thing left to look for is a rare tag.
+      rare = _FlacBase.__getattribute__(self, 'rare')
+      if rare and name.upper() in rare: return rare[name.upper()]
+      raise AttributeError("'FlacRecord' object has no attribute '%s'" % name)
+
+    def __getstate__(self):
+      return tuple([ getattr(self, name, None) for name in self.STATE ])
+
+    def __setstate__(self, state):
+      self.__init__()
+      for name, value in zip(self.STATE, state): setattr(self, name, value)
+
+
+class _TagView(collections.MutableMapping):
+    """What FlacRecord.tags returns: a dictionary made of a record's slots."""
+
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+      self.record = record
+
+    def __getitem__(self, name):
+      slot = _TAG_SLOT.get(name)
+      if slot: return getattr(self.record, slot)
+      rare = self.record.rare
+      if rare is None: raise KeyError(name)
+      return rare[name]
+
+    def __setitem__(self, name, value):
+      if name in INTERNED_TAGS: value = intern_string(value)
+      slot = _TAG_SLOT.get(name)
+      if slot:
+        setattr(self.record, slot, value)
+        return
+      if self.record.rare is None: self.record.rare = {}
+      self.record.rare[intern_string(name)] = value
+
+    def __delitem__(self, name):
+      slot = _TAG_SLOT.get(name)
+      if slot:
+        setattr(self.record, slot, None)
+        return
+      rare = self.record.rare
+      if rare is None: raise KeyError(name)
+      del rare[name]
+      if not rare: self.record.rare = None
+
+    def __iter__(self):
+      for name in SIMPLE_TAGS: yield name
+      for name in self.record.rare or (): yield name
+
+    def __len__(self):
+      return len(SIMPLE_TAGS) + len(self.record.rare or ())
+
+
+_strings = {}
+
+def intern_string(s):
+    """
+    Like intern(), but for unicode strings too.  Returns a string equal to
+    s, which is the same object for every equal s.
+    """
+    if type(s) is str: return intern(s)
+    if type(s) is not unicode: return s
+    return _strings.setdefault(s, s)
+
+
 class FlacLibrary:
     """
     A class representing a complete FLAC library, which is mostly a
@@ -221,79 +506,479 @@ class FlacLibrary:
         assert type(rootpaths) == type([]) # look out for strings
         self.rootpaths = rootpaths[:]
         self.flacs = { }
+        # a searchindex.SearchIndex, built by the first scan()
+        self.index = None
         
     def addpath(self, newpath):
         self.rootpaths.append(newpath)
 
     def clearpaths(self):
         self.rootpaths = []
+
+    def count(self):
+        return len(self.flacs)
+
+    def get(self, md5):
+        """Returns the entry with the given md5, or None."""
+        return self.flacs.get(md5)
+
+    def put(self, flac):
+        """Adds or replaces an entry, keeping the search index up to date."""
+        if not isinstance(flac, FlacRecord): flac = FlacRecord(flac)
+        self.flacs[flac.md5] = flac
+        self._indexPut(flac)
+
+    def match(self, regex):
+        """
+        Returns a list of the entries whose filename, artist, or album
+        matches the compiled regex.  If there is a search index, the regex
+        is only tried on the entries the index can't rule out.
+        """
+        flacs = self.flacs
+        md5s = None
+        index = getattr(self, 'index', None)
+        if index is not None: md5s = index.candidates(regex.pattern)
+        if md5s is None: candidates = flacs.values()
+        else: candidates = [ flacs[md5] for md5 in md5s if md5 in flacs ]
+        return [ flac for flac in candidates
+                 if (regex.search(flac.filename) or
+                     regex.search(flac.artist or "") or
+                     regex.search(flac.album or "")) ]
+
+    def matchTracks(self, regex):
+        """Returns a Track for every track whose title matches regex."""
+        index = getattr(self, 'index', None)
+        if index is not None:
+          tracks = index.trackCandidates(regex.pattern)
+        else:
+          tracks = itertools.chain(*[ flac.getTracks()
+                                      for flac in self.flacs.values() ])
+        return [ t for t in tracks if regex.search(t.title or '') ]
+
+    def _indexPut(self, flac):
+        index = getattr(self, 'index', None)
+        if index is not None: index.add(flac)
+
+    def _indexDelete(self, md5):
+        index = getattr(self, 'index', None)
+        if index is not None: index.remove(md5)
+
+    def latest(self, n):
+        """Returns the n entries with the most recent modification times."""
+        flacs = self.flacs.values()
+        flacs.sort(key=lambda f: f.mtime, reverse=True)
+        return flacs[:n]
         
-    def scan(self, stdout=sys.stdout):
-        changed = False
+    def scan(self, stdout=sys.stdout, threads=1, paranoid=False,
+             match_md5=True, journal=None):
+        """
+        Brings the library up to date with the filesystem.  Walking the
+        directories happens in this thread, while the metadata of new or
+        changed files is read by a pool of `threads` workers.  Results are
+        merged in the order the walk found them, so the output is the same
+        no matter how many threads there are.
+
+        Directories that look exactly like they did at the last scan have
+        their files marked verified without a stat() of each one.  Files
+        that were rewritten in place don't change their directory, so
+        paranoid=True is there to check every file anyway.
+
+        A file that turns up at a new path with the same device, inode,
+        size, and mtime as an entry whose old path is gone has been moved,
+        and the entry is re-pointed without reading it again.  With
+        match_md5, a file with the same size, mtime, and STREAMINFO md5 as
+        a vanished entry counts as moved too, which catches moves between
+        filesystems.
+
+        If journal is a ScanJournal, every change is written to it as soon
+        as it is made.
+
+        The search index is kept up to date along the way, and built from
+        scratch if the library doesn't have one yet.
+        """
+        changed = converted = False
         fname_index = {}
+        dir_index = {}
+        identity_index = {}
         # clear a flag in each flac entry, so that we can iterate them
         # after we are done scanning and identify any that were not
         # hit (mark and sweep)
-        for flac in self.flacs.values():
+        for md5, flac in self.flacs.items():
+          # entries from libraries saved before FlacRecord existed
+          if not isinstance(flac, FlacRecord):
+            flac = self.flacs[md5] = FlacRecord(flac)
+            converted = True
           flac.verified = False
-          fname_index[flac.filename] = flac.md5
+          fname_index[flac.filename] = flac
+          dir_index.setdefault(os.path.dirname(flac.filename), []).append(flac)
+          if flac.inode is not None:
+            identity_index[(flac.device, flac.inode, flac.filesize,
+                            flac.mtime)] = flac
+        # Snapshots are only replaced once the scan is complete, so that an
+        # interrupted scan can't leave behind a snapshot for a directory
+        # whose files were never looked at.
+        walk = _Walk(fname_index, dir_index, getattr(self, 'dirsnaps', {}),
+                     paranoid, identity_index, match_md5 and self.flacs)
         # scan each of our possibly many root paths
-        for path in self.rootpaths:
-            changed |= self._scanpath(path, stdout, fname_index)
+        candidates = itertools.chain(*[ walk.walk(path)
+                                        for path in self.rootpaths ])
+        for fname, flac, st in parallel_imap(_readFlac, candidates, threads):
+            if self._merge(fname, flac, st, stdout):
+              if journal: journal.put(self.flacs[flac.md5])
+              changed = True
         # delete any entries that didn't turn up in the scan
         for k in self.flacs.keys():
             if not self.flacs[k].verified:
                 stdout.write('deleted: %s\n' % \
                              self.flacs[k].filename)
                 del self.flacs[k]
+                self._indexDelete(k)
+                if journal: journal.delete(k)
                 changed = True
             else:
                 del self.flacs[k].verified
         stdout.write('Done: %d FLAC files.' % len(self.flacs.keys()))
         if not changed: stdout.write(' (No changes)')
         stdout.write('\n')
-        return changed
-                
-    def _scanpath(self, path, stdout, fname_index):
+        index = getattr(self, 'index', None)
+        if index is None or index.needsRebuild():
+          if index is None: index = self.index = searchindex.SearchIndex()
+          index.rebuild(self.flacs.itervalues())
+          changed = True
+        # New snapshots are worth saving even if no files changed.
+        if walk.snapshots != getattr(self, 'dirsnaps', None):
+          self.dirsnaps = walk.snapshots
+          return True
+        return changed or converted
+
+    def _merge(self, fname, flac, st, stdout):
+        """
+        _merge() is the second stage of scan().  It puts a freshly read
+        FlacFile (or None, if fname couldn't be read) into the library.  If
+        st is not None, flac is an existing entry that has moved to fname.
+        """
+        if st is not None:
+          stdout.write('moved:   %s -> %s\n' % (flac.filename, fname))
+          flac.filename = fname
+          flac.setStat(st)
+          self.flacs[flac.md5] = flac
+          self._indexPut(flac)
+          flac.verified = True
+          return True
+        if flac is None:
+          stdout.write('invalid: %s\n' % os.path.basename(fname))
+          return False
+        if flac.md5 in self.flacs:
+          del self.flacs[flac.md5]
+          stdout.write('changed: %s\n' % flac.filename)
+        else:
+          stdout.write("new:     %s\n" % flac.filename)
+        self.flacs[flac.md5] = flac
+        self.flacs[flac.md5].verified = True
+        self._indexPut(flac)
+        return True
+
+
+class ScanJournal:
+    """
+    An append-only log of the changes a scan makes to a library, kept next
+    to the library file.  A scan that is interrupted after hours of reading
+    metadata loses nothing: the next one calls replay() and picks up where
+    the last one left off.  Every `every` changes, compact() (typically a
+    writeSavefile()) is called and the journal starts over.
+
+    Records are pickled ('put', FlacFile) and ('del', md5) tuples.  Only one
+    process at a time can hold the journal open.
+    """
+
+    def __init__(self, path, compact=None, every=flaccfg.JOURNAL_CHECKPOINT):
+        self.path = path
+        self.compact = compact
+        self.every = every
+        self.pending = 0
+        self.fd = open(path, 'ab+')
+        try:
+          fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+          self.fd.close()
+          raise JournalBusy('%s is in use by another scan' % path)
+
+    def replay(self, lib):
+        """
+        Applies the journal to lib and returns the number of changes in it.
+        A record that was only half written when we crashed is dropped.
+        """
+        self.fd.seek(0)
+        n = good = 0
+        while True:
+          try:
+            op, arg = pickle.load(self.fd)
+          except Exception:
+            # a truncated pickle can raise just about anything
+            break
+          if op == 'put':
+            lib.flacs[arg.md5] = arg
+            lib._indexPut(arg)
+          elif op == 'del':
+            lib.flacs.pop(arg, None)
+            lib._indexDelete(arg)
+          good = self.fd.tell()
+          n += 1
+        self.fd.truncate(good)
+        self.pending = n
+        return n
+
+    def _append(self, record):
+        pickle.dump(record, self.fd, pickle.HIGHEST_PROTOCOL)
+        self.fd.flush()
+        self.pending += 1
+        if self.every and self.pending >= self.every: self.checkpoint()
+
+    def put(self, flac):
+        self._append(('put', flac))
+
+    def delete(self, md5):
+        self._append(('del', md5))
+
+    def checkpoint(self):
+        """Folds everything so far into the library file via compact()."""
+        if self.compact: self.compact()
+        self.fd.truncate(0)
+        self.pending = 0
+
+    def discard(self):
+        """Throws the journal away, once the library file is up to date."""
+        os.unlink(self.path)
+        self.fd.close()
+
+
+class DirSnapshot:
+    """
+    What a directory looked like the last time scan() listed it.  Adding,
+    removing, or renaming an entry changes the directory mtime, and the
+    entry count and digest of the names catch changes that land within
+    the mtime resolution of the filesystem.
+    """
+
+    def __init__(self, mtime, names, subdirs):
+        self.mtime = mtime
+        self.count = len(names)
+        self.digest = _digest_names(names)
+        self.subdirs = subdirs
+
+    def __eq__(self, other):
+        return (isinstance(other, DirSnapshot) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def matches(self, mtime, names):
+        return (self.mtime == mtime and self.count == len(names) and
+                self.digest == _digest_names(names))
+
+
+def _digest_names(names):
+    return hashlib.md5('\0'.join(names)).hexdigest()
+
+
+class _Walk:
+    """
+    The first stage of FlacLibrary.scan(), not really meant to be used from
+    the outside.  walk() generates the names of the .flac files under a
+    path whose metadata needs to be read, and marks the rest verified as
+    it goes.
+    """
+
+    def __init__(self, fname_index, dir_index, dirsnaps, paranoid,
+                 identity_index, md5_index):
+        self.fname_index = fname_index
+        self.dir_index = dir_index
+        self.dirsnaps = dirsnaps
+        self.paranoid = paranoid
+        self.identity_index = identity_index
+        self.md5_index = md5_index
+        self.moved = set()
+        self.snapshots = {}
+
+    def _candidate(self, fname):
         """
-        scanpath() is for the recursive use of scan(), and not really meant
-        to be called from the outside.
+        Returns what _readFlac() needs to know about a file that isn't in
+        the library under this name: (fname, entry, st) if it is a library
+        entry that moved here, or (fname, None, None) if it must be read.
         """
-        changed = False
-        for f in sorted(os.listdir(path)):
+        if not self.identity_index and not self.md5_index:
+          return fname, None, None
+        st = os.stat(fname)
+        size, mtime = st[stat.ST_SIZE], st[stat.ST_MTIME]
+        flac = self.identity_index.get((st[stat.ST_DEV], st[stat.ST_INO],
+                                        size, mtime))
+        if flac is None and self.md5_index:
+          try:
+            flac = self.md5_index.get(flacmeta.readMD5(fname))
+          except (flacmeta.Error, IOError):
+            flac = None
+          if flac is not None and (flac.filesize, flac.mtime) != (size, mtime):
+            flac = None
+        # If the old path is still there, this is a copy, not a move.
+        if (flac is None or flac.verified or id(flac) in self.moved or
+            os.path.exists(flac.filename)):
+          return fname, None, None
+        self.moved.add(id(flac))
+        return fname, flac, st
+
+    def walk(self, path):
+        mtime = os.stat(path).st_mtime
+        names = sorted(os.listdir(path))
+        snap = self.dirsnaps.get(path)
+        if not self.paranoid and snap and snap.matches(mtime, names):
+          # Nothing was added, removed, or renamed here, so every file we
+          # knew about is still here.  Subdirectories still have to be
+          # checked, because changes inside them don't touch our mtime.
+          for flac in self.dir_index.get(path, []): flac.verified = True
+          for f in names:
+            fname = os.path.join(path, f)
+            # anything we knew about but couldn't read gets another try
+            if f.endswith('.flac') and fname not in self.fname_index:
+              yield self._candidate(fname)
+          self.snapshots[path] = snap
+          for d in snap.subdirs:
+            for sub in self.walk(os.path.join(path, d)): yield sub
+          return
+
+        subdirs = []
+        for f in names:
           fname = os.path.join(path, f)
 
           if f.endswith('.flac'):
 
             # if the file name, size, and mtime all match the library
             # image, skip inspecting the flac metadata which is expensive.
-            if fname in fname_index:
-              lib_image = self.flacs[fname_index[fname]]
+            if fname in self.fname_index:
+              lib_image = self.fname_index[fname]
               st = os.stat(fname)
               if (st[stat.ST_SIZE]  == lib_image.filesize and
                   st[stat.ST_MTIME] == lib_image.mtime):
                 lib_image.verified = True
                 continue
-
-            # otherwise, read the embedded 'md5' metadata tag
-            try:
-              flac = FlacFile(fname)
-              if not flac.md5: raise MetaflacFailed('missing md5')
-            except MetaflacFailed:
-              stdout.write('invalid: %s\n' % f)
-              continue
-            if flac.md5 in self.flacs:
-              del self.flacs[flac.md5]
-              stdout.write('changed: %s\n' % flac.filename)
+              yield fname, None, None
             else:
-              stdout.write("new:     %s\n" % flac.filename)
-            self.flacs[flac.md5] = flac
-            self.flacs[flac.md5].verified = True
-            changed = True
+              yield self._candidate(fname)
 
           elif (os.path.isdir(fname) and not (f.startswith("."))):
-            changed |= self._scanpath(fname, stdout, fname_index)
-        return changed
+            subdirs.append(f)
+            for sub in self.walk(fname): yield sub
+        self.snapshots[path] = DirSnapshot(mtime, names, subdirs)
+
+
+def _readFlac(candidate):
+    """
+    Takes a candidate from _Walk and returns (fname, FlacFile, None), or
+    (fname, None, None) if it isn't valid.  Moved files are passed through
+    as they are.
+    """
+    fname, flac, st = candidate
+    if st is not None: return candidate
+    try:
+      flac = FlacFile(fname)
+      if not flac.md5: raise MetaflacFailed('missing md5')
+    except MetaflacFailed:
+      return fname, None, None
+    return fname, FlacRecord(flac), None
+
+
+def parallel_imap(func, items, threads):
+    """
+    Like itertools.imap(func, items), except that func is called from a
+    pool of threads.  Results come back in the same order as items.
+    items is consumed in the calling thread, and only a few times
+    `threads` calls are allowed to be outstanding at once, so a slow
+    generator and a slow func overlap without either running away.
+    """
+    if threads <= 1:
+      for item in items: yield func(item)
+      return
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+      for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        while pending and (len(pending) >= threads * 4 or pending[0].ready()):
+          yield pending.popleft().get(FOREVER)
+      while pending:
+        yield pending.popleft().get(FOREVER)
+    finally:
+      # an exception, or the caller giving up on us, lands here too
+      pool.terminate()
+      pool.join()
+
+
+def device_imap(func, items, threads, per_device=1, device=None):
+    """
+    Yields func(item) for each of items, from a pool of `threads` threads,
+    but with no more than per_device calls at once for items on the same
+    device (device(item), by default item.device), so that each disk gets
+    a steady stream of work instead of being fought over.  per_device may
+    also be a function that returns the limit for a device.  Items on each
+    device are started in the order given, a free thread going to the
+    device with the least going on, and results come back in the order
+    they finish.
+    """
+    if device is None: device = lambda item: item.device
+    if callable(per_device): limit = per_device
+    else: limit = lambda dev: per_device
+    queues = collections.OrderedDict()
+    for i, item in enumerate(items):
+      queues.setdefault(device(item), collections.deque()).append((i, item))
+    limits = dict([ (dev, max(1, limit(dev))) for dev in queues ])
+    total = sum([ len(q) for q in queues.values() ])
+    busy = dict.fromkeys(queues, 0)
+    cond = threading.Condition()
+    results = Queue.Queue()
+    state = { 'left': total, 'stop': False }
+
+    def worker():
+      while True:
+        cond.acquire()
+        try:
+          while True:
+            if state['stop'] or not state['left']: return
+            ready = [ (busy[dev], q[0][0], dev) for dev, q in queues.items()
+                      if q and busy[dev] < limits[dev] ]
+            if ready: break
+            cond.wait(FOREVER)
+          dev = min(ready)[2]
+          i, item = queues[dev].popleft()
+          busy[dev] += 1
+          state['left'] -= 1
+        finally:
+          cond.release()
+        try:
+          results.put((True, func(item)))
+        except:
+          results.put((False, sys.exc_info()))
+        cond.acquire()
+        busy[dev] -= 1
+        cond.notifyAll()
+        cond.release()
+
+    pool = [ threading.Thread(target=worker)
+             for i in xrange(max(1, min(threads, total))) ]
+    for t in pool:
+      t.daemon = True
+      t.start()
+    try:
+      for i in xrange(total):
+        ok, result = results.get(True, FOREVER)
+        if not ok: raise result[0], result[1], result[2]
+        yield result
+    finally:
+      cond.acquire()
+      state['stop'] = True
+      cond.notifyAll()
+      cond.release()
+      # the ones still running finish what they're doing first
+      for t in pool: t.join(FOREVER)
 
 
 def filequote(s):
@@ -341,28 +1026,48 @@ def check_binary(cmd, regex, loud=True):
     return not not m
 
 
-def flacpipe(f, n):
+def decode_range(n, start=None, end=None):
+    """
+    The flac -d arguments that select track n (1-based): the exact samples
+    from start to end (exclusive, or None for the end of the file) if we
+    know them, or else the track's indices in the cuesheet, which makes
+    flac look them up again.
+    """
+    if start is None: return ['--cue=%s.1-%s.1' % (n, n+1)]
+    args = ['--skip=%d' % start]
+    if end is not None: args.append('--until=%d' % end)
+    return args
+
+
+# flacpipe()s' decoders, until they've been waited for
+_flacpipes = []
+
+def flacpipe(f, n, start=None, end=None):
     """
     Returns a file descriptor that will give you the raw PCM data
-    after decoding track n from file f.
+    after decoding track n from file f.  start and end are as for
+    decode_range().  The decoders of earlier calls that have exited are
+    waited for, so that a long run of them doesn't leave zombies.
     """
-    cmd = ['flac', '--silent', '--decode', '--stdout',
-           '--cue=%s.1-%s.1' % (n, n+1), f]
+    for child in _flacpipes[:]:
+      if child.poll() is not None: _flacpipes.remove(child)
+    cmd = ['flac', '--silent', '--decode', '--stdout'] + \
+          decode_range(n, start, end) + [f]
     child = subprocess.Popen(cmd, bufsize=4096, stdout=subprocess.PIPE)
-    # Not sure it is safe to hang onto the stdout file descriptor and
-    # throw away the Popen object.  Could cause a zombie or Python
-    # memory leak.  But it is consistent with Popen documentation.
-    # Doesn't really matter in the command line context where the parent
-    # process only lives a short time.
+    _flacpipes.append(child)
     return child.stdout
 
 
 def loadSavefile(f):
     """
     Our 'save file' is a list of FlacFile objects and a couple other things,
-    pickled in the order defined here.
+    pickled in the order defined here.  It can also be a SQLite database,
+    in which case flacdb does the work.
     """
-    fd = open(os.path.expanduser(f), 'r')
+    f = os.path.expanduser(f)
+    import flacdb # flacdb imports us, so it can't be imported at the top
+    if flacdb.isStore(f): return flacdb.loadStore(f)
+    fd = open(f, 'rb')
     flacs = pickle.load(fd)
     prefs = pickle.load(fd)
     return flacs, prefs
@@ -370,10 +1075,23 @@ def loadSavefile(f):
 
 def writeSavefile(f, flacs, prefs):
    """see loadSavefile()."""
-   fd = open(os.path.expanduser(f), 'w')
-   pickle.dump(flacs, fd, pickle.HIGHEST_PROTOCOL)
-   pickle.dump(prefs, fd, pickle.HIGHEST_PROTOCOL)
-   fd.close()
+   f = os.path.expanduser(f)
+   import flacdb
+   if flacdb.isStore(f): return flacdb.writeStore(f, flacs, prefs)
+   # Write a temporary file next to the real one and rename it into
+   # place, so that nobody ever sees half a library.
+   dirname, basename = os.path.split(f)
+   fd, tmp = tempfile.mkstemp('', '.%s.' % basename, dirname or '.')
+   try:
+     if os.path.exists(f): os.chmod(tmp, stat.S_IMODE(os.stat(f).st_mode))
+     fd = os.fdopen(fd, 'wb')
+     pickle.dump(flacs, fd, pickle.HIGHEST_PROTOCOL)
+     pickle.dump(prefs, fd, pickle.HIGHEST_PROTOCOL)
+     fd.close()
+     os.rename(tmp, f)
+   except:
+     os.unlink(tmp)
+     raise
 
 
 def testBinaries():
@@ -0,0 +1,401 @@
+"""
+Native reader for the metadata blocks at the head of a FLAC file.
+
+Everything flaclib wants to know about a file (STREAMINFO, the
+VORBIS_COMMENT block, the CUESHEET, where the pictures are) lives in
+the first few KB, in front of the audio frames.  Forking metaflac to
+tell us about it costs far more than the read itself, so this module
+walks the block headers directly.  It never reads past the last
+metadata block, and it skips over picture data rather than reading it.
+
+Anything this module doesn't understand raises BadFlac, and the caller
+is expected to fall back to metaflac.
+
+writeComments() replaces the VORBIS_COMMENT block.  Almost every FLAC
+file has a PADDING block for just this purpose, so the new comments can
+usually be written over the old ones, taking space from the padding or
+giving it back, without moving the audio.  Only when the padding runs out
+is the whole file rewritten.
+
+The format is described at https://xiph.org/flac/format.html.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import binascii
+import hashlib
+import os
+import shutil
+import stat
+import struct
+import tempfile
+
+FLAC_MAGIC = 'fLaC'
+
+# metadata block types
+STREAMINFO     = 0
+PADDING        = 1
+APPLICATION    = 2
+SEEKTABLE      = 3
+VORBIS_COMMENT = 4
+CUESHEET       = 5
+PICTURE        = 6
+INVALID        = 127
+
+SEEKPOINT_SIZE = 18
+SEEKPOINT_PLACEHOLDER = 0xFFFFFFFFFFFFFFFFL
+MAX_BLOCK_LENGTH = (1 << 24) - 1
+
+# how much padding to leave when a file has to be rewritten anyway
+DEFAULT_PADDING = 8192
+DEFAULT_VENDOR = 'flacenstein'
+
+class Error(Exception): pass
+class BadFlac(Error): pass
+
+
+class Block:
+    """
+    One metadata block: its type, where its header starts in the file,
+    and the length of the body that follows the 4-byte header.
+    """
+
+    def __init__(self, type, offset, length, last):
+        self.type = type
+        self.offset = offset
+        self.length = length
+        self.last = last
+
+    def __repr__(self):
+        return '<Block type %d at %d, %d bytes>' % (self.type, self.offset,
+                                                    self.length)
+
+
+class CuesheetTrack:
+    """A CUESHEET track: its offset in samples, number, and indices."""
+
+    def __init__(self, offset, number, indices):
+        self.offset = offset
+        self.number = number
+        self.indices = indices # list of (offset, number)
+
+
+class Picture:
+    """
+    A PICTURE block, minus the actual image.  data_offset and
+    data_length say where to find the image bytes if someone wants them.
+    """
+
+    def __init__(self, block, type, mime, description, data_offset,
+                 data_length):
+        self.block = block
+        self.type = type
+        self.mime = mime
+        self.description = description
+        self.data_offset = data_offset
+        self.data_length = data_length
+
+
+class Metadata:
+    """The decoded contents of the metadata blocks of one FLAC file."""
+
+    def __init__(self):
+        self.blocks = []
+        self.audio_offset = None
+        # STREAMINFO
+        self.sample_rate = None
+        self.channels = None
+        self.bits_per_sample = None
+        self.samples = None
+        self.md5 = None
+        # VORBIS_COMMENT
+        self.vendor = None
+        self.comments = None # list of raw 'NAME=value' strings
+        # CUESHEET
+        self.lead_in = None
+        self.is_cd = None
+        self.cuetracks = None
+        # others
+        self.pictures = []
+        self.applications = [] # list of 4-byte application ids
+        self.seekpoints = 0
+        self.padding = 0
+
+
+def _read(fd, n):
+    s = fd.read(n)
+    if len(s) != n: raise BadFlac('truncated metadata')
+    return s
+
+
+def _parse_streaminfo(md, body):
+    if len(body) != 34: raise BadFlac('STREAMINFO is %d bytes' % len(body))
+    # bytes 10-17 hold 20 bits of sample rate, 3 bits of (channels - 1),
+    # 5 bits of (bits per sample - 1), and 36 bits of total samples.
+    packed, = struct.unpack('>Q', body[10:18])
+    md.sample_rate = int(packed >> 44)
+    md.channels = int((packed >> 41) & 0x7) + 1
+    md.bits_per_sample = int((packed >> 36) & 0x1f) + 1
+    md.samples = int(packed & 0xfffffffffL)
+    md.md5 = binascii.hexlify(body[18:34])
+
+
+def _parse_vorbis_comment(md, body):
+    # Unlike everything else in FLAC, these lengths are little-endian,
+    # because the block is borrowed verbatim from Ogg Vorbis.
+    try:
+        pos = 0
+        n, = struct.unpack_from('<I', body, pos)
+        md.vendor = body[pos+4:pos+4+n]
+        pos += 4 + n
+        count, = struct.unpack_from('<I', body, pos)
+        pos += 4
+        comments = []
+        for i in xrange(count):
+            n, = struct.unpack_from('<I', body, pos)
+            if pos + 4 + n > len(body): raise BadFlac('comment overflows')
+            comments.append(body[pos+4:pos+4+n])
+            pos += 4 + n
+    except struct.error:
+        raise BadFlac('truncated VORBIS_COMMENT')
+    md.comments = comments
+
+
+def _parse_cuesheet(md, body):
+    try:
+        md.lead_in, flags = struct.unpack_from('>QB', body, 128)
+        md.is_cd = bool(flags & 0x80)
+        ntracks, = struct.unpack_from('>B', body, 395)
+        pos = 396
+        tracks = []
+        for i in xrange(ntracks):
+            offset, number = struct.unpack_from('>QB', body, pos)
+            nindices, = struct.unpack_from('>B', body, pos + 35)
+            pos += 36
+            indices = []
+            for j in xrange(nindices):
+                ioffset, inumber = struct.unpack_from('>QB', body, pos)
+                indices.append((ioffset, inumber))
+                pos += 12
+            tracks.append(CuesheetTrack(offset, number, indices))
+    except struct.error:
+        raise BadFlac('truncated CUESHEET')
+    md.cuetracks = tracks
+
+
+def _parse_picture(md, block, fd):
+    """
+    Reads the PICTURE header fields and leaves fd positioned at the
+    start of the image data, which we don't read.
+    """
+    try:
+        type, n = struct.unpack('>II', _read(fd, 8))
+        mime = _read(fd, n)
+        n, = struct.unpack('>I', _read(fd, 4))
+        description = _read(fd, n)
+        width, height, depth, colors, data_length = \
+            struct.unpack('>IIIII', _read(fd, 20))
+    except struct.error:
+        raise BadFlac('truncated PICTURE')
+    data_offset = fd.tell()
+    if data_offset + data_length > block.offset + 4 + block.length:
+        raise BadFlac('picture data overflows block')
+    md.pictures.append(Picture(block, type, mime, description, data_offset,
+                               data_length))
+
+
+def _parse_seektable(md, body):
+    n = 0
+    for pos in xrange(0, len(body) - SEEKPOINT_SIZE + 1, SEEKPOINT_SIZE):
+        sample, = struct.unpack_from('>Q', body, pos)
+        if sample != SEEKPOINT_PLACEHOLDER: n += 1
+    md.seekpoints = n
+
+
+def readBlockHeader(fd):
+    """Reads a 4-byte metadata block header at the current position of fd."""
+    offset = fd.tell()
+    hdr, = struct.unpack('>I', _read(fd, 4))
+    return Block((hdr >> 24) & 0x7f, offset, hdr & 0xffffff,
+                 bool(hdr & 0x80000000))
+
+
+def readMetadata(fname):
+    """
+    Returns a Metadata instance describing fname.  Only the metadata
+    region is read; picture data and audio frames are skipped.
+    """
+    md = Metadata()
+    fd = open(fname, 'rb')
+    try:
+        if fd.read(4) != FLAC_MAGIC: raise BadFlac('no fLaC marker')
+        while True:
+            block = readBlockHeader(fd)
+            if block.type == INVALID: raise BadFlac('invalid block type')
+            if not md.blocks and block.type != STREAMINFO:
+                raise BadFlac('first block is not STREAMINFO')
+            md.blocks.append(block)
+            body_offset = fd.tell()
+            if block.type == STREAMINFO:
+                _parse_streaminfo(md, _read(fd, block.length))
+            elif block.type == VORBIS_COMMENT:
+                if md.comments is not None:
+                    raise BadFlac('more than one VORBIS_COMMENT')
+                _parse_vorbis_comment(md, _read(fd, block.length))
+            elif block.type == CUESHEET:
+                _parse_cuesheet(md, _read(fd, block.length))
+            elif block.type == PICTURE:
+                _parse_picture(md, block, fd)
+            elif block.type == APPLICATION:
+                if block.length < 4: raise BadFlac('short APPLICATION')
+                md.applications.append(_read(fd, 4))
+            elif block.type == SEEKTABLE:
+                _parse_seektable(md, _read(fd, block.length))
+            elif block.type == PADDING:
+                md.padding += block.length
+            fd.seek(body_offset + block.length)
+            if block.last: break
+        md.audio_offset = fd.tell()
+    finally:
+        fd.close()
+    if md.md5 is None: raise BadFlac('missing STREAMINFO')
+    return md
+
+
+def readMD5(fname):
+    """
+    Returns just the STREAMINFO md5 of fname, which is at a fixed offset
+    and takes a single 42-byte read to find.
+    """
+    fd = open(fname, 'rb')
+    try:
+        head = fd.read(42)
+    finally:
+        fd.close()
+    if len(head) != 42 or head[:4] != FLAC_MAGIC:
+        raise BadFlac('no fLaC marker')
+    if (ord(head[4]) & 0x7f) != STREAMINFO or head[5:8] != '\0\0\x22':
+        raise BadFlac('first block is not STREAMINFO')
+    return binascii.hexlify(head[26:42])
+
+
+def _block_header(type, length, last):
+    if length > MAX_BLOCK_LENGTH: raise Error('%d byte block' % length)
+    return struct.pack('>I', (last and 0x80000000 or 0) | (type << 24) | length)
+
+
+def _layout(blocks):
+    """Turns a list of [type, body] into the metadata region of a file."""
+    last = len(blocks) - 1
+    return ''.join([ _block_header(type, len(body), i == last) + body
+                     for i, (type, body) in enumerate(blocks) ])
+
+
+def _vorbis_comment(vendor, comments):
+    body = [ struct.pack('<I', len(vendor)), vendor,
+             struct.pack('<I', len(comments)) ]
+    for c in comments:
+        body.append(struct.pack('<I', len(c)))
+        body.append(c)
+    return ''.join(body)
+
+
+def commentDigest(comments):
+    """
+    Returns a short digest of a list of comments, for telling whether the
+    ones in a file are the ones we would write.
+    """
+    return hashlib.md5(_vorbis_comment('', comments)).digest()
+
+
+def _fit(blocks, size):
+    """
+    Grows or shrinks the last PADDING block in blocks (a list of [type,
+    body]) so that they lay out to exactly size bytes.  Returns False if
+    that can't be done.
+    """
+    need = size - len(_layout(blocks))
+    padding = [ b for b in blocks if b[0] == PADDING ]
+    if need == 0: return True
+    if padding:
+        length = len(padding[-1][1]) + need
+        if length >= 0:
+            padding[-1][1] = '\0' * length
+            return True
+        if length == -4:
+            # exactly the size of its header, so it can go altogether
+            blocks.remove(padding[-1])
+            return True
+    elif need >= 4:
+        blocks.append([PADDING, '\0' * (need - 4)])
+        return True
+    return False
+
+
+def writeComments(fname, comments, vendor=None):
+    """
+    Replaces the VORBIS_COMMENT block of fname with comments, a list of
+    'NAME=value' strings in UTF-8.  The vendor string is kept unless a new
+    one is given.  Returns 'inplace' if the new block fit in the space of
+    the old one and the padding, or 'rewrite' if the file had to be
+    written out again in full (to a temporary file that is then renamed
+    over the old one).
+    """
+    md = readMetadata(fname)
+    fd = open(fname, 'rb')
+    try:
+        fd.seek(len(FLAC_MAGIC))
+        old = _read(fd, md.audio_offset - len(FLAC_MAGIC))
+    finally:
+        fd.close()
+    # old starts right after the magic, so each block's body begins at its
+    # header's offset in the file
+    blocks = [ [b.type, old[b.offset:b.offset + b.length]] for b in md.blocks ]
+    if vendor is None: vendor = md.vendor or DEFAULT_VENDOR
+    vc = _vorbis_comment(vendor, comments)
+    for b in blocks:
+        if b[0] == VORBIS_COMMENT:
+            b[1] = vc
+            break
+    else:
+        blocks.insert(1, [VORBIS_COMMENT, vc])
+
+    if _fit(blocks, len(old)):
+        new = _layout(blocks)
+        if new == old: return 'inplace'
+        # only write the part that changed
+        start = 0
+        while new[start] == old[start]: start += 1
+        end = len(new)
+        while new[end - 1] == old[end - 1]: end -= 1
+        fd = open(fname, 'r+b')
+        try:
+            fd.seek(len(FLAC_MAGIC) + start)
+            fd.write(new[start:end])
+        finally:
+            fd.close()
+        return 'inplace'
+
+    blocks = [ b for b in blocks if b[0] != PADDING ]
+    blocks.append([PADDING, '\0' * DEFAULT_PADDING])
+    dirname, basename = os.path.split(fname)
+    tmpfd, tmp = tempfile.mkstemp('', '.%s.' % basename, dirname or '.')
+    try:
+        os.chmod(tmp, stat.S_IMODE(os.stat(fname).st_mode))
+        out = os.fdopen(tmpfd, 'wb')
+        out.write(FLAC_MAGIC)
+        out.write(_layout(blocks))
+        fd = open(fname, 'rb')
+        try:
+            fd.seek(md.audio_offset)
+            shutil.copyfileobj(fd, out, 1 << 20)
+        finally:
+            fd.close()
+        out.close()
+        os.rename(tmp, fname)
+    except:
+        os.unlink(tmp)
+        raise
+    return 'rewrite'
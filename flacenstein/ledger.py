@@ -0,0 +1,149 @@
+"""
+A record of a convert run, kept in the output tree, so that a run that
+was interrupted can be finished by convert --resume without choosing the
+flac files again or redoing any job that was done.
+
+The ledger starts with the plan: the options the run was started with.
+The EncodeJobs it means to do are added as they're planned, which goes on
+while the first ones are running, and the plan is marked complete once
+they all have been.  Each job is recorded as it starts, finishes, or
+fails.  Like the scan journal, records are appended as pickles, and one
+that was only half written when we crashed is dropped.  Only one
+process at a time can hold a ledger open.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import cPickle as pickle
+import fcntl
+import os
+import threading
+
+LEDGER_NAME = '.flacenstein-ledger'
+
+
+class Error(Exception): pass
+class LedgerBusy(Error): pass
+class NoPlan(Error): pass
+
+
+def ledger_path(output_path):
+    return os.path.join(output_path, LEDGER_NAME)
+
+
+class JobLedger:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname): os.makedirs(dirname)
+        self.fd = open(path, 'ab+')
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.fd.close()
+            raise LedgerBusy('%s is in use by another convert' % path)
+        self.options = None
+        self.jobs = []
+        self.complete = False # whether every job has been planned
+        self.state = {} # job.final -> 'started', 'done' or 'failed'
+        self.errors = {} # job.final -> the last error
+
+    def load(self):
+        """Reads the ledger back in, or raises NoPlan if it's empty."""
+        self.fd.seek(0)
+        good = 0
+        while True:
+            try:
+                record = pickle.load(self.fd)
+            except Exception:
+                # a truncated pickle can raise just about anything
+                break
+            if record[0] == 'plan':
+                self.options, self.jobs = record[1], record[2]
+                # older ledgers planned every job up front
+                self.complete = bool(self.jobs)
+                self.state = {}
+                self.errors = {}
+            elif record[0] == 'planned':
+                self.jobs.extend(record[1])
+            elif record[0] == 'complete':
+                self.complete = True
+            else:
+                self.state[record[1]] = record[0]
+                if record[0] == 'failed': self.errors[record[1]] = record[2]
+            good = self.fd.tell()
+        self.fd.truncate(good)
+        if self.options is None:
+            raise NoPlan('no convert to resume in %s' %
+                         os.path.dirname(self.path))
+
+    def unfinished(self):
+        """The planned jobs that haven't been done."""
+        return [ j for j in self.jobs if self.state.get(j.final) != 'done' ]
+
+    def counts(self):
+        """How many of the planned jobs are in each state."""
+        out = { 'done': 0, 'failed': 0, 'started': 0, 'waiting': 0 }
+        for j in self.jobs: out[self.state.get(j.final, 'waiting')] += 1
+        return out
+
+    def plan(self, options):
+        """Starts the ledger over, for a run with options."""
+        self.lock.acquire()
+        try:
+            self.fd.truncate(0)
+            self.options, self.jobs = options, []
+            self.complete = False
+            self.state = {}
+            self.errors = {}
+            self._append(('plan', options, self.jobs))
+        finally:
+            self.lock.release()
+
+    def planned(self, jobs):
+        """Adds jobs to the plan."""
+        self.lock.acquire()
+        try:
+            self.jobs.extend(jobs)
+            self._append(('planned', list(jobs)))
+        finally:
+            self.lock.release()
+
+    def planned_all(self):
+        """Notes that the plan is complete."""
+        self.lock.acquire()
+        try:
+            self.complete = True
+            self._append(('complete',))
+        finally:
+            self.lock.release()
+
+    def _append(self, record):
+        pickle.dump(record, self.fd, pickle.HIGHEST_PROTOCOL)
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+
+    def _record(self, what, job, *args):
+        self.lock.acquire()
+        try:
+            self.state[job.final] = what
+            self._append((what, job.final) + args)
+        finally:
+            self.lock.release()
+
+    def started(self, job):
+        self._record('started', job)
+
+    def done(self, job):
+        self._record('done', job)
+
+    def failed(self, job, error):
+        self.errors[job.final] = error
+        self._record('failed', job, str(error))
+
+    def close(self):
+        self.fd.close()
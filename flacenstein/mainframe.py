@@ -9,13 +9,13 @@ are permitted under the terms of the GNU General Public License, version 2.
 
 import os
 import pickle
-import sys
-import tempfile
 import time
 import wx
 
 import flaccfg
 import flaclib
+import manifest
+import pipeline
 
 xfmmod = None
 
@@ -369,13 +369,12 @@ class MainLibFrame(wx.Frame):
             """
             pass
 
-        artdir = tempfile.mkdtemp("", "flacart.")
-
         # The strategy here is to make up a queue of jobs to do, then register
         # a processing function as an idle event handler.  This lets the GUI
         # keep itself updated while the transformation is running.
         
         self.statusNotify("Preparing job list...")
+        self.manifest = manifest.Manifest(self.outpath)
         for f in self.lib.flacs.values():
             if f.selected:
                 c = 0
@@ -388,18 +387,24 @@ class MainLibFrame(wx.Frame):
                     j.album = f.album
                     j.tracknum = c
                     j.flacfile = f.filename
-                    j.coverart = f.extractThumbnail(artdir)
+                    j.start, j.end, j.samples = f.trackRange(c - 1)
+                    j.sample_rate = f.sample_rate
+                    j.coverart = f.extractThumbnail()
                     j.listindex = f.listindex
                     fname = "%02d - %s.%s" % (c, t, xfmmod.extension)
-                    j.outfile = os.path.join(self.outpath,
-                                             flaclib.filequote(f.artist),
-                                             flaclib.filequote(f.album),
-                                             flaclib.filequote(fname))
+                    j.final = os.path.join(self.outpath,
+                                           flaclib.filequote(f.artist),
+                                           flaclib.filequote(f.album),
+                                           flaclib.filequote(fname))
+                    # the encoder writes beside it, and only a whole
+                    # output is moved into place
+                    j.outfile = pipeline.partial_name(j.final)
                     j.failures = 0
-                    # skip this job if outfile already exists
-                    # (should probably compare modification times of output file
-                    # and flac file)
-                    if not os.path.isfile(j.outfile): self.jobs.append(j)
+                    # skip this job if the output is up to date with the
+                    # flac file, its tags, and the encoder settings
+                    j.entry = manifest.make_entry(f, j, xfmmod)
+                    if self.manifest.status(j.final, j.entry):
+                        self.jobs.append(j)
                     
         print "Prepared %d jobs" % len(self.jobs)
         # 18 Feb 05 MAD: the order is always surprising anyway
@@ -422,47 +427,46 @@ class MainLibFrame(wx.Frame):
 
         global xfmmod
 
-        # if we have jobs to do, and empty child slots, fork a child
+        # if we have jobs to do, and empty child slots, start an encoder
         if self.jobs and len(self.children.keys()) < self.parallelism:
             j = self.jobs.pop()
-            self.lblAlbum.SetLabel(j.outfile)
-            child = os.fork()
-            if child == 0:
-                # this is the child process; call the encodeFile() method
-                # which should exec() an encoder process and exit with a
-                # status code
-                xfmmod.encodeFile(j)
-                # if you ever get here, something went wrong
-                sys.stderr.write('Whuh-oh, encodeFile() returned.\n')
-                sys.exit(1)
-            # this is the parent process; remember the job in a dictionary
-            # and wait to see what happens
+            self.lblAlbum.SetLabel(j.final)
+            try:
+                handle = pipeline.start_encoder(xfmmod, None, j)
+            except pipeline.Error, err:
+                print "%s - %s: %s" % (j.artist, j.title, err)
+                handle = None
+            # remember the job in a dictionary and wait to see what happens
             self.list.SetItemBackgroundColour(j.listindex, "pink")
-            self.children[child] = j
+            if handle: self.children[handle] = j
             jobsleft = len(self.jobs) + len(self.children.keys())
             self.ggeProgress.SetValue(self.maxjobs - jobsleft)
 
         # if we have children running, see if any have exited
-        if self.children:
-            exited, status = os.waitpid(-1, os.WNOHANG)
-            if exited and self.children.has_key(exited):
-                j = self.children[exited]
-                if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
-                    j.failures += 1
-                    if j.failures > 2:
-                        print "%s - %s: Giving up." % (j.artist, j.title)
-                    else:
-                        print "%s - %s: Job failed, retrying" % (j.artist, j.title)
-                        self.jobs.append(j)
-                del self.children[exited]
-            elif exited:
-                print "Got unknown child PID %d, something's weird" % exited
+        for handle, j in self.children.items():
+            if handle.poll() is None: continue
+            err = handle.error()
+            try:
+                pipeline.finish(j, err)
+            except OSError, ex:
+                err = str(ex)
+            if err:
+                j.failures += 1
+                if j.failures > 2:
+                    print "%s - %s: Giving up." % (j.artist, j.title)
+                else:
+                    print "%s - %s: Job failed, retrying" % (j.artist, j.title)
+                    self.jobs.append(j)
+            else:
+                self.manifest.record(j.final, j.entry)
+            del self.children[handle]
             jobsleft = len(self.jobs) + len(self.children.keys())
             self.ggeProgress.SetValue(self.maxjobs - jobsleft)
 
         # if we have no jobs left and no children to wait for, we're done
         if not self.jobs and not self.children:
             self.statusNotify("Transform done.")
+            self.manifest.save()
             xfmmod.cleanup()
             del xfmmod
             self.setState(STATE_IDLE)
@@ -524,8 +528,8 @@ class MainLibFrame(wx.Frame):
         def flaccmp(a,  b):
             """A throwaway list sorting function"""
             for f in self.sortfields:
-                c = cmp(self.lib.flacs[a].__dict__[f],
-                        self.lib.flacs[b].__dict__[f])
+                c = cmp(getattr(self.lib.flacs[a], f),
+                        getattr(self.lib.flacs[b], f))
                 if (c != 0):
                     return c
             return 0
@@ -577,7 +581,7 @@ class MainLibFrame(wx.Frame):
             self.lblAlbum.SetLabel("%s (%s)" % (flac.album, flac.date))
         else:
             self.lblAlbum.SetLabel(flac.album)
-        imgfile = flac.extractThumbnail(flaccfg.IMAGE_TEMP_PATH)
+        imgfile = flac.extractThumbnail()
         if imgfile:
             try:
                 img = wx.Image(imgfile, wx.BITMAP_TYPE_ANY)
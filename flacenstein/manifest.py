@@ -0,0 +1,144 @@
+"""
+A record of what each file in an output tree was made from, so that
+convert can tell which outputs are out of date instead of only which
+ones exist.
+
+For each output, the manifest keeps the md5 and mtime of the flac file
+it came from, the samples that were decoded, a digest of the tags and
+cover art it was given, and the encoder and its settings.  An output is
+redone when any of those but the mtime is different now; the mtime is
+only kept to say when the source changed.  The whole manifest is read
+once, and an output that it vouches for isn't looked at, unless we are
+being paranoid.
+
+Outputs that are there but that the manifest doesn't know about, such as
+a tree written before manifests existed, are taken to be up to date.
+When a track's output gets a new name (because its title changed, say),
+renamed() finds the old one, so it can be removed once the new one is
+written.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import collections
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+MANIFEST_NAME = '.flacenstein-manifest'
+
+Entry = collections.namedtuple('Entry',
+                               'md5 mtime tracknum start end tags settings')
+
+
+def tag_digest(job):
+    """A digest of the tags and cover art an encoder gives job's output."""
+    art = job.coverart and os.path.basename(job.coverart) or ''
+    fields = [ job.artist or u'', job.album or u'', job.title or u'',
+               unicode(job.tracknum), art ]
+    return hashlib.md5(u'\0'.join(fields).encode('utf-8')).hexdigest()
+
+
+def encoder_settings(xfmmod):
+    """What about an xfm module changes the audio it writes."""
+    return (xfmmod.extension, tuple(getattr(xfmmod, 'encoder_options', ())))
+
+
+def make_entry(flac, job, xfmmod):
+    return Entry(flac.md5, flac.mtime, job.tracknum, job.start, job.end,
+                 tag_digest(job), encoder_settings(xfmmod))
+
+
+def _track(entry):
+    return entry.md5, entry.tracknum, entry.settings
+
+
+class Manifest:
+
+    def __init__(self, output_path):
+        self.root = output_path
+        self.path = os.path.join(output_path, MANIFEST_NAME)
+        self.entries = self._load() # output path, relative to root -> Entry
+        self.tracks = None # (md5, tracknum, settings) -> output path
+        self.dirty = False
+
+    def _load(self):
+        try:
+            fd = open(self.path, 'rb')
+        except IOError:
+            return {}
+        try:
+            try:
+                return pickle.load(fd)
+            except Exception:
+                # we'll be suspicious of nothing, but we won't crash
+                return {}
+        finally:
+            fd.close()
+
+    def _rel(self, outfile):
+        return os.path.relpath(outfile, self.root)
+
+    def find(self, outfile):
+        return self.entries.get(self._rel(outfile))
+
+    def status(self, outfile, entry, paranoid=False):
+        """
+        Returns None if outfile is up to date with entry, or else why not:
+        'new', 'missing', 'audio', 'settings', or 'tags'.
+        """
+        old = self.find(outfile)
+        if old is None:
+            if not os.path.isfile(outfile): return 'new'
+            self.record(outfile, entry)
+            return None
+        if paranoid and not os.path.isfile(outfile): return 'missing'
+        if (old.md5, old.start, old.end) != (entry.md5, entry.start,
+                                             entry.end):
+            return 'audio'
+        if old.settings != entry.settings: return 'settings'
+        if old.tags != entry.tags: return 'tags'
+        return None
+
+    def renamed(self, outfile, entry):
+        """
+        Returns the output that was made from the same track as outfile
+        but under another name, or None.
+        """
+        if self.tracks is None:
+            self.tracks = {}
+            for rel, e in self.entries.items(): self.tracks[_track(e)] = rel
+        rel = self.tracks.get(_track(entry))
+        if rel is None or rel == self._rel(outfile): return None
+        return os.path.join(self.root, rel)
+
+    def record(self, outfile, entry):
+        rel = self._rel(outfile)
+        self.entries[rel] = entry
+        if self.tracks is not None: self.tracks[_track(entry)] = rel
+        self.dirty = True
+
+    def forget(self, outfile):
+        rel = self._rel(outfile)
+        entry = self.entries.pop(rel, None)
+        if entry is None: return
+        if self.tracks is not None and self.tracks.get(_track(entry)) == rel:
+            del self.tracks[_track(entry)]
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty: return
+        if not os.path.isdir(self.root): os.makedirs(self.root)
+        fd, tmp = tempfile.mkstemp('', '.manifest.', self.root)
+        try:
+            fd = os.fdopen(fd, 'wb')
+            pickle.dump(self.entries, fd, pickle.HIGHEST_PROTOCOL)
+            fd.close()
+            os.rename(tmp, self.path)
+        except:
+            os.unlink(tmp)
+            raise
+        self.dirty = False
@@ -0,0 +1,411 @@
+"""
+Native writers for the tags in the files the xfm modules make, so that
+when only the tags of a track have changed, its output can be retagged
+in a second instead of encoded again in a minute.
+
+writeID3() replaces the ID3v2 frames lame writes (and updates the ID3v1
+tag at the end, if there is one).  writeOggComments() replaces the
+comment header of an Ogg Vorbis or Opus stream; the audio pages are
+copied as they are, unless the new comments take a different number of
+pages, in which case their sequence numbers and checksums are redone.
+Either way, the other tags in the file are kept.
+
+Both read one file and write another, so that the caller can move the
+new one into place when it is done.  Anything they don't understand
+raises Unsupported, and the caller is expected to encode the track over
+again instead.
+
+The formats are described at https://id3.org/id3v2.3.0 and
+https://xiph.org/ogg/doc/framing.html.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import base64
+import os
+import shutil
+import struct
+
+class Error(Exception): pass
+class Unsupported(Error): pass
+
+COPY_CHUNK = 256 * 1024
+FRONT_COVER = 3
+
+MIME_TYPES = { '.png': 'image/png', '.gif': 'image/gif' }
+
+
+def _mime(fname):
+    return MIME_TYPES.get(os.path.splitext(fname)[1].lower(), 'image/jpeg')
+
+
+def _read_file(fname):
+    fd = open(fname, 'rb')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+
+def _copy_rest(src, dst):
+    shutil.copyfileobj(src, dst, COPY_CHUNK)
+
+
+def _text(s):
+    if s is None: return u''
+    if isinstance(s, str): return s.decode('utf-8', 'replace')
+    return s
+
+
+def _read_art(job):
+    if not job.coverart: return None
+    return _mime(job.coverart), _read_file(job.coverart)
+
+
+#
+# ID3
+#
+
+ID3_HEADER = struct.Struct('>3sBBB4s')
+ID3V1_SIZE = 128
+ID3_PADDING = 1024
+ID3_FLAGS_UNSUPPORTED = 0x80 | 0x40 | 0x10 # unsynchronized, extended, footer
+
+
+def _syncsafe(s):
+    b = [ ord(c) for c in s ]
+    if [ c for c in b if c & 0x80 ]: raise Unsupported('bad syncsafe integer')
+    return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+
+def _to_syncsafe(n):
+    return ''.join([ chr((n >> shift) & 0x7f) for shift in (21, 14, 7, 0) ])
+
+
+def _id3_frames(data, version):
+    """Splits the body of an ID3v2 tag into a list of (id, flags, body)."""
+    frames = []
+    pos = 0
+    while pos + 10 <= len(data):
+        fid = data[pos:pos+4]
+        if fid == '\0\0\0\0': break # padding
+        if version == 4: size = _syncsafe(data[pos+4:pos+8])
+        else: size = struct.unpack('>I', data[pos+4:pos+8])[0]
+        flags = data[pos+8:pos+10]
+        if pos + 10 + size > len(data): raise Unsupported('truncated frame')
+        frames.append((fid, flags, data[pos+10:pos+10+size]))
+        pos += 10 + size
+    return frames
+
+
+def _id3_frame(fid, flags, body, version):
+    if version == 4: size = _to_syncsafe(len(body))
+    else: size = struct.pack('>I', len(body))
+    return fid + size + flags + body
+
+
+def _id3_text(text, version):
+    if version == 4: return '\x03' + text.encode('utf-8')
+    return '\x01' + text.encode('utf-16')
+
+
+def _id3_picture(mime, data):
+    # Latin-1 description, front cover, no description
+    return '\x00' + mime + '\x00' + chr(FRONT_COVER) + '\x00' + data
+
+
+ID3_OWNED = ('TPE1', 'TALB', 'TIT2', 'TRCK', 'APIC')
+
+
+def _id3_ours(job, version):
+    frames = [ ('TPE1', _id3_text(_text(job.artist), version)),
+               ('TALB', _id3_text(_text(job.album), version)),
+               ('TIT2', _id3_text(_text(job.title), version)),
+               ('TRCK', _id3_text(unicode(job.tracknum), version)) ]
+    art = _read_art(job)
+    if art: frames.append(('APIC', _id3_picture(*art)))
+    return frames
+
+
+def _id3v1(old, job):
+    """Updates the fields of the ID3v1 tag old that lame fills in."""
+    def field(s, n):
+        return s.encode('latin-1', 'replace')[:n].ljust(n, '\0')
+    comment = old[97:125]
+    return ('TAG' + field(_text(job.title), 30) +
+            field(_text(job.artist), 30) + field(_text(job.album), 30) +
+            old[93:97] + comment[:28] + '\0' +
+            chr(min(job.tracknum, 255)) + old[127])
+
+
+def writeID3(src, dst, job):
+    """
+    Copies the MP3 file src to dst with the artist, album, title, track
+    number, and cover art tags replaced by job's.
+    """
+    fin = open(src, 'rb')
+    try:
+        head = fin.read(ID3_HEADER.size)
+        if len(head) == ID3_HEADER.size and head.startswith('ID3'):
+            magic, version, rev, flags, size = ID3_HEADER.unpack(head)
+            if version not in (3, 4):
+                raise Unsupported('ID3v2.%d tag' % version)
+            if flags & ID3_FLAGS_UNSUPPORTED:
+                raise Unsupported('ID3v2 flags %#x' % flags)
+            size = _syncsafe(size)
+            frames = _id3_frames(fin.read(size), version)
+        else:
+            # no ID3v2 tag; lame writes 2.3 when it writes one
+            version, flags, frames = 3, 0, []
+            fin.seek(0)
+        keep = [ f for f in frames if f[0] not in ID3_OWNED ]
+        body = ''.join([ _id3_frame(fid, '\0\0', data, version)
+                         for fid, data in _id3_ours(job, version) ] +
+                       [ _id3_frame(fid, fflags, data, version)
+                         for fid, fflags, data in keep ])
+        body += '\0' * ID3_PADDING
+        audio_start = fin.tell()
+
+        fin.seek(0, os.SEEK_END)
+        end = fin.tell()
+        tail = ''
+        if end - audio_start >= ID3V1_SIZE:
+            fin.seek(end - ID3V1_SIZE)
+            tail = fin.read(ID3V1_SIZE)
+            if tail.startswith('TAG'):
+                end -= ID3V1_SIZE
+                tail = _id3v1(tail, job)
+            else:
+                tail = ''
+
+        fout = open(dst, 'wb')
+        try:
+            fout.write(ID3_HEADER.pack('ID3', version, 0, 0,
+                                       _to_syncsafe(len(body))))
+            fout.write(body)
+            fin.seek(audio_start)
+            left = end - audio_start
+            while left > 0:
+                data = fin.read(min(COPY_CHUNK, left))
+                if not data: raise Unsupported('%s got shorter' % src)
+                fout.write(data)
+                left -= len(data)
+            fout.write(tail)
+        finally:
+            fout.close()
+    finally:
+        fin.close()
+
+
+#
+# Ogg
+#
+
+OGG_HEADER = struct.Struct('<4sBBqIIIB')
+OGG_CONTINUED = 0x01
+MAX_SEGMENTS = 255
+
+VORBIS_COMMENT_MAGIC = '\x03vorbis'
+OPUS_TAGS_MAGIC = 'OpusTags'
+
+OGG_OWNED = ('ARTIST', 'ALBUM', 'TITLE', 'TRACKNUMBER',
+             'METADATA_BLOCK_PICTURE')
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for j in range(8):
+            if r & 0x80000000: r = ((r << 1) ^ 0x04c11db7) & 0xffffffff
+            else: r = (r << 1) & 0xffffffff
+        table.append(r)
+    return table
+
+_CRC_TABLE = _crc_table()
+
+
+def _ogg_crc(data):
+    crc = 0
+    table = _CRC_TABLE
+    for c in data:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ ord(c)]
+    return crc
+
+
+class _Page:
+
+    def __init__(self, flags, granule, serial, seqno, segments, data):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.seqno = seqno
+        self.segments = segments
+        self.data = data
+
+    def pack(self):
+        head = OGG_HEADER.pack('OggS', 0, self.flags, self.granule,
+                               self.serial, self.seqno, 0,
+                               len(self.segments))
+        page = head + ''.join(map(chr, self.segments)) + self.data
+        crc = _ogg_crc(page)
+        return page[:22] + struct.pack('<I', crc) + page[26:]
+
+
+def _read_page(fd):
+    head = fd.read(OGG_HEADER.size)
+    if not head: return None
+    if len(head) < OGG_HEADER.size: raise Unsupported('truncated page')
+    magic, version, flags, granule, serial, seqno, crc, nsegs = \
+        OGG_HEADER.unpack(head)
+    if magic != 'OggS' or version != 0: raise Unsupported('not an Ogg page')
+    segments = map(ord, fd.read(nsegs))
+    data = fd.read(sum(segments))
+    if len(segments) != nsegs or len(data) != sum(segments):
+        raise Unsupported('truncated page')
+    return _Page(flags, granule, serial, seqno, segments, data)
+
+
+def _read_headers(fd, count):
+    """
+    Reads the pages holding the first count packets of the stream, and
+    returns (pages, packets).  The last of them has to end its page.
+    """
+    pages, packets = [], []
+    packet = ''
+    while len(packets) < count:
+        page = _read_page(fd)
+        if page is None: raise Unsupported('stream ended in the headers')
+        if pages and page.serial != pages[0].serial:
+            raise Unsupported('more than one logical stream')
+        pages.append(page)
+        pos = 0
+        for n, seg in enumerate(page.segments):
+            packet += page.data[pos:pos+seg]
+            pos += seg
+            if seg < 255:
+                packets.append(packet)
+                packet = ''
+                if len(packets) == count and n != len(page.segments) - 1:
+                    raise Unsupported('audio shares a page with headers')
+    if packet: raise Unsupported('audio shares a page with headers')
+    return pages, packets
+
+
+def _paginate(packets, serial, seqno):
+    """Lays packets out on as few pages as will hold them."""
+    pages = []
+    segments, data = [], []
+    flags = 0
+    finished = False # whether a packet ends on this page
+    for packet in packets:
+        lacing = [255] * (len(packet) / 255) + [len(packet) % 255]
+        pos = 0
+        for i, seg in enumerate(lacing):
+            if len(segments) == MAX_SEGMENTS:
+                # header pages have granule position 0, except that one on
+                # which no packet ends has -1
+                granule = finished and 0 or -1
+                pages.append(_Page(flags, granule, serial, seqno, segments,
+                                   ''.join(data)))
+                seqno += 1
+                flags = i and OGG_CONTINUED or 0
+                segments, data = [], []
+                finished = False
+            segments.append(seg)
+            data.append(packet[pos:pos+seg])
+            pos += seg
+            if seg < 255: finished = True
+    pages.append(_Page(flags, 0, serial, seqno, segments, ''.join(data)))
+    return pages
+
+
+def _parse_comments(packet, magic):
+    if not packet.startswith(magic): raise Unsupported('no comment header')
+    pos = len(magic)
+    try:
+        n = struct.unpack('<I', packet[pos:pos+4])[0]
+        vendor = packet[pos+4:pos+4+n]
+        pos += 4 + n
+        count = struct.unpack('<I', packet[pos:pos+4])[0]
+        pos += 4
+        comments = []
+        for i in xrange(count):
+            n = struct.unpack('<I', packet[pos:pos+4])[0]
+            comments.append(packet[pos+4:pos+4+n])
+            pos += 4 + n
+    except struct.error:
+        raise Unsupported('truncated comment header')
+    return vendor, comments
+
+
+def _pack_comments(magic, vendor, comments):
+    out = [magic, struct.pack('<I', len(vendor)), vendor,
+           struct.pack('<I', len(comments))]
+    for c in comments: out.extend([struct.pack('<I', len(c)), c])
+    if magic == VORBIS_COMMENT_MAGIC: out.append('\x01') # framing bit
+    return ''.join(out)
+
+
+def _picture_comment(mime, data):
+    # a FLAC PICTURE block, with no description and no dimensions
+    block = (struct.pack('>II', FRONT_COVER, len(mime)) + mime +
+             struct.pack('>IIIIII', 0, 0, 0, 0, 0, len(data)) + data)
+    return 'METADATA_BLOCK_PICTURE=' + base64.b64encode(block)
+
+
+def _ogg_ours(job, art):
+    comments = [ u'ARTIST=' + _text(job.artist), u'ALBUM=' + _text(job.album),
+                 u'TITLE=' + _text(job.title),
+                 u'TRACKNUMBER=%d' % job.tracknum ]
+    comments = [ c.encode('utf-8') for c in comments ]
+    if art:
+        picture = _read_art(job)
+        if picture: comments.append(_picture_comment(*picture))
+    return comments
+
+
+def writeOggComments(src, dst, job, art=True):
+    """
+    Copies the Ogg Vorbis or Opus file src to dst with the artist, album,
+    title, and track number comments replaced by job's, as well as the
+    cover art if art.
+    """
+    fin = open(src, 'rb')
+    try:
+        first = _read_page(fin)
+        if first is None: raise Unsupported('empty file')
+        if first.data.startswith('\x01vorbis'):
+            magic, count = VORBIS_COMMENT_MAGIC, 2 # comments, setup
+        elif first.data.startswith('OpusHead'):
+            magic, count = OPUS_TAGS_MAGIC, 1 # comments
+        else:
+            raise Unsupported('not Vorbis or Opus')
+        pages, packets = _read_headers(fin, count)
+        vendor, comments = _parse_comments(packets[0], magic)
+        keep = [ c for c in comments
+                 if c.split('=', 1)[0].upper() not in OGG_OWNED ]
+        packets[0] = _pack_comments(magic, vendor,
+                                    _ogg_ours(job, art) + keep)
+        new = _paginate(packets, first.serial, pages[0].seqno)
+        shift = len(new) - len(pages)
+
+        fout = open(dst, 'wb')
+        try:
+            fout.write(first.pack())
+            for page in new: fout.write(page.pack())
+            if not shift:
+                _copy_rest(fin, fout)
+            else:
+                # every page after ours has to be renumbered
+                while True:
+                    page = _read_page(fin)
+                    if page is None: break
+                    page.seqno += shift
+                    fout.write(page.pack())
+        finally:
+            fout.close()
+    finally:
+        fin.close()
@@ -0,0 +1,526 @@
+"""
+Decode-once transcoding of whole albums.
+
+Encoding an album a track at a time runs flac once per track, and each of
+those has to open the file, find its track, and decode it.  An AlbumJob
+instead runs one flac over all the tracks it wants, as raw PCM, and cuts
+the stream at the tracks' sample offsets, handing each piece to its own
+encoder behind a WAV header.  No more than CHUNK bytes of audio are held
+in memory at once: the pipes to the encoders are all the buffering there
+is, and a slow encoder just slows the decoder down.
+
+For the same reason, an album's tracks are encoded one after another;
+encoding two at once would mean holding on to the second one's audio
+until the first was done.  Parallelism comes from doing several albums at
+once.
+
+An AlbumJob doesn't need a thread of its own: it never blocks, but says
+which pipes it is waiting on (fds()), and moves audio along when one of
+them is ready, so one select() loop (see engine) can run many of them.
+run() is that loop for just one.
+
+Every encoder writes to a hidden partial_name() beside its output file,
+which finish() renames into place only once the encoder has succeeded,
+so an interrupted run never leaves a truncated file where a finished one
+is expected.
+
+An xfm module is an encoder to this module.  It says what it can do with
+a few module attributes (see capabilities()), and startEncoder(src, job)
+starts encoding the WAV stream src into job.outfile, returning an
+EncoderHandle to wait on; see start_encoder().  Modules from before this
+interface, with only an encodeFile(job) to be called in a forked child,
+are still run that way, but can't share a decoder.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import signal
+import struct
+import subprocess
+import time
+
+import flaccfg
+import flaclib
+
+CHUNK = 256 * 1024
+
+# for start_encoder(), when the caller is going to write the audio itself
+PIPE = subprocess.PIPE
+
+# how often AlbumJob.run() checks on encoders that are finishing up
+POLL = 0.01
+
+WAVE_FORMAT_PCM = 1
+
+
+def wav_header(samples, channels, bits, rate):
+    """A canonical 44-byte WAV header for samples samples of PCM."""
+    block_align = channels * bits / 8
+    size = samples * block_align
+    return struct.pack('<4sI4s4sIHHIIHH4sI', 'RIFF', 36 + size, 'WAVE',
+                       'fmt ', 16, WAVE_FORMAT_PCM, channels, rate,
+                       rate * block_align, block_align, bits, 'data', size)
+
+
+def decoder_command(filename, start, end=None, bits=16):
+    """
+    The flac command that writes samples start to end (None for the end of
+    the file) of filename to stdout as raw little-endian PCM, bits bits to
+    a sample, signed as a WAV file has them (unsigned if 8 bits).
+    """
+    if bits == 8: sign = 'unsigned'
+    else: sign = 'signed'
+    cmd = [flaccfg.BIN_FLAC, '--silent', '--decode', '--stdout',
+           '--force-raw-format', '--endian=little', '--sign=%s' % sign,
+           '--skip=%d' % start]
+    if end is not None: cmd.append('--until=%d' % end)
+    cmd.append(filename)
+    return cmd
+
+
+def track_decoder_command(job):
+    """The flac command that writes job's track to stdout as a WAV stream."""
+    return [flaccfg.BIN_FLAC, '--silent', '--decode', '--stdout'] + \
+           flaclib.decode_range(job.tracknum, job.start, job.end) + \
+           [job.flacfile]
+
+
+def partial_name(outfile):
+    """
+    Where an encoder writes outfile until it is done: a hidden file beside
+    it, with the same extension, since some encoders go by that.
+    """
+    head, tail = os.path.split(outfile)
+    root, ext = os.path.splitext(tail)
+    return os.path.join(head, '.%s.part%s' % (root, ext))
+
+
+def finish(job, error):
+    """
+    Moves job's output into place if error is None, or throws it away if
+    not, so that a file at job.final is always a whole one.
+    """
+    if error is None:
+        os.rename(job.outfile, job.final)
+    elif os.path.exists(job.outfile):
+        os.unlink(job.outfile)
+
+
+class EncodeJob:
+    """
+    One track to encode.  transcode_flacs() fills in the details: what to
+    decode (flacfile, tracknum, start, end, and the audio format), how to
+    tag it (artist, album, title, coverart), and where it goes.  The
+    encoder writes outfile, which is moved to final when it is done.  If
+    retag, only the tags need changing, and outfile is made by copying
+    the output there is already, existing, with new tags.
+    """
+    pass
+
+
+class Error(Exception): pass
+
+
+Capabilities = collections.namedtuple('Capabilities',
+                                      'extension sample_bits tags art '
+                                      'threads streams')
+
+
+def capabilities(xfmmod):
+    """
+    What xfmmod's encoder can do: the extension of what it writes, the
+    bits per sample it takes, whether it writes tags and cover art, how
+    many threads it keeps busy, and whether it can be handed audio to
+    encode (streams) instead of decoding for itself.  A module that
+    doesn't say is taken to be an old one that needs a track at a time.
+    """
+    return Capabilities(xfmmod.extension,
+                        tuple(getattr(xfmmod, 'sample_bits', (16,))),
+                        getattr(xfmmod, 'writes_tags', True),
+                        getattr(xfmmod, 'writes_art', False),
+                        getattr(xfmmod, 'threads', 1),
+                        hasattr(xfmmod, 'startEncoder'))
+
+
+class _Forked:
+    """Enough of a Popen for a child running an old module's encodeFile()."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.stdin = None
+        self.returncode = None
+
+    def _status(self, status):
+        if os.WIFSIGNALED(status): self.returncode = -os.WTERMSIG(status)
+        else: self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def poll(self):
+        if self.returncode is not None: return self.returncode
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0: return None
+        return self._status(status)
+
+    def wait(self):
+        if self.returncode is not None: return self.returncode
+        pid, status = os.waitpid(self.pid, 0)
+        return self._status(status)
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+
+class EncoderHandle:
+    """
+    A running encoder, and the flac decoding for it if there is one.  If
+    it was started with PIPE, the audio is to be written to stdin, which
+    the caller closes when it's done.  poll() and wait() are as for a
+    Popen, and error() says what went wrong once it has finished.
+    """
+
+    def __init__(self, cmd, encoder, decoder=None):
+        self.cmd = cmd
+        self.encoder = encoder
+        self.decoder = decoder
+        self.stdin = encoder.stdin
+        self.returncode = None
+
+    def _finished(self, ret):
+        # an encoder that quit early leaves the decoder with a broken
+        # pipe, so this doesn't wait long
+        if self.decoder: self.decoder.wait()
+        self.returncode = ret
+        return ret
+
+    def poll(self):
+        ret = self.encoder.poll()
+        if ret is None: return None
+        return self._finished(ret)
+
+    def wait(self):
+        return self._finished(self.encoder.wait())
+
+    def kill(self):
+        """Kills the encoder and decoder, which still need to be waited for."""
+        for proc in (self.encoder, self.decoder):
+            if proc is None or proc.poll() is not None: continue
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def error(self):
+        """None if the encoder (and decoder) succeeded, or else why not."""
+        if self.returncode < 0:
+            return '%s killed by signal %d' % (self.cmd[0], -self.returncode)
+        if self.returncode:
+            return '%s returned %d' % (self.cmd[0], self.returncode)
+        if self.decoder and self.decoder.returncode:
+            return 'flac returned %d' % self.decoder.returncode
+        return None
+
+
+def utf8(text):
+    """text as an argument for a command: a UTF-8 str, not unicode."""
+    if text is None: return ''
+    if isinstance(text, unicode): return text.encode('utf-8')
+    return text
+
+
+def spawn(cmd, src, job):
+    """
+    Starts cmd reading a WAV stream from src, as start_encoder() does,
+    and returns its EncoderHandle.  xfm modules' startEncoder()s use this.
+    """
+    decoder = None
+    if src is None:
+        decoder = subprocess.Popen(track_decoder_command(job),
+                                   stdout=subprocess.PIPE, bufsize=CHUNK,
+                                   close_fds=True)
+        src = decoder.stdout
+    try:
+        try:
+            # close_fds, or the encoders for a track would hold each
+            # other's stdin open, and none of them would see the end
+            encoder = subprocess.Popen(cmd, stdin=src, close_fds=True)
+        except (OSError, TypeError, ValueError), e:
+            # TypeError is an argument that's unicode, or None
+            if decoder:
+                decoder.kill()
+                decoder.wait()
+            raise Error("can't run %s: %s" % (cmd[0], e))
+    finally:
+        # the encoder has its own copy now
+        if decoder: decoder.stdout.close()
+    return EncoderHandle(cmd, encoder, decoder)
+
+
+def start_encoder(xfmmod, src, job):
+    """
+    Starts xfmmod encoding job, and returns an EncoderHandle.  src is an
+    open file with the track in it as a WAV stream, or PIPE if the caller
+    will write it to the handle's stdin, or None to have the track
+    decoded from job.flacfile.  The directory for job.outfile is made if
+    need be.  Raises Error if the encoder can't take the job or can't be
+    started.
+    """
+    caps = capabilities(xfmmod)
+    bits = getattr(job, 'bits_per_sample', None)
+    if caps.streams and bits and bits not in caps.sample_bits:
+        raise Error('%s encoder takes %s-bit audio, not %d-bit' %
+                    (caps.extension, '/'.join(map(str, caps.sample_bits)),
+                     bits))
+    outdir = os.path.dirname(job.outfile)
+    try:
+        os.makedirs(outdir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise Error("can't create %s: %s" % (outdir, e))
+    if caps.streams: return xfmmod.startEncoder(src, job)
+    if src is not None:
+        raise Error('%s encoder can only decode for itself' % caps.extension)
+    # an old module, whose encodeFile() decodes the track itself, execs
+    # the encoder, and exits with its status
+    child = os.fork()
+    if child == 0:
+        try:
+            xfmmod.encodeFile(job)
+        finally:
+            os._exit(1)
+    return EncoderHandle([xfmmod.__name__.split('.')[-1]], _Forked(child))
+
+
+def _nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Encoder:
+    """One encoder being fed a track, and what has gone wrong with it."""
+
+    def __init__(self, job):
+        self.job = job
+        self.handle = None
+        self.fd = None
+        self.error = None
+        self.written = 0 # of the chunk being handed out
+
+    def wants(self, n):
+        """Whether we still have to write to it, out of n bytes."""
+        return self.fd is not None and not self.error and self.written < n
+
+    def write(self, data):
+        try:
+            self.written += os.write(self.fd, data[self.written:])
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                self.error = 'encoder stopped reading: %s' % e
+
+
+class AlbumJob:
+    """
+    The tracks of one FLAC file (or just one track) that are to be
+    encoded.  jobs are the EncodeJobs that transcode_flacs() makes, which
+    must all know their start, end, and samples; start(src, job) starts
+    an encoder for one of them, as start_encoder() does.  There can be
+    several jobs for the same track, for different output types, which
+    are fed the same audio at once.
+
+    Once begin() has been called, fds() are the (readable, writable) file
+    descriptors we're waiting on, and ready(fd) is to be called when one
+    of them is.  poll() has to be called now and then as well, and
+    returns True when we're done, with a (job, error) in results for each
+    job, where error is None if it worked.  If an encoder is killed by a
+    signal, we stop there, and the jobs we hadn't started are in results
+    failed with 'encoder killed by signal N', to be tried again on their
+    own.  progress is when audio last moved.
+    """
+
+    def __init__(self, jobs, start):
+        self.flacfile = jobs[0].flacfile
+        self.channels = jobs[0].channels
+        self.bits_per_sample = jobs[0].bits_per_sample
+        self.sample_rate = jobs[0].sample_rate
+        self.jobs = sorted(jobs, key=lambda j: j.start)
+        self.start = start
+        tracks = {}
+        for j in self.jobs: tracks.setdefault(j.start, []).append(j)
+        self.tracks = [ tracks[s] for s in sorted(tracks) ]
+        self.samples = sum([ t[0].samples for t in self.tracks ])
+        self.outfile = self.flacfile # for progress messages
+        self.killed = None # the signal that killed an encoder
+        self.done = False
+        self.results = []
+        self.progress = None
+
+    def begin(self):
+        self.frame = self.channels * self.bits_per_sample / 8
+        first, last = self.tracks[0][0], self.tracks[-1][0]
+        cmd = decoder_command(self.flacfile, first.start, last.end,
+                              self.bits_per_sample)
+        self.decoder = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                        close_fds=True)
+        self.src = self.decoder.stdout.fileno()
+        _nonblocking(self.src)
+        self.pos = first.start
+        self.next = 0 # the next of tracks to start on
+        self.encoders = []
+        self.closing = False
+        self.progress = time.time()
+        self._next_track()
+
+    def _next_track(self):
+        # an encoder killed by a signal probably means ^C, or that we're
+        # short of memory; the tracks we haven't started fail with it, so
+        # that they can be tried again on their own
+        if self.killed:
+            error = 'encoder killed by signal %d' % self.killed
+            for jobs in self.tracks[self.next:]:
+                for j in jobs: self.results.append((j, error))
+        if self.killed or self.next == len(self.tracks):
+            self._end()
+            return
+        jobs = self.tracks[self.next]
+        self.next += 1
+        # skip over any tracks in between that we aren't encoding
+        self.skip = (jobs[0].start - self.pos) * self.frame
+        self.left = jobs[0].samples * self.frame
+        self.pos = jobs[0].start + jobs[0].samples
+        self.encoders = [ _Encoder(j) for j in jobs ]
+        for e in self.encoders: self._start(e)
+        self.chunk = wav_header(jobs[0].samples, self.channels,
+                                self.bits_per_sample, self.sample_rate)
+        # in case none of the encoders started
+        self._advance()
+
+    def _start(self, encoder):
+        try:
+            encoder.handle = self.start(PIPE, encoder.job)
+        except (Error, EnvironmentError), e:
+            encoder.error = str(e)
+            return
+        encoder.fd = encoder.handle.stdin.fileno()
+        _nonblocking(encoder.fd)
+
+    def fds(self):
+        if self.done or self.closing: return [], []
+        if self.chunk:
+            n = len(self.chunk)
+            return [], [ e.fd for e in self.encoders if e.wants(n) ]
+        return [self.src], []
+
+    def ready(self, fd):
+        if fd == self.src:
+            self._read()
+        else:
+            for e in self.encoders:
+                if e.fd == fd: e.write(self.chunk)
+        self._advance()
+
+    def _read(self):
+        try:
+            data = os.read(self.src, min(CHUNK, self.skip or self.left))
+        except OSError, e:
+            if e.errno == errno.EAGAIN: return
+            raise
+        if not data:
+            # the decoder stopped short; this track fails, and so will
+            # the ones after it
+            self._close_track()
+            return
+        self.progress = time.time()
+        if self.skip:
+            self.skip -= len(data)
+        else:
+            self.left -= len(data)
+            self.chunk = data
+            for e in self.encoders: e.written = 0
+
+    def _advance(self):
+        n = len(self.chunk)
+        if [ e for e in self.encoders if e.wants(n) ]: return
+        # every encoder has it, or can't take it; if an encoder has died,
+        # we keep reading for the others, or to get to the next track
+        if self.chunk: self.progress = time.time()
+        self.chunk = ''
+        if not self.skip and not self.left: self._close_track()
+
+    def _close_track(self):
+        for e in self.encoders:
+            if not e.handle: continue
+            try:
+                e.handle.stdin.close()
+            except IOError:
+                pass
+        self.closing = True
+
+    def poll(self):
+        if not self.closing: return self.done
+        if [ e for e in self.encoders if e.handle and
+             e.handle.poll() is None ]:
+            return False
+        for e in self.encoders:
+            if e.handle:
+                if e.handle.returncode < 0:
+                    self.killed = -e.handle.returncode
+                e.error = e.handle.error() or e.error
+            if not e.error and (self.skip or self.left):
+                e.error = 'decoder stopped %d bytes short' % \
+                          (self.skip + self.left)
+            if e.error and os.path.exists(e.job.outfile):
+                os.unlink(e.job.outfile)
+            self.results.append((e.job, e.error))
+        self.encoders = []
+        self.closing = False
+        self._next_track()
+        return self.done
+
+    def _end(self):
+        self.decoder.stdout.close()
+        # it gets a broken pipe if we're leaving early, unless it's stuck
+        if self.next < len(self.tracks) and self.decoder.poll() is None:
+            self.decoder.kill()
+        self.decoder.wait()
+        self.done = True
+
+    def kill(self, error):
+        """
+        Stops at once, killing the decoder and encoders, and fails the
+        jobs that weren't done with error.
+        """
+        if self.done: return
+        for e in self.encoders:
+            if e.handle:
+                e.handle.kill()
+                e.handle.wait()
+            if os.path.exists(e.job.outfile): os.unlink(e.job.outfile)
+            self.results.append((e.job, error))
+        for jobs in self.tracks[self.next:]:
+            for j in jobs: self.results.append((j, error))
+        self.encoders = []
+        self.next = len(self.tracks)
+        if self.decoder.poll() is None: self.decoder.kill()
+        self._end()
+
+    def run(self):
+        """Does the whole job, and returns results."""
+        self.begin()
+        try:
+            while not self.poll():
+                readers, writers = self.fds()
+                if not readers and not writers:
+                    time.sleep(POLL)
+                    continue
+                readers, writers, x = select.select(readers, writers, [])
+                for fd in readers + writers: self.ready(fd)
+        except:
+            self.kill('interrupted')
+            raise
+        return self.results
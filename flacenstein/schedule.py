@@ -0,0 +1,308 @@
+"""
+Ordering transcode jobs so that a run finishes as early as it can.
+
+Workers take jobs off a queue in order, so the order is the schedule.
+Handing out the longest jobs first (LPT) means that what is left at the
+end is short tracks, and no worker is still encoding a twenty-minute
+track while the rest sit idle.  A job's cost is guessed from the length
+of its audio and how fast its encoder usually runs (ENCODER_SPEED in
+flaccfg); the same guesses give the predicted length of the run, which
+is worth comparing to the real one when tuning those speeds.  A track
+that is being encoded to several output types at once costs the sum of
+its encoders.
+
+Jobs are also spread over the devices their flac files are on, so that
+one disk isn't fought over by every worker while the others sit idle.
+Each device (named by its mount point) gets DEVICE_CONCURRENCY jobs at
+once, and what was read from it, and how fast, is summed up by
+DeviceStats at the end of a run.
+
+With -j auto, how many jobs run at once is up to Concurrency, which
+starts at one per CPU and feels its way from there by how much audio
+gets encoded per second, backing off when the disks can't keep up.
+calibrate() measures each encoder's speed beforehand, to order the jobs
+by instead of ENCODER_SPEED.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import heapq
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import flaccfg
+import pipeline
+
+# what we assume a track lasts when we don't know, in seconds
+DEFAULT_LENGTH = 240.0
+
+
+def encoder_speed(output_type):
+    """How many times realtime one output_type encoder runs, on one CPU."""
+    return flaccfg.ENCODER_SPEED.get(output_type,
+                                     flaccfg.DEFAULT_ENCODER_SPEED)
+
+
+def audio_length(job):
+    """The seconds of audio in job, or None if we don't know."""
+    if not job.samples or not job.sample_rate: return None
+    return float(job.samples) / job.sample_rate
+
+
+def estimate(jobs, speed):
+    """
+    Returns a list of (cost, job) for jobs, where cost is the guessed
+    seconds to encode it at speed(job) times realtime.  A job with jobs
+    of its own (an AlbumJob) costs what they add up to, since each of
+    them has its own encoder.
+    """
+    tracks = []
+    for j in jobs: tracks.extend(getattr(j, 'jobs', [j]))
+    known = [ n for n in map(audio_length, tracks) if n is not None ]
+    if known: guess = sum(known) / len(known)
+    else: guess = DEFAULT_LENGTH
+
+    def cost(j):
+        if hasattr(j, 'jobs'): return sum(map(cost, j.jobs))
+        if getattr(j, 'retag', False): return 0.0 # no audio to encode
+        n = audio_length(j)
+        if n is None: n = guess
+        return n / speed(j)
+
+    return [ (cost(j), j) for j in jobs ]
+
+
+def lpt(costs, by_album=False):
+    """
+    Orders a list of (cost, job) longest first.  If by_album, the jobs
+    for each flac file are kept together, largest album first, so that
+    albums are finished one after another instead of all at the end.
+    """
+    if not by_album:
+        return sorted(costs, key=lambda (c, j): c, reverse=True)
+    albums = {}
+    for c, j in costs: albums.setdefault(j.flacfile, []).append((c, j))
+    groups = albums.values()
+    groups.sort(key=lambda g: sum([ c for c, j in g ]), reverse=True)
+    out = []
+    for g in groups: out.extend(sorted(g, key=lambda (c, j): c, reverse=True))
+    return out
+
+
+def makespan(costs, workers):
+    """
+    How long workers workers take over a list of (cost, job), each taking
+    the next job as soon as it is free.
+    """
+    free = [0.0] * max(1, workers)
+    for c, j in costs:
+        heapq.heapreplace(free, free[0] + c)
+    return max(free)
+
+
+def mount_point(path):
+    """The mount point of the filesystem path is on."""
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path: break
+        path = parent
+    return path
+
+
+_mounts = {} # st_dev -> mount point
+
+def source_device(flac):
+    """The mount point of the filesystem flac is on."""
+    dev = flac.device
+    try:
+        if dev is None: dev = os.stat(flac.filename).st_dev
+    except OSError:
+        return mount_point(os.path.dirname(flac.filename))
+    if dev not in _mounts:
+        _mounts[dev] = mount_point(os.path.dirname(flac.filename))
+    return _mounts[dev]
+
+
+def source_bytes(flac, samples):
+    """About how many bytes of flac have to be read to decode samples."""
+    if not flac.filesize: return 0
+    if samples and flac.samples: return flac.filesize * samples / flac.samples
+    return flac.filesize / max(1, len(flac.tracks))
+
+
+def device_limit(mount):
+    """How many jobs to run at once on files under mount."""
+    return flaccfg.DEVICE_CONCURRENCY.get(mount,
+                                          flaccfg.DEFAULT_DEVICE_CONCURRENCY)
+
+
+class DeviceStats:
+    """Bytes read from each device, and when it was busy."""
+
+    def __init__(self):
+        self.bytes = {}
+        self.intervals = {}
+
+    def add(self, dev, nbytes, started, finished):
+        self.bytes[dev] = self.bytes.get(dev, 0) + nbytes
+        self.intervals.setdefault(dev, []).append((started, finished))
+
+    def busy(self, dev):
+        """Seconds during which dev had at least one job running."""
+        total = 0.0
+        end = None
+        for a, b in sorted(self.intervals[dev]):
+            if end is not None and a < end: a = end
+            if b > a: total += b - a
+            end = max(end, b)
+        return total
+
+    def report(self):
+        lines = []
+        for dev in sorted(self.bytes):
+            mb = self.bytes[dev] / 1048576.0
+            busy = self.busy(dev)
+            lines.append('%-24s %9.1f MB in %s, %6.1f MB/s (limit %d)' %
+                         (dev, mb, format_seconds(busy), mb / max(busy, 0.001),
+                          device_limit(dev)))
+        return lines
+
+
+def format_seconds(t):
+    t = int(round(t))
+    if t >= 3600: return '%d:%02d:%02d' % (t / 3600, t / 60 % 60, t % 60)
+    return '%d:%02d' % (t / 60, t % 60)
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def calibrate(xfmmod, seconds=None):
+    """
+    Times xfmmod's encoder on seconds of CD-quality noise, and returns
+    how many times realtime it ran, or None if it wouldn't run.
+    """
+    if seconds is None: seconds = flaccfg.CALIBRATION_SECONDS
+    j = pipeline.EncodeJob()
+    j.artist = j.album = j.title = u'Calibration'
+    j.tracknum = 1
+    j.coverart = None
+    j.channels, j.bits_per_sample, j.sample_rate = 2, 16, 44100
+    samples = seconds * j.sample_rate
+    # noise, since silence is much quicker to encode than music
+    audio = os.urandom(samples * j.channels * j.bits_per_sample / 8)
+    tmp = tempfile.mkdtemp('', 'flacenstein-calibrate.')
+    j.outfile = os.path.join(tmp, 'calibrate.%s' % xfmmod.extension)
+    try:
+        started = time.time()
+        try:
+            handle = pipeline.start_encoder(xfmmod, pipeline.PIPE, j)
+            try:
+                handle.stdin.write(pipeline.wav_header(samples, j.channels,
+                                                       j.bits_per_sample,
+                                                       j.sample_rate))
+                handle.stdin.write(audio)
+            finally:
+                handle.stdin.close()
+                handle.wait()
+        except (pipeline.Error, EnvironmentError):
+            return None
+        if handle.error(): return None
+        return seconds / max(time.time() - started, 0.001)
+    finally:
+        shutil.rmtree(tmp, True)
+
+
+def cpu_times():
+    """
+    The (total, iowait) jiffies the CPUs have spent since boot, or None
+    if we can't tell (anywhere but Linux).
+    """
+    try:
+        fd = open('/proc/stat')
+        try:
+            fields = fd.readline().split()
+        finally:
+            fd.close()
+    except IOError:
+        return None
+    if not fields or fields[0] != 'cpu' or len(fields) < 6: return None
+    jiffies = map(int, fields[1:])
+    return sum(jiffies), jiffies[4]
+
+
+class Concurrency:
+    """
+    How many jobs to run at once, for -j auto.  Call it for the current
+    number (it goes to engine.Engine as running), and tell it about each
+    job that finishes.  Once an interval has passed, and at least as many
+    jobs have finished as are running, it compares the audio encoded per
+    second to the interval before, and runs one job more or one fewer
+    from then on: the same way as last time if that helped, and the other
+    way if it didn't.  Too much iowait always means one fewer.
+    """
+
+    def __init__(self, workers, most, interval=None, max_iowait=None):
+        if interval is None: interval = flaccfg.AUTO_INTERVAL
+        if max_iowait is None: max_iowait = flaccfg.AUTO_MAX_IOWAIT
+        self.most = max(1, most)
+        self.workers = max(1, min(workers, self.most))
+        self.interval = interval
+        self.max_iowait = max_iowait
+        self.step = 1
+        self.rate = None # audio seconds per second, last interval
+        self.low = self.high = self.workers
+        self._reset(time.time())
+
+    def __call__(self):
+        return self.workers
+
+    def _reset(self, now):
+        self.since = now
+        self.audio = 0.0
+        self.jobs = 0
+        self.cpu = cpu_times()
+
+    def iowait(self):
+        """The fraction of CPU time spent in iowait since the interval began."""
+        now = cpu_times()
+        if now is None or self.cpu is None: return 0.0
+        total, iowait = now[0] - self.cpu[0], now[1] - self.cpu[1]
+        if total <= 0: return 0.0
+        return float(iowait) / total
+
+    def finished(self, seconds, now=None):
+        """
+        Notes that a job with seconds of audio finished, and returns a
+        message if that changed how many jobs to run, or else None.
+        """
+        if now is None: now = time.time()
+        self.audio += seconds
+        self.jobs += 1
+        elapsed = now - self.since
+        if elapsed < self.interval or self.jobs < self.workers: return None
+        rate = self.audio / elapsed
+        iowait = self.iowait()
+        if iowait > self.max_iowait: self.step = -1
+        elif self.rate is not None and rate <= self.rate: self.step = -self.step
+        old = self.workers
+        self.workers = max(1, min(self.workers + self.step, self.most))
+        # turn around at the ends, so there's still something to compare
+        if self.workers == old: self.step = -self.step
+        self.low = min(self.low, self.workers)
+        self.high = max(self.high, self.workers)
+        self.rate = rate
+        self._reset(now)
+        if self.workers == old: return None
+        return 'Running %d jobs at once instead of %d (%.1fx realtime, ' \
+               '%d%% iowait)' % (self.workers, old, rate, iowait * 100)
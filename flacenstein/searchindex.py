@@ -0,0 +1,253 @@
+"""
+An inverted index over the filename, artist, and album of every entry in a
+FlacLibrary (and over the titles of its tracks), so that a search doesn't
+have to run a regex over every file in the library.
+
+Every search argument is still a regex matched case-insensitively against
+those three fields, and it is still the regex that has the last word.  The
+index only narrows down which entries are worth trying it on.  Any match
+of a regex has to contain the literal strings that the regex requires (for
+'beatles.*white', that is 'beatles' and 'white'), and:
+
++ a literal of three or more characters can only be found in an entry
+  that has every one of its trigrams, and
+
++ a literal of one or two word characters can only be found inside one
+  of an entry's words, and there aren't very many different words.
+
+A regex with no required literals (like 'a|b') gets no help, and is run
+over everything as before.  Only ASCII is indexed; anything else reads as
+'?', which can only make the candidate list longer, never shorter.
+
+Copyright (C) 2005 Michael A. Dickerson.  Modification and
+redistribution are permitted under the terms of the GNU General Public
+License, version 2.
+"""
+
+import array
+import re
+import sre_constants
+import sre_parse
+
+GRAM = 3
+
+_WORD = re.compile(r'\w+')
+_HIGH_BYTES = re.compile(r'[\x80-\xff]')
+
+
+def _fold(text):
+    """Lower case, with everything that isn't ASCII turned into '?'."""
+    if isinstance(text, unicode):
+        return text.lower().encode('ascii', 'replace')
+    return _HIGH_BYTES.sub('?', text.lower())
+
+
+def _words_and_grams(texts):
+    words = set()
+    grams = set()
+    for text in texts:
+        text = _fold(text)
+        words.update(_WORD.findall(text))
+        for i in xrange(len(text) - GRAM + 1):
+            grams.add(text[i:i+GRAM])
+    return words, grams
+
+
+def _literal_runs(seq, runs):
+    """
+    Appends to runs the literal strings that anything matching the parsed
+    regex seq has to contain.  Anything we're not sure about just ends the
+    current run, which only ever makes the index less choosy.
+    """
+    run = []
+    for op, av in seq:
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av))
+            continue
+        if op == sre_constants.AT:
+            # zero-width, so the literals on either side are still adjacent
+            continue
+        if run: runs.append(''.join(run).lower())
+        run = []
+        if op == sre_constants.SUBPATTERN:
+            _literal_runs(av[-1], runs)
+    if run: runs.append(''.join(run).lower())
+
+
+def requiredLiterals(pattern):
+    """Returns the literal strings every match of pattern must contain."""
+    runs = []
+    try:
+        _literal_runs(sre_parse.parse(pattern), runs)
+    except (sre_constants.error, TypeError, ValueError):
+        return []
+    return runs
+
+
+class _Postings:
+    """
+    Maps trigrams and words to the numbers of the documents they appear
+    in.  Document numbers only ever go up, so every array stays sorted.
+    """
+
+    def __init__(self):
+        self.grams = {} # trigram -> array of document numbers
+        self.words = {} # word -> array of document numbers
+
+    def add(self, n, texts):
+        words, grams = _words_and_grams(texts)
+        for w in words: self.words.setdefault(w, array.array('i')).append(n)
+        for g in grams: self.grams.setdefault(g, array.array('i')).append(n)
+
+    def _find(self, literal):
+        """Returns the set of documents that might contain literal."""
+        if len(literal) >= GRAM:
+            postings = []
+            for i in xrange(len(literal) - GRAM + 1):
+                p = self.grams.get(literal[i:i+GRAM])
+                if p is None: return set()
+                postings.append(p)
+            postings.sort(key=len)
+            found = set(postings[0])
+            for p in postings[1:]:
+                found.intersection_update(p)
+                if not found: break
+            return found
+        m = _WORD.match(literal)
+        if m and m.end() == len(literal):
+            found = set()
+            for word, p in self.words.iteritems():
+                if literal in word: found.update(p)
+            return found
+        return None
+
+    def candidates(self, pattern):
+        """
+        Returns the set of documents that might match the regex pattern, or
+        None if we can't narrow it down at all.
+        """
+        found = None
+        for literal in requiredLiterals(pattern):
+            if not literal: continue
+            ids = self._find(literal)
+            if ids is None: continue
+            if found is None: found = ids
+            else: found.intersection_update(ids)
+        return found
+
+    def __getstate__(self):
+        # arrays pickle as lists of ints, which is big and slow
+        return dict([ (name, dict([ (k, v.tostring()) for k, v
+                                    in getattr(self, name).iteritems() ]))
+                      for name in ('grams', 'words') ])
+
+    def __setstate__(self, state):
+        self.__init__()
+        for name in ('grams', 'words'):
+            d = getattr(self, name)
+            for k, v in state[name].iteritems():
+                a = array.array('i')
+                a.fromstring(v)
+                d[k] = a
+
+
+class SearchIndex:
+    """
+    Indexes the filename, artist, and album of each library entry (by
+    md5), and the title of each of its tracks.  add() and remove() keep it
+    up to date as a scan goes.  Removed entries leave a hole until
+    rebuild(), which a FlacLibrary does when there are enough of them.
+    """
+
+    def __init__(self):
+        self.md5s = []    # entry number -> md5, or None if removed
+        self.ids = {}     # md5 -> entry number
+        self.albums = _Postings()
+        self.tracks = []  # track number -> flaclib.Track, or None
+        self.trackids = {} # md5 -> track numbers
+        self.titles = _Postings()
+        self.holes = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, flac):
+        if flac.md5 in self.ids: self.remove(flac.md5)
+        n = len(self.md5s)
+        self.md5s.append(flac.md5)
+        self.ids[flac.md5] = n
+        self.albums.add(n, (flac.filename, flac.artist or '',
+                            flac.album or ''))
+        ids = []
+        for track in flac.getTracks():
+            n = len(self.tracks)
+            self.tracks.append(track)
+            self.titles.add(n, (track.title or '',))
+            ids.append(n)
+        self.trackids[flac.md5] = ids
+        self.dirty = True
+
+    def remove(self, md5):
+        n = self.ids.pop(md5, None)
+        if n is None: return
+        self.md5s[n] = None
+        for n in self.trackids.pop(md5, ()): self.tracks[n] = None
+        self.holes += 1
+        self.dirty = True
+
+    def needsRebuild(self):
+        return self.holes > 1000 and self.holes > len(self.md5s) / 4
+
+    def rebuild(self, flacs):
+        """Starts over with the FlacRecords in the list flacs."""
+        self.__init__()
+        for flac in flacs: self.add(flac)
+
+    def candidates(self, pattern):
+        """
+        Returns the set of md5s of the entries that might match the regex
+        pattern, or None if the index can't narrow it down at all.
+        """
+        found = self.albums.candidates(pattern)
+        if found is None: return None
+        return set([ self.md5s[n] for n in found if self.md5s[n] is not None ])
+
+    def trackCandidates(self, pattern):
+        """
+        Returns a list of the Tracks whose titles might match the regex
+        pattern, which is every track if the index can't narrow it down.
+        """
+        found = self.titles.candidates(pattern)
+        if found is None: found = xrange(len(self.tracks))
+        else: found = sorted(found)
+        return [ self.tracks[n] for n in found if self.tracks[n] is not None ]
+
+    def __getstate__(self):
+        return { 'md5s': self.md5s, 'holes': self.holes,
+                 'albums': self.albums, 'tracks': self.tracks,
+                 'titles': self.titles }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+        self.ids = dict([ (md5, n) for n, md5 in enumerate(self.md5s)
+                          if md5 is not None ])
+        for n, track in enumerate(self.tracks):
+            if track is not None:
+                self.trackids.setdefault(track.md5, []).append(n)
+
+
+if __name__ == '__main__':
+    # self-test: what the index narrows a search down to
+    p = _Postings()
+    p.add(0, ['The Beatles', 'White Album'])
+    p.add(1, ['AC/DC', 'Back in Black'])
+    assert p.candidates('beatles.*white') == set([0])
+    assert p.candidates('b') == set([0, 1])
+    assert p.candidates('ac/dc') == set([1])
+    assert p.candidates('a|b') is None
+    # short literals that aren't words can't use the word list
+    for pattern in ('-', '/', '&', ' ', '/d'):
+        assert p.candidates(pattern) is None, pattern
+    print 'self-test OK!'
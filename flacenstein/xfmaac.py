@@ -7,11 +7,14 @@ http://www.rarewares.org/.
 """
 
 import os
+import shutil
 import subprocess
 import sys
 
 import flaclib
 import flaccfg
+import outtags
+import pipeline
 
 # The following are required for all transform modules, and will be
 # used by Flacenstein.
@@ -20,6 +23,14 @@ status = "init"
 notify = lambda s: sys.stdout.write(s + '\n')
 outpath = "/tmp/flac"
 extension = "m4a"
+# anything that changes the audio, so that outputs made with different
+# options are redone
+encoder_options = []
+# what the encoder can do; see pipeline.capabilities()
+sample_bits = (16, 24)
+writes_tags = True
+writes_art = True
+threads = 1
 
 artdir = ""
 
@@ -37,31 +48,43 @@ def ready():
                                loud=True)
     return ok
 
-def encodeFile(job):
-
-    # create output directory if necessary
-    (outdir, outfile) = os.path.split(job.outfile)
-    if not os.path.isdir(outdir):
-        try:
-            os.makedirs(outdir)
-        except:
-            print "Can't create path", outdir
-            os._exit(1)
-        
+def encoderCommand(job):
+    """The command that encodes a WAV stream on stdin to job.outfile."""
     # Beware, untested!
-    cmd = ['faac', '-o', job.outfile,
-           '--artist', job.artist,
-           '--album', job.album,
-           '--title', job.title,
+    cmd = ['faac'] + encoder_options + \
+          ['-o', pipeline.utf8(job.outfile),
+           '--artist', pipeline.utf8(job.artist),
+           '--album', pipeline.utf8(job.album),
+           '--title', pipeline.utf8(job.title),
            '--track', str(job.tracknum)]
     if job.coverart:
         cmd.extend(['--cover-art', job.coverart])
     cmd.append('-')
-    flac_stdout = flaclib.flacpipe(job.flacfile, job.tracknum)
-    faac_child = subprocess.Popen(cmd, stdin=flac_stdout)
-    flac_stdout.close()
-    faac_child.wait()
-    os._exit(faac_child.returncode)
+    return cmd
+
+def retagFile(job):
+    """Copies job.existing to job.outfile, with its tags replaced."""
+    shutil.copyfile(job.existing, job.outfile)
+    cmd = [flaccfg.BIN_MP4TAGS,
+           '-a', pipeline.utf8(job.artist),
+           '-A', pipeline.utf8(job.album),
+           '-s', pipeline.utf8(job.title),
+           '-t', str(job.tracknum)]
+    if job.coverart: cmd.extend(['-P', job.coverart])
+    else: cmd.extend(['-r', 'P'])
+    cmd.append(pipeline.utf8(job.outfile))
+    try:
+        ret = subprocess.call(cmd)
+    except OSError, e:
+        raise outtags.Unsupported("can't run %s: %s" % (cmd[0], e))
+    if ret: raise outtags.Unsupported('%s returned %d' % (cmd[0], ret))
+
+def startEncoder(src, job):
+    """
+    Starts encoding the WAV stream src to job.outfile, and returns its
+    pipeline.EncoderHandle; see pipeline.start_encoder().
+    """
+    return pipeline.spawn(encoderCommand(job), src, job)
 
 def cleanup():
     """We can at least try to clean up after ourselves, if the caller calls
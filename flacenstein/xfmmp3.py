@@ -4,12 +4,12 @@ seems to no longer be hard to get; ubuntu 14.10 can just do
 'apt-get install lame' from the normal sources.
 """
 
-import os
-import subprocess
 import sys
 
 import flaclib
 import flaccfg
+import outtags
+import pipeline
 
 description = "Encode to MP3"
 status = "init"
@@ -17,6 +17,14 @@ notify = lambda s: sys.stdout.write(s + '\n')
 outpath = "/tmp/flac"
 extension = "mp3"
 debug = True
+# anything that changes the audio, so that outputs made with different
+# options are redone
+encoder_options = ['--preset', 'medium']
+# what the encoder can do; see pipeline.capabilities()
+sample_bits = (8, 16, 24)
+writes_tags = True
+writes_art = True
+threads = 1
 
 def ready():
     """
@@ -31,30 +39,28 @@ def ready():
                                loud=True)
     return ok
 
-def encodeFile(job):
-    
-    # create output directory if necessary
-    (outdir, outfile) = os.path.split(job.outfile)
-    if not os.path.isdir(outdir):
-        try:
-            os.makedirs(outdir)
-        except:
-            notify("Can't create path %s" % outdir)
-            os._exit(1)
-
-    cmd = [flaccfg.BIN_LAME, '--preset', 'medium',
-           '--ta', job.artist,
-           '--tl', job.album,
-           '--tt', job.title,
+def encoderCommand(job):
+    """The command that encodes a WAV stream on stdin to job.outfile."""
+    cmd = [flaccfg.BIN_LAME] + encoder_options + \
+          ['--ta', pipeline.utf8(job.artist),
+           '--tl', pipeline.utf8(job.album),
+           '--tt', pipeline.utf8(job.title),
            '--tn', str(job.tracknum)]
     if job.coverart:
         cmd.extend(['--ti', job.coverart])
-    cmd.extend(['-', job.outfile])
-    flac_stdout = flaclib.flacpipe(job.flacfile, job.tracknum)
-    lame_child = subprocess.Popen(cmd, stdin=flac_stdout)
-    flac_stdout.close() # recall it's been duplicated into the lame process
-    lame_child.wait()
-    os._exit(lame_child.returncode)
+    cmd.extend(['-', pipeline.utf8(job.outfile)])
+    return cmd
+
+def retagFile(job):
+    """Copies job.existing to job.outfile, with its tags replaced."""
+    outtags.writeID3(job.existing, job.outfile, job)
+
+def startEncoder(src, job):
+    """
+    Starts encoding the WAV stream src to job.outfile, and returns its
+    pipeline.EncoderHandle; see pipeline.start_encoder().
+    """
+    return pipeline.spawn(encoderCommand(job), src, job)
 
 def cleanup():
     """this module doesn't use any temp files, so nothing to do here"""
@@ -2,12 +2,12 @@
 Opus transform module for flacenstein.  Requires opus-tools.
 """
 
-import os
-import subprocess
 import sys
 
 import flaclib
 import flaccfg
+import outtags
+import pipeline
 
 description = "Encode to Opus"
 status = "init"
@@ -15,6 +15,14 @@ notify = lambda s: sys.stdout.write(s + '\n')
 outpath = "/tmp/flac"
 extension = "opus"
 debug = True
+# anything that changes the audio, so that outputs made with different
+# options are redone; we accept the default bitrate of 96kbps per stereo pair
+encoder_options = []
+# what the encoder can do; see pipeline.capabilities()
+sample_bits = (8, 16, 24)
+writes_tags = True
+writes_art = True
+threads = 1
 
 def ready():
     """
@@ -29,30 +37,27 @@ def ready():
                                loud=True)
     return ok
 
-def encodeFile(job):
-    
-    # create output directory if necessary
-    (outdir, outfile) = os.path.split(job.outfile)
-    if not os.path.isdir(outdir):
-        try:
-            os.makedirs(outdir)
-        except:
-            notify("Can't create path %s" % outdir)
-            os._exit(1)
-
-    cmd = ['opusenc', # accept default bitrate of 96kbps per stereo pair
-           '--quiet',
-           '--artist', job.artist,
-           '--album', job.album,
-           '--title', job.title,
+def encoderCommand(job):
+    """The command that encodes a WAV stream on stdin to job.outfile."""
+    cmd = ['opusenc', '--quiet'] + encoder_options + \
+          ['--artist', pipeline.utf8(job.artist),
+           '--album', pipeline.utf8(job.album),
+           '--title', pipeline.utf8(job.title),
            '--comment', 'TRACKNUMBER=%s' % str(job.tracknum)]
     if job.coverart: cmd.extend(['--picture', job.coverart])
-    cmd.extend(['-', job.outfile])
-    flac_stdout = flaclib.flacpipe(job.flacfile, job.tracknum)
-    opus_child = subprocess.Popen(cmd, stdin=flac_stdout)
-    flac_stdout.close() # recall it's been duplicated into the lame process
-    opus_child.wait()
-    os._exit(opus_child.returncode)
+    cmd.extend(['-', pipeline.utf8(job.outfile)])
+    return cmd
+
+def retagFile(job):
+    """Copies job.existing to job.outfile, with its tags replaced."""
+    outtags.writeOggComments(job.existing, job.outfile, job)
+
+def startEncoder(src, job):
+    """
+    Starts encoding the WAV stream src to job.outfile, and returns its
+    pipeline.EncoderHandle; see pipeline.start_encoder().
+    """
+    return pipeline.spawn(encoderCommand(job), src, job)
 
 def cleanup():
     """this module doesn't use any temp files, so nothing to do here"""
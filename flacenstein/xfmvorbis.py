@@ -7,11 +7,12 @@ Debian package is vorbis-tools.
 
 import os
 import re
-import subprocess
 import sys
 
 import flaccfg
 import flaclib
+import outtags
+import pipeline
 
 description = "Encode to Ogg Vorbis"
 status = "init"
@@ -19,6 +20,14 @@ notify = lambda s: sys.stdout.write(s + '\n')
 outpath = "/tmp/flac"
 extension = "ogg"
 debug = True
+# anything that changes the audio, so that outputs made with different
+# options are redone
+encoder_options = []
+# what the encoder can do; see pipeline.capabilities()
+sample_bits = (8, 16, 24)
+writes_tags = True
+writes_art = False # oggenc isn't given the cover art
+threads = 1
 
 def ready():
     """Check whether binaries we need can be executed."""
@@ -31,28 +40,27 @@ def ready():
                                loud=True)
     return ok
 
-def encodeFile(job):
-    
-    # create output directory if necessary
-    (outdir, outfile) = os.path.split(job.outfile)
-    if not os.path.isdir(outdir):
-        try:
-            os.makedirs(outdir)
-        except:
-            notify("Can't create path %s" % outdir)
-            os._exit(1)
+def encoderCommand(job):
+    """The command that encodes a WAV stream on stdin to job.outfile."""
+    return [flaccfg.BIN_OGG] + encoder_options + \
+           ['-o', pipeline.utf8(job.outfile),
+            '-a', pipeline.utf8(job.artist),
+            '-l', pipeline.utf8(job.album),
+            '-t', pipeline.utf8(job.title),
+            '-N', str(job.tracknum),
+            '-']
+
+def retagFile(job):
+    """Copies job.existing to job.outfile, with its tags replaced."""
+    # oggenc isn't given the cover art, so neither is this
+    outtags.writeOggComments(job.existing, job.outfile, job, art=False)
 
-    cmd = [flaccfg.BIN_OGG, '-o', job.outfile,
-           '-a', job.artist,
-           '-l', job.album,
-           '-t', job.title,
-           '-N', str(job.tracknum),
-           '-']
-    flac_stdout = flaclib.flacpipe(job.flacfile, job.tracknum)
-    ogg_child = subprocess.Popen(cmd, stdin=flac_stdout)
-    flac_stdout.close()
-    ogg_child.wait()
-    os._exit(ogg_child.returncode)
+def startEncoder(src, job):
+    """
+    Starts encoding the WAV stream src to job.outfile, and returns its
+    pipeline.EncoderHandle; see pipeline.start_encoder().
+    """
+    return pipeline.spawn(encoderCommand(job), src, job)
 
 def cleanup():
     """this module doesn't use any temp files, so nothing to do here"""
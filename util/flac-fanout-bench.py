@@ -0,0 +1,152 @@
+#!/usr/bin/python
+"""Usage: flac-fanout-bench.py [-t type] [-n tracks] [-s seconds]
+                              [file.flac ...]
+
+Times converting every track of each file the old way, one flac decoder
+per track, against convert --album's way, one decoder per file whose
+output is cut into tracks.  With -t, the tracks are encoded by that
+transform module's encoder (e.g. mp3 or ogg); without it, the "encoder"
+is cat to /dev/null, which leaves only the cost of decoding.
+
+With no files, the album is a synthetic one: -n tracks (12) of -s
+seconds (30) each of noise, with a cuesheet, made with flac.  Tracks
+whose samples we don't know (a file with no cuesheet and several
+titles, say) are left out.
+
+The album and the outputs go to a temporary directory that is removed
+afterward.
+
+Copyright (c) 2005 Michael A. Dickerson.  Modification and redistribution
+are permitted under the terms of the GNU General Public License, version 2.
+"""
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+from flacenstein import flaccfg
+from flacenstein import flaclib
+from flacenstein import pipeline
+
+RATE = 44100
+CHANNELS = 2
+BITS = 16
+
+
+def null_encoder(src, job):
+    return pipeline.spawn(['sh', '-c', 'cat > /dev/null'], src, job)
+
+
+def make_album(tmp, tracks, seconds):
+    """
+    Writes a flac file of tracks tracks of noise, seconds long each, with
+    a cuesheet and titles, to tmp, and returns its name.
+    """
+    wav = os.path.join(tmp, 'album.wav')
+    cue = os.path.join(tmp, 'album.cue')
+    flac = os.path.join(tmp, 'album.flac')
+    samples = tracks * seconds * RATE
+    fd = open(wav, 'wb')
+    fd.write(pipeline.wav_header(samples, CHANNELS, BITS, RATE))
+    left = samples * CHANNELS * BITS / 8
+    while left:
+        n = min(left, pipeline.CHUNK)
+        fd.write(os.urandom(n))
+        left -= n
+    fd.close()
+    fd = open(cue, 'w')
+    fd.write('FILE "album.wav" WAVE\n')
+    for c in range(tracks):
+        fd.write('  TRACK %02d AUDIO\n' % (c + 1))
+        fd.write('    INDEX 01 %02d:%02d:00\n' % divmod(c * seconds, 60))
+    fd.close()
+    cmd = [flaccfg.BIN_FLAC, '--silent', '--force', '-0',
+           '--cuesheet=%s' % cue, '-T', 'ARTIST=Noise',
+           '-T', 'ALBUM=Synthetic', '-o', flac]
+    for n in range(1, tracks + 1):
+        cmd.extend(['-T', 'TITLE[%d]=Track %d' % (n, n)])
+    subprocess.check_call(cmd + [wav])
+    os.unlink(wav)
+    return flac
+
+
+def make_jobs(f, outdir, extension):
+    jobs = []
+    for c in range(len(f.tracks)):
+        j = pipeline.EncodeJob()
+        j.start, j.end, j.samples = f.trackRange(c)
+        if j.start is None:
+            print '%s: skipping track %d, whose samples are unknown' % (
+                f.filename, c + 1)
+            continue
+        j.tracknum = c + 1
+        j.artist = f.artist
+        j.album = f.album
+        j.title = f.tracks[c] or 'Track %d' % j.tracknum
+        j.flacfile = f.filename
+        j.channels = f.channels
+        j.bits_per_sample = f.bits_per_sample
+        j.sample_rate = f.sample_rate
+        j.coverart = None
+        j.outfile = os.path.join(outdir, '%02d.%s' % (j.tracknum, extension))
+        jobs.append(j)
+    return jobs
+
+
+def per_track(f, jobs, encoder):
+    for j in jobs:
+        # with no source, the track is decoded just for this encoder
+        handle = encoder(None, j)
+        handle.wait()
+        if handle.error(): print '%s: %s' % (j.outfile, handle.error())
+
+
+def per_album(f, jobs, encoder):
+    for j, err in pipeline.AlbumJob(jobs, encoder).run():
+        if err: print '%s: %s' % (j.outfile, err)
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 't:n:s:')
+        opts = dict(opts)
+        num_tracks = int(opts.get('-n', 12))
+        seconds = int(opts.get('-s', 30))
+    except (getopt.GetoptError, ValueError), e:
+        print e
+        print __doc__
+        sys.exit(1)
+    encoder, extension = null_encoder, 'wav'
+    if '-t' in opts:
+        a = opts['-t']
+        xfmmod = __import__('flacenstein.xfm%s' % a, globals(), locals(),
+                            'xfm%s' % a)
+        encoder = lambda src, job: pipeline.start_encoder(xfmmod, src, job)
+        extension = xfmmod.extension
+
+    tmp = tempfile.mkdtemp('', 'fanout.')
+    try:
+        if not args:
+            print 'Making a synthetic album of %d %d-second tracks' % (
+                num_tracks, seconds)
+            args = [ make_album(tmp, num_tracks, seconds) ]
+        flacs = []
+        for fname in args: flacs.append(flaclib.FlacFile(fname))
+        tracks = sum([ len(f.tracks) for f in flacs ])
+        print '%d files, %d tracks' % (len(flacs), tracks)
+
+        for name, func in (('per-track', per_track), ('per-album', per_album)):
+            t = time.time()
+            for i, f in enumerate(flacs):
+                outdir = os.path.join(tmp, name, str(i))
+                os.makedirs(outdir)
+                jobs = make_jobs(f, outdir, extension)
+                if jobs: func(f, jobs, encoder)
+            print '%-10s %8.2f s' % (name, time.time() - t)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+"""Usage: flac-membench.py [n]
+
+Compares the memory and pickle cost of n library entries (default 50000)
+kept as plain FlacFile objects, the way libraries used to be, against
+the compact FlacRecord form.  The entries are made up, but shaped like a
+real library: a few thousand artists with several albums each, a dozen
+tracks per album, and the occasional rare tag.
+
+Each form is built in a child process of its own, so that the resident
+set size it reports is not polluted by the other one.
+
+Copyright (c) 2005 Michael A. Dickerson.  Modification and redistribution
+are permitted under the terms of the GNU General Public License, version 2.
+"""
+
+import os
+import cPickle as pickle
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+from flacenstein import flaclib
+
+
+def make_flacfile(i, rng):
+    flac = flaclib.FlacFile(None)
+    artist = 'Artist %d' % rng.randint(0, 5000)
+    album = 'Album %d' % (i / 3)
+    flac.filename = '/mnt/flac/%s/%s - %s.flac' % (artist[:1], artist, album)
+    flac.md5 = '%032x' % i
+    flac.mtime = 1500000000 + i
+    flac.filesize = rng.randint(100, 600) << 20
+    flac.device = 2049
+    flac.inode = 1000000 + i
+    flac.channels = 2
+    flac.bits_per_sample = 16
+    flac.sample_rate = 44100
+    flac.samples = rng.randint(20, 70) * 60 * 44100
+    flac.cuesheet = [ (n + 1, n * 588 * 75 * 240) for n in xrange(12) ]
+    # the way the native reader would have decoded them: a fresh string
+    # for every file
+    flac.tags['ARTIST'] = unicode(artist)
+    flac.tags['ALBUM'] = unicode(album)
+    flac.tags['DATE'] = str(1960 + rng.randint(0, 60))
+    flac.tags['GENRE'] = 'Rock'[:rng.randint(0, 4)] or None
+    if rng.random() < 0.1: flac.tags['OWNER'] = 'mikey'
+    flac.tracks = [ u'Track title %d' % n for n in xrange(12) ]
+    return flac
+
+
+def build(form, n):
+    rng = random.Random(1)
+    flacs = {}
+    for i in xrange(n):
+        flac = make_flacfile(i, rng)
+        if form == 'record': flac = flaclib.FlacRecord(flac)
+        flacs[flac.md5] = flac
+    return flacs
+
+
+def measure(form, n, rfd, wfd):
+    """Runs in a child process, and writes one line of results to wfd."""
+    os.close(rfd)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    flacs = build(form, n)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.time()
+    s = pickle.dumps(flacs, pickle.HIGHEST_PROTOCOL)
+    dump_time = time.time() - t
+    del flacs
+    t = time.time()
+    pickle.loads(s)
+    load_time = time.time() - t
+    os.write(wfd, '%-8s %10d KB %10d KB %8.2f s %8.2f s\n' %
+             (form, after - before, len(s) / 1024, dump_time, load_time))
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    n = 50000
+    if len(sys.argv) > 1: n = int(sys.argv[1])
+    print '%d entries' % n
+    print '%-8s %13s %13s %10s %10s' % ('form', 'max RSS', 'pickle',
+                                        'dump', 'load')
+    for form in ('flacfile', 'record'):
+        rfd, wfd = os.pipe()
+        child = os.fork()
+        if child == 0: measure(form, n, rfd, wfd)
+        os.close(wfd)
+        sys.stdout.write(os.fdopen(rfd).read())
+        os.waitpid(child, 0)